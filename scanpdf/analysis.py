@@ -0,0 +1,406 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    In-process page analysis on decoded pixel arrays (see :mod:`pnm`).  These
+    compute the same metrics as :class:`backend.ImageMagickBackend`, without
+    forking a convert for every page.
+"""
+
+import logging
+
+import numpy as np
+
+# Mean RGB channel difference above which a pixel counts as color (same as the histogram check)
+COLOR_DIFF = 30
+# Fraction of (downsampled) pixels that must be color for the page to be color
+COLOR_MIN_FRACTION = 0.002
+# Rows of the page the color check converts to float at a time
+BAND_ROWS = 384
+# Resolution the color check works at on a pyramid (-adaptive-resize 35% of the page)
+COLOR_DPI = 100
+
+
+def downsample(pixels, factor):
+    """
+        Shrink pixels by an integer factor by averaging factor x factor blocks
+        (the same smoothing -adaptive-resize gives us).
+
+        :returns: float32 array
+    """
+    if factor <= 1:
+        return pixels.astype(np.float32)
+    h = pixels.shape[0] // factor * factor
+    w = pixels.shape[1] // factor * factor
+    blocks = pixels[:h, :w].astype(np.float32)
+    blocks = blocks.reshape((h // factor, factor, w // factor, factor) + pixels.shape[2:])
+    return blocks.mean(axis=(1, 3))
+
+
+def halve(pixels):
+    """
+        Shrink pixels to half size by averaging 2x2 blocks, in integer math
+        (an odd last row or column is dropped).
+
+        :returns: uint8 array
+    """
+    h = pixels.shape[0] // 2 * 2
+    w = pixels.shape[1] // 2 * 2
+    # Add up pairs of rows, then pairs of columns
+    rows = pixels[0:h:2, :w].astype(np.uint16)
+    rows += pixels[1:h:2, :w]
+    pairs = rows.reshape((h // 2, w // 2, 2) + pixels.shape[2:])
+    total = pairs[:, :, 0] + pairs[:, :, 1]
+    total += 2
+    total >>= 2
+    return total.astype(np.uint8)
+
+
+def color_diff(pixels):
+    """
+        Mean of the absolute differences between the R, G and B channels of each
+        pixel.  Shades of grey will be very close to zero in this metric.
+    """
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    return (np.abs(g - r) + np.abs(b - r) + np.abs(b - g)) / 3
+
+
+def pyramid_is_color(pyramid):
+    """
+        :func:`is_color` on the level of a :class:`pyramid.Pyramid` closest to COLOR_DPI
+    """
+    pixels, dpi = pyramid.at(COLOR_DPI)
+    return is_color(pixels, factor=1)
+
+
+def is_color(pixels, factor=3):
+    """
+        Returns True if the page has a meaningful amount of color.
+
+        The page is downsampled by factor (3 is close to the 35% that the
+        ImageMagick check uses), and then every pixel whose RGB channel
+        difference is above COLOR_DIFF is counted as color.  This replaces
+        quantizing to 8 colors and checking the channel difference of each
+        color, so a small patch of color is enough, but scanner noise is not.
+
+        The page is worked through in bands of BAND_ROWS, so a mapped page
+        (see :func:`pnm.map_pnm`) is never copied as a whole.
+
+        :param pixels: array from :func:`pnm.map_pnm`
+    """
+    if pixels.ndim < 3:
+        return False
+    band = max(1, BAND_ROWS // factor) * factor
+    colored = 0
+    total = 0
+    for top in range(0, pixels.shape[0], band):
+        small = downsample(pixels[top:top + band], factor)
+        colored += np.count_nonzero(color_diff(small) > COLOR_DIFF)
+        total += small.shape[0] * small.shape[1]
+    if total == 0:
+        return False
+    fraction = float(colored) / total
+    logging.debug("Color fraction is %s" % fraction)
+    return fraction > COLOR_MIN_FRACTION
+
+
+# Pages whose content is smaller than this (in inches) in either direction are blank
+BLANK_MIN_INCHES = 0.3
+# Resolution that the blank check works at
+BLANK_DPI = 100
+# Content is anything darker than the paper by more than this fraction (like -fuzz 15%)
+BLANK_FUZZ = 0.15
+# Size of the cells that ink is counted over, in inches (stands in for the -blur 0x15)
+BLANK_CELL_INCHES = 0.1
+
+
+def to_grey(pixels):
+    """
+        Cheap greyscale view of pixels for finding ink: the green channel
+        carries most of the luminance, and taking it doesn't copy anything.
+    """
+    if pixels.ndim == 3:
+        return pixels[..., 1]
+    return pixels
+
+
+def find_ink(grey):
+    """
+        :returns: bool array, True where grey is darker than the paper by more than BLANK_FUZZ
+    """
+    # Take the paper color from a sparse sample, scanned paper is rarely pure white
+    paper = np.percentile(grey[::4, ::4], 90)
+    return grey < paper - 255 * BLANK_FUZZ
+
+
+def content_size(pixels, dpi, white_fraction=0.97, border=1.0):
+    """
+        Find the size of the content on a page, ignoring a one inch border and
+        isolated specks.
+
+        - Shave off border inches around the edges and subsample to about BLANK_DPI
+        - Mark every pixel darker than the paper (by BLANK_FUZZ) as ink
+        - Split the page into BLANK_CELL_INCHES square cells; a cell is white if at
+          least white_fraction of its pixels are not ink
+        - Project the non-white cells onto the rows and columns to get the content box
+
+        Only the subsampled pixels are ever read, so this is cheap on a
+        mapped page.
+
+        :param pixels: array from :func:`pnm.map_pnm`
+        :param dpi: resolution of pixels
+        :param white_fraction: the --blank-threshold
+        :returns: (width, height) of the content box in inches
+    """
+    dpi = int(dpi)
+    shave = int(dpi * border)
+    page = pixels[shave:-shave, shave:-shave] if shave else pixels
+    step = max(1, dpi // BLANK_DPI)
+    grey = to_grey(page[::step, ::step])
+    if grey.size == 0:
+        return 0.0, 0.0
+
+    ink = find_ink(grey)
+
+    cell = max(1, int(round(float(dpi) / step * BLANK_CELL_INCHES)))
+    rows = ink.shape[0] // cell
+    cols = ink.shape[1] // cell
+    if rows == 0 or cols == 0:
+        return 0.0, 0.0
+    cells = ink[:rows * cell, :cols * cell].reshape(rows, cell, cols, cell)
+    ink_fraction = cells.mean(axis=(1, 3))
+    content = ink_fraction > (1.0 - white_fraction)
+
+    content_rows = np.flatnonzero(content.any(axis=1))
+    content_cols = np.flatnonzero(content.any(axis=0))
+    if content_rows.size == 0:
+        return 0.0, 0.0
+    inches_per_cell = float(cell * step) / dpi
+    width = (content_cols[-1] - content_cols[0] + 1) * inches_per_cell
+    height = (content_rows[-1] - content_rows[0] + 1) * inches_per_cell
+    return width, height
+
+
+def pyramid_is_blank(pyramid, white_fraction=0.97):
+    """
+        :func:`is_blank` on the level of a :class:`pyramid.Pyramid` closest to BLANK_DPI
+    """
+    pixels, dpi = pyramid.at(BLANK_DPI)
+    return is_blank(pixels, dpi, white_fraction)
+
+
+def is_blank(pixels, dpi, white_fraction=0.97):
+    """
+        Returns True if the content on the page (see :func:`content_size`) is
+        smaller than BLANK_MIN_INCHES in either direction.
+    """
+    width, height = content_size(pixels, dpi, white_fraction)
+    logging.debug('Content is %.2fx%.2f inches' % (width, height))
+    return width < BLANK_MIN_INCHES or height < BLANK_MIN_INCHES
+
+
+# What the blank check on the raw scan (see raw_blank_verdict) can tell
+BLANK, BORDERLINE, CONTENT = 'blank', 'borderline', 'content'
+# It's only sure when the content is this many times smaller or bigger than BLANK_MIN_INCHES ...
+RAW_BLANK_MARGIN = 2.0
+# ... looking this many inches from the edges for blank pages (closer than the check on the cropped
+# page does, in case cropping moves something in), and this far for pages with content (so that
+# cropping can't move it out)
+RAW_BLANK_BORDER = 0.5
+RAW_CONTENT_BORDER = 1.5
+
+
+def raw_blank_verdict(pixels, dpi, white_fraction=0.97):
+    """
+        A quick blank check on the page straight from the scanner, before
+        it's been cropped, so blank pages can be dropped before any of the
+        real work is done on them.  It only says BLANK or CONTENT when
+        :func:`is_blank` on the cropped page couldn't say otherwise, and
+        BORDERLINE when it has to be left to that.
+    """
+    width, height = content_size(pixels, dpi, white_fraction, border=RAW_BLANK_BORDER)
+    if min(width, height) < BLANK_MIN_INCHES / RAW_BLANK_MARGIN:
+        return BLANK
+    width, height = content_size(pixels, dpi, white_fraction, border=RAW_CONTENT_BORDER)
+    if min(width, height) >= BLANK_MIN_INCHES * RAW_BLANK_MARGIN:
+        return CONTENT
+    return BORDERLINE
+
+
+def pyramid_raw_blank_verdict(pyramid, white_fraction=0.97):
+    """
+        :func:`raw_blank_verdict` on the level of a :class:`pyramid.Pyramid` closest to BLANK_DPI
+    """
+    pixels, dpi = pyramid.at(BLANK_DPI)
+    return raw_blank_verdict(pixels, dpi, white_fraction)
+
+
+# Pages less skewed than this (in degrees) aren't worth resampling
+SKEW_TOLERANCE = 0.1
+# Largest skew looked for, in degrees, first in coarse steps and then fine ones around the best coarse one
+SKEW_MAX = 5.0
+SKEW_COARSE = 0.5
+SKEW_FINE = 0.05
+# Resolution the skew is estimated at
+SKEW_DPI = 75
+# Anything darker than this is ink, for the skew estimate
+SKEW_INK = 128
+
+
+def _profile_sharpness(ys, xs, angles):
+    """
+        For each angle, shear the ink pixels at (ys, xs) by it and project them
+        onto the rows.  The straighter the lines of text, the more the ink
+        piles up in a few rows, and the bigger the sum of squares.
+    """
+    scores = []
+    for angle in angles:
+        rows = np.rint(ys - xs * np.tan(np.radians(angle))).astype(np.intp)
+        rows -= rows.min()
+        counts = np.bincount(rows).astype(np.float64)
+        scores.append(np.dot(counts, counts))
+    return np.array(scores)
+
+
+def estimate_skew(pixels):
+    """
+        Estimate how far the lines on a page slope down to the right, from
+        projection profiles of the ink (a thumbnail is plenty for this).
+
+        :returns: the angle in degrees, 0 if there's too little ink to tell
+    """
+    ys, xs = np.nonzero(to_grey(pixels) < SKEW_INK)
+    if ys.size < 100:
+        return 0.0
+    ys = ys.astype(np.float64)
+    xs = xs.astype(np.float64) - pixels.shape[1] / 2.0
+    coarse = np.arange(-SKEW_MAX, SKEW_MAX + SKEW_COARSE / 2, SKEW_COARSE)
+    best = coarse[np.argmax(_profile_sharpness(ys, xs, coarse))]
+    fine = np.arange(best - SKEW_COARSE, best + SKEW_COARSE + SKEW_FINE / 2, SKEW_FINE)
+    # Rounded to the step, so that a straight page comes out as 0.1 and not 0.10000000000000009
+    angle = round(float(fine[np.argmax(_profile_sharpness(ys, xs, fine))]), 2)
+    logging.debug("Skew is %.2f degrees" % angle)
+    return angle
+
+
+def pyramid_skew(pyramid):
+    """
+        :func:`estimate_skew` on the level of a :class:`pyramid.Pyramid` closest to SKEW_DPI
+    """
+    pixels, dpi = pyramid.at(SKEW_DPI)
+    return estimate_skew(pixels)
+
+
+def content_box(pixels, shave, fuzz):
+    """
+        Find what ``-shave <shave> -fuzz <fuzz> -trim`` would leave of a
+        page: shave pixels off every edge, then trim off the rows and
+        columns on the outside that are all within fuzz (a fraction of
+        the full range, RMS over the channels) of the color of the
+        top-left corner.
+
+        The margins are searched from each edge in towards the content, so
+        only they get looked at, not the whole page.
+
+        :returns: (left, top, right, bottom), the right and bottom exclusive, or None if nothing is left
+    """
+    h, w = pixels.shape[:2]
+    if h <= 2 * shave or w <= 2 * shave:
+        return None
+    page = pixels[shave:h - shave, shave:w - shave]
+    border = page[0, 0].astype(np.int32)
+    limit = (1 if page.ndim < 3 else page.shape[2]) * (fuzz * 255) ** 2
+
+    def content(block, axis):
+        """ Which rows (axis 1) or columns (axis 0) of block have content in them """
+        diff = block.astype(np.int32) - border
+        distance = diff * diff
+        if distance.ndim == 3:
+            distance = distance.sum(axis=2)
+        return (distance > limit).any(axis=axis)
+
+    def first(length, has_content, reverse=False):
+        """ The first index (from the end if reverse) where has_content(start, stop) finds something """
+        for start in range(0, length, BAND_ROWS):
+            stop = min(start + BAND_ROWS, length)
+            if reverse:
+                start, stop = length - stop, length - start
+            found = np.flatnonzero(has_content(start, stop))
+            if found.size:
+                return start + (found[-1] if reverse else found[0])
+        return None
+
+    top = first(page.shape[0], lambda a, b: content(page[a:b], 1))
+    if top is None:
+        return None
+    bottom = first(page.shape[0], lambda a, b: content(page[a:b], 1), reverse=True) + 1
+    rows = page[top:bottom]
+    left = first(page.shape[1], lambda a, b: content(rows[:, a:b], 0))
+    right = first(page.shape[1], lambda a, b: content(rows[:, a:b], 0), reverse=True) + 1
+    return (shave + left, shave + top, shave + right, shave + bottom)
+
+
+# Resolution specks are counted at, fine enough that a speck of dust is still darker than the paper
+SPECK_DPI = 150
+# Most pixels of specks (ink that fits in 3x3 pixels at SPECK_DPI, with clear paper around it) a clean page can have
+SPECKS_MAX = 4
+# Width of the edges, in inches, that have to be clear of ink on a clean page
+EDGE_INCHES = 0.2
+
+
+def _box_sums(mask, radius):
+    """
+        :returns: for every pixel, how many of the pixels within radius of it (a square) are set in mask
+    """
+    size = 2 * radius + 1
+    padded = np.zeros((mask.shape[0] + size, mask.shape[1] + size), dtype=np.int32)
+    padded[radius + 1:radius + 1 + mask.shape[0], radius + 1:radius + 1 + mask.shape[1]] = mask
+    sums = padded.cumsum(axis=0).cumsum(axis=1)
+    return sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+
+
+def count_specks(pixels):
+    """
+        Count the pixels of ink that are part of a speck: a blob small enough
+        to fit in 3x3 pixels, with nothing else within two pixels of it.
+        This is what unpaper's noise filter would remove.
+    """
+    ink = find_ink(to_grey(pixels))
+    specks = ink & (_box_sums(ink, 2) == _box_sums(ink, 1))
+    return int(specks.sum())
+
+
+def has_dark_edges(pixels, dpi):
+    """
+        Returns True if there's any ink within EDGE_INCHES of the edges of
+        the page (scanner background, punch holes), for unpaper's black
+        filter to clean up.
+    """
+    edge = max(1, int(dpi * EDGE_INCHES))
+    ink = find_ink(to_grey(pixels))
+    return bool(ink[:edge].any() or ink[-edge:].any() or ink[:, :edge].any() or ink[:, -edge:].any())
+
+
+def pyramid_is_clean(pyramid):
+    """
+        Returns True if the page is straight (to within SKEW_TOLERANCE), has
+        at most SPECKS_MAX specks, and clear edges, so that there's nothing
+        for unpaper to do.
+    """
+    angle = pyramid_skew(pyramid)
+    if abs(angle) > SKEW_TOLERANCE:
+        return False
+    pixels, dpi = pyramid.at(SPECK_DPI)
+    specks = count_specks(pixels)
+    logging.debug("%d pixels of specks" % specks)
+    return specks <= SPECKS_MAX and not has_dark_edges(pixels, dpi)
@@ -0,0 +1,647 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    The image processing backends (``--backend``).
+
+    Everything ScanPdf does to a page image goes through an
+    :class:`ImageBackend`: getting its dimensions, cropping and
+    straightening it, checking whether it's in color or blank, turning it
+    into B&W and encoding it for the PDF.  There are three of them:
+
+    - :class:`ImageMagickBackend` runs the ImageMagick command line tools
+    - :class:`NumpyBackend` works in-process on the mapped in PNM (the default)
+    - :class:`VipsBackend` streams the page through libvips, if pyvips is installed
+
+    A backend that can't read a file (numpy only reads PNMs) leaves it to
+    ImageMagick, see :meth:`ScanPdf._backend_for`.
+"""
+
+import os
+import io
+import re
+import logging
+try:
+    from shutil import which as find_executable
+except ImportError:
+    # Python 2 (distutils is gone from Python 3.12 on)
+    from distutils.spawn import find_executable
+
+import numpy as np
+
+from pnm import map_pnm, read_pnm, read_size, write_pnm
+from page import crop, to_bw, bw_table, SHAVE_INCHES, TRIM_FUZZ, FILL
+from pyramid import Pyramid
+from pdfwriter import encode_grey, encode_jpeg
+import analysis
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # OSError is what pyvips raises when it's installed but libvips isn't
+    pyvips = None
+
+# Quality of the JPEGs color pages are encoded as
+JPEG_QUALITY = 85
+
+
+class ImageBackend(object):
+    """
+        What every backend has to do.  The filenames are full paths, and
+        the results go to out_filename as a PNM (so any backend can pick up
+        where another left off).
+
+        :param script: The :class:`scanpdf.ScanPdf` it works for, which has the dpi, --blank-threshold and so on
+    """
+
+    name = None
+    # Whether :meth:`raw_blank_verdict` is worth running on every page before it's cropped
+    quick_blank_check = False
+
+    def __init__(self, script):
+        self.script = script
+
+    @classmethod
+    def missing(cls):
+        """
+            :returns: What needs installing for this backend to work, or None if it's all there
+        """
+        return None
+
+    def reads(self, filename):
+        """
+            True if this backend can read filename itself
+        """
+        return True
+
+    def dimensions(self, filename):
+        """
+            :returns: (width, height) in pixels
+        """
+        raise NotImplementedError
+
+    def is_blank(self, filename):
+        """
+            Returns True if there's too little on the page to keep (see --blank-threshold)
+        """
+        raise NotImplementedError
+
+    def raw_blank_verdict(self, filename, pyramid=None):
+        """
+            A quick blank check of the page straight from the scanner (see
+            :func:`analysis.raw_blank_verdict`).  BORDERLINE leaves it to
+            :meth:`is_blank` once the page is cropped.
+
+            :param pyramid: The page's :class:`pyramid.Pyramid`, if it's been built already
+        """
+        return analysis.BORDERLINE
+
+    def is_color(self, filename):
+        """
+            Returns True if the page has a meaningful amount of color
+        """
+        raise NotImplementedError
+
+    def crop(self, filename, out_filename, pyramid=None):
+        """
+            Straighten the page, trim off the scanner background around it,
+            and center it on a white page of the original size
+
+            :param pyramid: The page's :class:`pyramid.Pyramid`, if it's been built already
+        """
+        raise NotImplementedError
+
+    def to_bw(self, filename, out_filename):
+        """
+            Convert the page to BW_LEVELS greys (see :func:`page.to_bw`)
+        """
+        raise NotImplementedError
+
+    def encode(self, filename, bw):
+        """
+            Encode the page for the PDF: 2-bit Flate for B&W pages, and JPEG for color ones
+
+            :returns: :class:`pdfwriter.PdfImage`
+        """
+        raise NotImplementedError
+
+
+class ImageMagickBackend(ImageBackend):
+    """
+        The ImageMagick command line tools, a convert or identify per page.
+        The dimensions, color and blank checks can also be run on a batch
+        of pages at once (see :meth:`all_dimensions` and so on), which
+        ScanPdf does up front to save forking a command for every page.
+    """
+
+    name = 'imagemagick'
+
+    @classmethod
+    def missing(cls):
+        if not find_executable('convert') or not find_executable('identify'):
+            return 'ImageMagick (convert and identify)'
+        return None
+
+    def parse_dimensions(self, result):
+        first_line = str(result.splitlines()[0].strip())
+        logging.debug(first_line)
+        mCropDim = re.compile("""\s*(?P<filename>[\d\w\[_\/\\\.]+)\s+\w+\s+(?P<X>\d+)x(?P<Y>\d+)\s+""")
+        # blank3.pnm PPM 1x1 1950x2716-1-1 8-bit sRGB 0.010u 0:00.009
+        matchCropDim = mCropDim.search(first_line)
+        if matchCropDim:
+            x = int(matchCropDim.group('X'))
+            y = int(matchCropDim.group('Y'))
+        else:
+            x = -1
+            y = -1
+        return x, y
+
+    def dimensions(self, filename):
+        result = self.script.cmd(['identify', filename])
+        return self.parse_dimensions(result)
+
+    def _batches(self, items):
+        batch_size = self.script.batch_size
+        for i in range(0, len(items), batch_size):
+            yield items[i:i + batch_size]
+
+    def _sizes(self, batch, out):
+        """
+            :returns: dict of each file in batch to the size printed for it in out
+        """
+        sizes = [line.split()[1:3] for line in out.splitlines() if line.startswith(b'size ')]
+        if len(sizes) != len(batch):
+            # Can't tell which is which, so leave them to be done one at a time
+            logging.debug("Expected %d sizes, got %d" % (len(batch), len(sizes)))
+            return {}
+        return dict((filename, (int(x), int(y))) for filename, (x, y) in zip(batch, sizes))
+
+    def all_dimensions(self, filenames):
+        """
+            The dimensions of all of filenames, with a single identify per --batch-size files
+
+            :returns: dict of filename to (width, height), for the ones it could tell
+        """
+        sizes = {}
+        for batch in self._batches(filenames):
+            out = self.script.cmd(['identify', '-format', 'size %w %h\n'] + ['%s[0]' % f for f in batch])
+            sizes.update(self._sizes(batch, out))
+        return sizes
+
+    def _convert_each(self, filenames, ops, writes):
+        """
+            Run a single ``convert`` per --batch-size of filenames that
+            applies ops to each file and then writes each (format, output)
+            in writes.  Every file gets its own parenthesized group and is
+            dropped at the end of it, so only one page is in memory at a time.
+
+            :returns: list of (batch, output) for each convert
+        """
+        results = []
+        for batch in self._batches(filenames):
+            c = ['convert']
+            for filename in batch:
+                c.extend(['(', '%s[0]' % filename] + ops)
+                for format, output in writes:
+                    c.extend(['-format', format, '-write', output])
+                c.extend(['+delete', ')'])
+            # convert insists on having something to write at the end
+            c.extend(['xc:', 'null:'])
+            results.append((batch, self.script.cmd(c)))
+        return results
+
+    def is_blank(self, filename):
+        """
+            Returns true if image in filename is blank
+
+            - Shave off one inch around edges
+            - Blur and crop down as much as possible
+            - If remaining page has a dimension smaller than 0.3" conclude it's blank
+        """
+        #c = 'convert %s -shave %sx%s -virtual-pixel White -blur 0x15 -fuzz 15%% -trim info:' % (filename, self.dpi, self.dpi)
+        c = ['convert', filename] + self._blank_ops() + ['info:']
+        result = self.script.cmd(c)
+        x, y = self.parse_dimensions(result)
+        return self._is_blank_size(x, y)
+
+    def _blank_ops(self):
+        dpi = self.script.dpi
+        return ['-shave', '%sx%s' % (dpi, dpi),
+                '-density', str(int(dpi/2)),
+                '-adaptive-resize', '65%',
+                '-virtual-pixel', 'White',
+                '-blur', '0x15',
+                '-fuzz', '15%',
+                '-trim',
+               ]
+
+    def _is_blank_size(self, x, y):
+        """
+            Returns true if the size ImageMagick trimmed a page down to in
+            :meth:`is_blank` means it's blank
+        """
+        if x>0 and y>0:
+            logging.debug('Finding threshold for blanks')
+            threshold = int(self.script.dpi)/2*0.3  # Threshold is 0.3 inches
+            logging.debug('x=%s, y=%s, threshold=%s' % (x, y, threshold))
+            if x < threshold or y < threshold:
+                return True
+            else:
+                return False
+        else:
+            logging.debug('Could not find dimensions in output of imagemagick for cropping')
+            return False
+
+    def all_blanks(self, filenames):
+        """
+            :meth:`is_blank` of all of filenames, in a single convert per --batch-size files
+
+            :returns: dict of filename to whether it's blank, for the ones it could tell
+        """
+        blanks = {}
+        for batch, out in self._convert_each(filenames, self._blank_ops(), [('size %w %h\n', 'info:-')]):
+            for filename, (x, y) in self._sizes(batch, out).items():
+                blanks[filename] = self._is_blank_size(x, y)
+        return blanks
+
+    def is_color(self, filename):
+        """
+            Run the following command from ImageMagick:
+
+            ::
+
+                 convert holi.pdf -colors 8 -depth 8 -format %c histogram:info:-
+
+            This outputs something like the following:
+            ::
+
+                  10831: ( 24, 26, 26,255) #181A1A srgba(24,26,26,1)
+                  4836: ( 55, 87, 79,255) #37574F srgba(55,87,79,1)
+                  6564: ( 77,138,121,255) #4D8A79 srgba(77,138,121,1)
+                  4997: ( 86, 96, 93,255) #56605D srgba(86,96,93,1)
+                  7005: ( 92,153,139,255) #5C998B srgba(92,153,139,1)
+                  2479: (143,118,123,255) #8F767B srgba(143,118,123,1)
+                  8870: (169,176,170,255) #A9B0AA srgba(169,176,170,1)
+                442906: (254,254,254,255) #FEFEFE srgba(254,254,254,1)
+                  1053: (  0,  0,  0,255) #000000 black
+                484081: (255,255,255,255) #FFFFFF white
+
+        """
+        cmd = ['convert', filename] + self._color_ops() + ['-format', '%c', 'histogram:info:-']
+        out = self.script.cmd(cmd)
+        return self._histogram_is_color(out)
+
+    def _color_ops(self):
+        return ['-density', str(int(self.script.dpi/3)),
+                '-adaptive-resize', '35%',
+                '-colors', '8',
+                '-depth', '8',
+               ]
+
+    def all_colors(self, filenames):
+        """
+            :meth:`is_color` of all of filenames, in a single convert per --batch-size files
+
+            :returns: dict of filename to whether it's in color, for the ones it could tell
+        """
+        colors = {}
+        # Each histogram is preceded by a line of its own, to tell them apart
+        writes = [('page\n', 'info:-'), ('%c', 'histogram:info:-')]
+        for batch, out in self._convert_each(filenames, self._color_ops(), writes):
+            histograms = []
+            for line in out.splitlines():
+                if line.strip() == b'page':
+                    histograms.append([])
+                elif histograms:
+                    histograms[-1].append(line)
+            if len(histograms) != len(batch):
+                logging.debug("Expected %d histograms, got %d" % (len(batch), len(histograms)))
+                continue
+            for filename, lines in zip(batch, histograms):
+                colors[filename] = self._histogram_is_color(b'\n'.join(lines))
+        return colors
+
+    def _histogram_is_color(self, out):
+        """
+            Returns True if the histogram ImageMagick printed in
+            :meth:`is_color` has any color in it
+        """
+        mLine = re.compile(r"""\s*(?P<count>\d+):\s*\(\s*(?P<R>\d+),\s*(?P<G>\d+),\s*(?P<B>\d+).+""")
+        colors = []
+        for line in out.splitlines():
+            matchLine = mLine.search(str(line))
+            if matchLine:
+                logging.debug("Found RGB values")
+                color = [int(x) for x in (matchLine.group('count'),
+                             matchLine.group('R'),
+                             matchLine.group('G'),
+                             matchLine.group('B'),
+                             )
+                        ]
+                colors.append(color)
+        # sort
+        colors.sort(reverse=True, key = lambda x: x[0])
+        logging.debug(colors)
+        is_color = False
+        logging.debug(colors)
+        for color in colors:
+            # Calculate the mean differences between the RGB components
+            # Shades of grey will be very close to zero in this metric...
+            diff = float(sum([abs(color[2]-color[1]),
+                         abs(color[3]-color[1]),
+                         abs(color[3]-color[2]),
+                         ]))/3
+            if diff > 30:
+                is_color = True
+                logging.debug("Found color, diff is %s" % diff)
+            else:
+                logging.debug("No color, diff is %s" % diff)
+        return is_color
+
+    def _crop_ops(self, x, y):
+        """
+            :param x, y: The page's original dimensions, to pad it back out to (-1 if they aren't known)
+        """
+        shave_amt = int(int(self.script.dpi)*SHAVE_INCHES)
+        ops = ['-deskew', '80%',
+               '-shave', '%dx%d' % (shave_amt, shave_amt),
+               '-fuzz', '%d%%' % (TRIM_FUZZ * 100),
+               '-trim',
+               '+repage',
+              ]
+        if x>0 and y>0:
+            # IF we know the original dimensions, then just pad back to that with white background
+            ops.extend(['-gravity', 'center',
+                        '-background', 'white',
+                        '-extent', '%sx%s' % (x, y),
+                       ])
+        return ops
+
+    def crop(self, filename, out_filename, pyramid=None):
+        # Get original dimensions (through the script, which may have them already)
+        x, y = self.script.get_dimensions(filename)
+        self.script.cmd(['convert', filename] + self._crop_ops(x, y) + [out_filename])
+
+    def crop_and_check(self, pages, check_blank=True):
+        """
+            :meth:`crop` each of pages, and do :meth:`is_blank` (if
+            check_blank) and :meth:`is_color` on the cropped page, all in a
+            single convert.  Each page gets its own parenthesized group, so
+            only one is in memory at a time.
+
+            :param pages: list of (filename, out_filename, (width, height) of filename)
+            :returns: dict of out_filename to (whether it's blank or None, whether it's in color), for the ones it could tell
+        """
+        c = ['convert']
+        for filename, out_filename, (x, y) in pages:
+            c.extend(['(', '%s[0]' % filename] + self._crop_ops(x, y) + ['-write', out_filename])
+            # Marks where each page's output starts
+            c.extend(['-format', 'page\n', '-write', 'info:-'])
+            if check_blank:
+                c.extend(['(', '+clone'] + self._blank_ops() + ['-format', 'size %w %h\n', '-write', 'info:-', '+delete', ')'])
+            c.extend(self._color_ops() + ['-format', '%c', '-write', 'histogram:info:-', '+delete', ')'])
+        # convert insists on having something to write at the end
+        c.extend(['xc:', 'null:'])
+        out = self.script.cmd(c)
+
+        outputs = []
+        for line in out.splitlines():
+            if line.strip() == b'page':
+                outputs.append({'size': None, 'histogram': []})
+            elif outputs and line.startswith(b'size '):
+                outputs[-1]['size'] = [int(n) for n in line.split()[1:3]]
+            elif outputs:
+                outputs[-1]['histogram'].append(line)
+        if len(outputs) != len(pages):
+            logging.debug("Expected the checks of %d pages, got %d" % (len(pages), len(outputs)))
+            return {}
+        checks = {}
+        for (filename, out_filename, size), output in zip(pages, outputs):
+            if check_blank and output['size'] is None:
+                continue
+            blank = self._is_blank_size(*output['size']) if check_blank else None
+            checks[out_filename] = (blank, self._histogram_is_color(b'\n'.join(output['histogram'])))
+        return checks
+
+    def to_bw(self, filename, out_filename):
+        cmd = ['convert', filename,
+                '+dither',
+                '-density', str(self.script.dpi),
+                '-colors', '16',
+                '-colors', '4',
+                '-colorspace', 'gray',
+                '-normalize',
+                out_filename,
+            ]
+        self.script.cmd(cmd)
+
+    def encode(self, filename, bw):
+        if bw:
+            return encode_grey(self.read_grey(filename), bits=2)
+        jpeg_filename = '%s.jpg' % filename
+        c = ['convert',
+                filename,
+                '-sampling-factor', '4:2:0',
+                '-strip',
+                '-quality', str(JPEG_QUALITY),
+                '-interlace', 'JPEG',
+                jpeg_filename,
+            ]
+        self.script.cmd(c)
+        with open(jpeg_filename, 'rb') as f:
+            data = f.read()
+        os.remove(jpeg_filename)
+        return encode_jpeg(data)
+
+    def read_grey(self, filename):
+        """
+            The grey pixels of filename, for :func:`pdfwriter.encode_grey`
+        """
+        try:
+            return analysis.to_grey(map_pnm(filename))
+        except ValueError:
+            # Not a PNM, so get ImageMagick to turn it into one
+            grey_filename = '%s.pgm' % filename
+            self.script.cmd(['convert', filename, '-colorspace', 'gray', '-depth', '8', 'pgm:%s' % grey_filename])
+            pixels = read_pnm(grey_filename)
+            os.remove(grey_filename)
+            return pixels
+
+
+class NumpyBackend(ImageBackend):
+    """
+        In-process, on the page mapped in with :func:`pnm.map_pnm` and its
+        :class:`pyramid.Pyramid` (see :mod:`analysis` and :mod:`page`).  It
+        only reads PNMs, which is what scanadf writes.  Color pages are
+        encoded by Pillow if it's installed, and by convert if it isn't.
+    """
+
+    name = 'numpy'
+    quick_blank_check = True
+
+    @classmethod
+    def missing(cls):
+        if Image is None and ImageMagickBackend.missing():
+            # Nothing to encode the color pages with
+            return 'Pillow or ImageMagick'
+        return None
+
+    def reads(self, filename):
+        try:
+            read_size(filename)
+            return True
+        except ValueError:
+            return False
+
+    def dimensions(self, filename):
+        # No need to fork identify just to read a PNM header
+        return read_size(filename)
+
+    def is_blank(self, filename):
+        pyramid = Pyramid.for_page(filename, self.script.dpi)
+        return analysis.pyramid_is_blank(pyramid, self.script.blank_threshold)
+
+    def raw_blank_verdict(self, filename, pyramid=None):
+        if pyramid is None:
+            pyramid = Pyramid.build(filename, self.script.dpi)
+        return analysis.pyramid_raw_blank_verdict(pyramid, self.script.blank_threshold)
+
+    def is_color(self, filename):
+        return analysis.pyramid_is_color(Pyramid.for_page(filename, self.script.dpi))
+
+    def crop(self, filename, out_filename, pyramid=None):
+        if pyramid is None:
+            # The skew only needs a thumbnail, which doesn't need saving
+            pyramid = Pyramid.build(filename, self.script.dpi)
+        angle = analysis.pyramid_skew(pyramid)
+        write_pnm(out_filename, crop(pyramid.level(1), self.script.dpi, angle))
+
+    def to_bw(self, filename, out_filename):
+        write_pnm(out_filename, to_bw(map_pnm(filename)))
+
+    def encode(self, filename, bw):
+        if bw:
+            return encode_grey(analysis.to_grey(map_pnm(filename)), bits=2)
+        if Image is None:
+            return self.script.imagemagick.encode(filename, bw)
+        out = io.BytesIO()
+        # subsampling=2 is 4:2:0, like the convert
+        Image.fromarray(map_pnm(filename)).save(out, 'JPEG', quality=JPEG_QUALITY, subsampling=2, progressive=True)
+        return encode_jpeg(out.getvalue())
+
+
+class VipsBackend(ImageBackend):
+    """
+        libvips, through pyvips.  vips streams a page through in strips
+        instead of loading it whole, so it never has the full page in
+        memory (other than to encode a B&W one), and the checks work on a
+        thumbnail it shrinks the page to on the way in.  The checks
+        themselves are the ones in :mod:`analysis`.
+    """
+
+    name = 'vips'
+    quick_blank_check = True
+
+    @classmethod
+    def missing(cls):
+        if pyvips is None:
+            return 'pyvips and libvips'
+        return None
+
+    def _open(self, filename, access='sequential'):
+        image = pyvips.Image.new_from_file(filename, access=access)
+        if image.hasalpha():
+            image = image.flatten(background=[FILL] * (image.bands - 1))
+        return image
+
+    def _pixels(self, image):
+        """
+            :returns: image as a uint8 array, (height, width) or (height, width, bands)
+        """
+        pixels = np.frombuffer(image.write_to_memory(), dtype=np.uint8)
+        pixels = pixels.reshape(image.height, image.width, image.bands)
+        return pixels[..., 0] if image.bands == 1 else pixels
+
+    def _grey(self, image):
+        return image.colourspace('b-w') if image.bands > 1 else image
+
+    def _thumbnail(self, filename, dpi):
+        """
+            :returns: (pixels, resolution) of the page shrunk down to about dpi
+        """
+        image = self._open(filename)
+        scale = min(1.0, float(dpi) / self.script.dpi)
+        if scale < 1.0:
+            image = image.resize(scale)
+        return self._pixels(image), self.script.dpi * scale
+
+    def dimensions(self, filename):
+        # Only the header is read until the pixels are asked for
+        image = pyvips.Image.new_from_file(filename)
+        return image.width, image.height
+
+    def is_blank(self, filename):
+        pixels, dpi = self._thumbnail(filename, analysis.BLANK_DPI)
+        return analysis.is_blank(pixels, dpi, self.script.blank_threshold)
+
+    def raw_blank_verdict(self, filename, pyramid=None):
+        pixels, dpi = self._thumbnail(filename, analysis.BLANK_DPI)
+        return analysis.raw_blank_verdict(pixels, dpi, self.script.blank_threshold)
+
+    def is_color(self, filename):
+        pixels, dpi = self._thumbnail(filename, analysis.COLOR_DPI)
+        return analysis.is_color(pixels, factor=1)
+
+    def crop(self, filename, out_filename, pyramid=None):
+        thumbnail, dpi = self._thumbnail(filename, analysis.SKEW_DPI)
+        angle = analysis.estimate_skew(thumbnail)
+        # Rotating needs to get at the page out of order
+        image = self._open(filename, access='random')
+        width, height = image.width, image.height
+        fill = [FILL] * image.bands
+        if abs(angle) > analysis.SKEW_TOLERANCE:
+            image = image.rotate(-angle, background=fill)
+        shave = int(self.script.dpi * SHAVE_INCHES)
+        image = image.crop(shave, shave, image.width - 2 * shave, image.height - 2 * shave)
+        left, top, trim_width, trim_height = image.find_trim(threshold=TRIM_FUZZ * 255,
+                                                            background=image.getpoint(0, 0))
+        if trim_width and trim_height:
+            # Centered, cutting off the edges if it's too big (like page.crop)
+            image = image.crop(left, top, trim_width, trim_height)
+            image = image.gravity('centre', width, height, extend='background', background=fill)
+        else:
+            image = (pyvips.Image.black(width, height, bands=image.bands) + FILL).cast('uchar')
+        image.ppmsave(out_filename)
+
+    def to_bw(self, filename, out_filename):
+        # Two passes over the page, one for the histogram and one for the lookup
+        grey = self._grey(self._open(filename, access='random'))
+        histogram = np.frombuffer(grey.hist_find().write_to_memory(), dtype=np.uint32)
+        table = bw_table(histogram)
+        if table is not None:
+            grey = grey.maplut(pyvips.Image.new_from_memory(table.tobytes(), 256, 1, 1, 'uchar'))
+        grey.ppmsave(out_filename)
+
+    def encode(self, filename, bw):
+        image = self._open(filename)
+        if bw:
+            return encode_grey(self._pixels(self._grey(image)), bits=2)
+        return encode_jpeg(image.jpegsave_buffer(Q=JPEG_QUALITY, interlace=True, strip=True))
+
+
+BACKENDS = dict((backend.name, backend) for backend in (ImageMagickBackend, NumpyBackend, VipsBackend))
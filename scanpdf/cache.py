@@ -0,0 +1,153 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Content addressed cache of per-page results, so re-running a scan
+    directory with different output options doesn't redo the per-page work.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+# Bump this whenever a stage changes what it produces, so old entries stop matching.
+# 2: pages are deskewed and cropped in-process, unpaper is skipped on clean
+# pages, and color pages stay in color
+STAGE_VERSION = 2
+
+
+class PageCache(object):
+    """
+        A directory of cache entries, evicted least recently used first once
+        the directory grows past max_bytes.
+
+        Entries are keyed (see :meth:`key`) on a hash of the raw page bytes,
+        the stage, and the parameters that affect the result of the stage.
+        An entry is either a small dict (``<key>.json``) or a file
+        (``<key>.data``).
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def digest(self, filename):
+        """
+            :returns: hash of the contents of filename
+        """
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def key(self, digest, stage, params):
+        """
+            :param digest: from :meth:`digest` of the raw page
+            :param stage: name of the stage
+            :param params: dict of every option that changes the result of the stage
+        """
+        desc = json.dumps([STAGE_VERSION, digest, stage, params], sort_keys=True)
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, '%s.%s' % (key, ext))
+
+    def _hit(self, path):
+        try:
+            # Entries are evicted by mtime, so this marks it as recently used
+            os.utime(path, None)
+            return True
+        except OSError:
+            return False
+
+    def get_info(self, key):
+        path = self._path(key, 'json')
+        if not self._hit(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get_file(self, key, filename):
+        """
+            Copy the file for key to filename
+
+            :returns: True if it was in the cache
+        """
+        path = self._path(key, 'data')
+        if not self._hit(path):
+            return False
+        try:
+            shutil.copyfile(path, filename)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def put_info(self, key, info):
+        self._store(self._path(key, 'json'), lambda f: f.write(json.dumps(info).encode('utf-8')))
+
+    def put_file(self, key, filename):
+        def copy(f):
+            with open(filename, 'rb') as src:
+                shutil.copyfileobj(src, f)
+        self._store(self._path(key, 'data'), copy)
+
+    def _store(self, path, write):
+        # Write under a temp name and rename, so nobody ever sees a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+            Remove the least recently used entries until the cache fits in max_bytes
+        """
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('.tmp'):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                logging.debug("Evicting %s from the cache" % path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
@@ -0,0 +1,98 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import logging
+import threading
+
+
+class Journal(object):
+    """
+        Append-only record, kept in the tmp dir, of the stage each page has
+        finished and the file that stage produced.  If a run dies part way
+        through, the next run over the same tmp dir picks up from it.
+
+        The first line holds the options the batch is being run with; a run
+        with different options starts the journal over.  Every other line is
+        one record::
+
+            {"page": "./page_0001", "stage": "encoded", "artifact": "./page_0001.crop"}
+
+        Make sure the files behind an artifact are on disk (see :func:`sync_file`)
+        before recording it, so the journal never points at a half written file.
+    """
+
+    FILENAME = 'journal'
+
+    def __init__(self, tmp_dir, params):
+        self.filename = os.path.join(tmp_dir, self.FILENAME)
+        self.params = params
+        self.lock = threading.Lock()
+        self.pages = {}
+        if not self._load():
+            with open(self.filename, 'w') as f:
+                f.write(json.dumps({'params': params}, sort_keys=True) + '\n')
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename) as f:
+            lines = f.read().splitlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return False
+        if header.get('params') != self.params:
+            logging.info("Options changed since the last run, starting over")
+            return False
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line got cut off when we died
+                continue
+            self.pages[record['page']] = record
+        logging.info("Resuming, %d pages already done" % len(self.pages))
+        return True
+
+    def get(self, page):
+        """
+            :returns: The last record for page, or None
+        """
+        return self.pages.get(page)
+
+    def record(self, page, stage, artifact=None):
+        """
+            Record that page has finished stage, producing artifact
+        """
+        record = {'page': page, 'stage': stage, 'artifact': artifact}
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.pages[page] = record
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def sync_file(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,226 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+import numpy as np
+
+from pnm import map_pnm, to_pnm, write_pnm
+from pyramid import Pyramid
+import analysis
+
+# Grey levels of the 2-bit B&W pages (what -depth 2 maps to)
+BW_LEVELS = 4
+# Fraction of pixels clipped to black/white when normalizing (same as -normalize)
+NORMALIZE_BLACK = 0.02
+NORMALIZE_WHITE = 0.01
+# Rows converted to grey at a time, so a color page never gets a full size 16 bit copy
+BAND_ROWS = 256
+
+
+def to_bw(pixels):
+    """
+        In-process version of ``convert +dither -colors 16 -colors 4 -colorspace gray -normalize``:
+        convert to grey, stretch the contrast and reduce to BW_LEVELS evenly spaced greys.
+
+        :returns: uint8 array of shape (height, width)
+    """
+    if pixels.ndim == 3:
+        grey = np.empty(pixels.shape[:2], dtype=np.uint8)
+        for top in range(0, pixels.shape[0], BAND_ROWS):
+            # Rec. 601 luma in integer math
+            rgb = pixels[top:top + BAND_ROWS].astype(np.uint16)
+            grey[top:top + BAND_ROWS] = (rgb[..., 0] * 77 + rgb[..., 1] * 150 + rgb[..., 2] * 29) >> 8
+    else:
+        grey = pixels
+
+    table = bw_table(np.bincount(grey.ravel(), minlength=256))
+    if table is None:
+        return grey
+    if pixels.ndim < 3:
+        # grey is the caller's (maybe mapped) pixels, so don't write to it
+        return table[grey]
+    for top in range(0, grey.shape[0], BAND_ROWS):
+        grey[top:top + BAND_ROWS] = table[grey[top:top + BAND_ROWS]]
+    return grey
+
+
+def bw_table(histogram):
+    """
+        The lookup table that does the normalize and quantize of :func:`to_bw`
+        in one go, so each pixel is only touched once
+
+        :param histogram: Pixel count of each of the 256 grey levels
+        :returns: uint8 array of 256 entries, or None if the page is all one grey
+    """
+    cumulative = np.cumsum(histogram)
+    black = int(np.searchsorted(cumulative, NORMALIZE_BLACK * cumulative[-1]))
+    white = int(np.searchsorted(cumulative, (1.0 - NORMALIZE_WHITE) * cumulative[-1]))
+    if white <= black:
+        return None
+    values = np.arange(256, dtype=np.float32)
+    stretched = np.clip((values - black) / (white - black), 0.0, 1.0)
+    step = 255 // (BW_LEVELS - 1)
+    return (np.rint(stretched * (BW_LEVELS - 1)) * step).astype(np.uint8)
+
+
+# Shaved off every edge before trimming, in inches (the -shave)
+SHAVE_INCHES = 0.1
+# How different from the border color a pixel has to be to count as content (the -fuzz 20%)
+TRIM_FUZZ = 0.2
+# Paper color for the corners that rotating exposes, and around the cropped page
+FILL = 255
+
+
+def _shear(pixels, slope):
+    """
+        Shift every row of pixels sideways by slope times its distance from
+        the middle row, interpolating linearly between neighbouring pixels.
+        Rows that move by the same whole number of pixels are done together.
+
+        :returns: uint8 array, wide enough to hold all the shifted rows (the rest is FILL)
+    """
+    h, w = pixels.shape[:2]
+    spread = abs(slope) * (h - 1)
+    out = np.full((h, w + 1 + int(np.ceil(spread))) + pixels.shape[2:], FILL, dtype=np.uint8)
+    offsets = slope * (np.arange(h) - (h - 1) / 2.0) + spread / 2.0
+    whole = np.floor(offsets).astype(np.intp)
+    # Interpolate in 8 bit fixed point, so it all fits in uint16
+    weight = np.rint((offsets - whole) * 256).astype(np.uint16)
+    weight = weight.reshape((h,) + (1,) * (pixels.ndim - 1))
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(whole)) + 1, [h]])
+    for first, last in zip(starts[:-1], starts[1:]):
+        for top in range(first, last, BAND_ROWS):
+            bottom = min(top + BAND_ROWS, last)
+            rows = pixels[top:bottom].astype(np.uint16)
+            right = weight[top:bottom]
+            left = 256 - right
+            shifted = np.empty((bottom - top, w + 1) + pixels.shape[2:], dtype=np.uint16)
+            shifted[:, :w] = rows * left
+            shifted[:, w] = FILL * left[:, 0]
+            shifted[:, 1:] += rows * right
+            shifted[:, 0] += FILL * right[:, 0]
+            shifted += 128
+            shifted >>= 8
+            k = whole[top]
+            out[top:bottom, k:k + w + 1] = shifted
+    return out
+
+
+def rotate(pixels, degrees):
+    """
+        Rotate pixels clockwise by degrees onto a canvas big enough to hold
+        all of it (the new corners are FILL), as three shears (Paeth's
+        method), which only ever move whole rows or columns.
+
+        :returns: uint8 array
+    """
+    theta = np.radians(degrees)
+    pixels = _shear(pixels, -np.tan(theta / 2))
+    # Shear the columns as rows of the transpose, which is a lot quicker on a contiguous copy
+    pixels = _shear(np.ascontiguousarray(pixels.swapaxes(0, 1)), np.sin(theta))
+    pixels = np.ascontiguousarray(pixels.swapaxes(0, 1))
+    return _shear(pixels, -np.tan(theta / 2))
+
+
+def crop(pixels, dpi, angle=0.0):
+    """
+        In-process version of ``convert -deskew 80% -shave -fuzz 20% -trim
+        +repage -gravity center -extent``: straighten the page by angle (see
+        :func:`analysis.estimate_skew`), find what's left of it after the
+        shave and trim (see :func:`analysis.content_box`), and center that
+        on a page the size of the original.
+
+        The page is only resampled if it's skewed by more than SKEW_TOLERANCE.
+
+        :returns: uint8 array, the same shape as pixels
+    """
+    h, w = pixels.shape[:2]
+    if abs(angle) > analysis.SKEW_TOLERANCE:
+        pixels = rotate(pixels, -angle)
+    box = analysis.content_box(pixels, int(dpi * SHAVE_INCHES), TRIM_FUZZ)
+    out = np.full((h, w) + pixels.shape[2:], FILL, dtype=np.uint8)
+    if box is None:
+        return out
+    left, top, right, bottom = box
+    # Centered, cutting off the edges of the content if it's too big (what -extent does)
+    dx = (w - (right - left)) // 2
+    dy = (h - (bottom - top)) // 2
+    src_left, src_top = left + max(0, -dx), top + max(0, -dy)
+    width = min(right - src_left, w - max(0, dx))
+    height = min(bottom - src_top, h - max(0, dy))
+    out[max(0, dy):max(0, dy) + height, max(0, dx):max(0, dx) + width] = \
+        pixels[src_top:src_top + height, src_left:src_left + width]
+    return out
+
+
+class Page(object):
+    """
+        A page that is mapped in once (see :func:`pnm.map_pnm`) and shared
+        by crop, classification and blank detection.  Only the final result
+        gets written back out.
+    """
+
+    def __init__(self, filename, dpi):
+        self.filename = filename
+        self.dpi = int(dpi)
+        self._pixels = None
+        self._pyramid = None
+        self.is_bw = False
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            logging.debug("Mapping %s" % self.filename)
+            self._pixels = map_pnm(self.filename)
+        return self._pixels
+
+    @property
+    def size(self):
+        """ (width, height) in pixels """
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    @property
+    def pyramid(self):
+        """
+            The :class:`pyramid.Pyramid` of the page as it is on disk, which
+            all the checks work from
+        """
+        if self._pyramid is None:
+            # Once it's B&W the pixels in memory aren't what's in the file any more
+            pixels = None if self.is_bw else self._pixels
+            self._pyramid = Pyramid.for_page(self.filename, self.dpi, pixels)
+        return self._pyramid
+
+    def is_color(self):
+        return analysis.pyramid_is_color(self.pyramid)
+
+    def is_blank(self, white_fraction):
+        return analysis.pyramid_is_blank(self.pyramid, white_fraction)
+
+    def convert_to_bw(self):
+        self._pixels = to_bw(self.pixels)
+        self.is_bw = True
+
+    def to_pnm(self):
+        return to_pnm(self.pixels)
+
+    def save(self, filename):
+        write_pnm(filename, self.pixels)
+        self.filename = filename
+
+    def release(self):
+        self._pixels = None
+        if self._pyramid is not None:
+            self._pyramid.release()
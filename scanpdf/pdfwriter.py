@@ -0,0 +1,263 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Writes a PDF of full-page images straight from already encoded image
+    streams (JPEG for color, Flate for grey/B&W), one page at a time, so
+    nothing needs to be re-interpreted or re-encoded by Ghostscript.
+"""
+
+import json
+import zlib
+
+import numpy as np
+
+
+class PdfImage(object):
+    """
+        An encoded image stream, ready to go into a PDF image XObject.
+
+        :ivar data: The encoded bytes
+        :ivar width: In pixels
+        :ivar height: In pixels
+        :ivar colorspace: DeviceRGB or DeviceGray
+        :ivar bits: Bits per component
+        :ivar filter: DCTDecode or FlateDecode
+    """
+
+    def __init__(self, data, width, height, colorspace, bits, filter):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.colorspace = colorspace
+        self.bits = bits
+        self.filter = filter
+
+    def _info(self):
+        return {'width': self.width,
+                'height': self.height,
+                'colorspace': self.colorspace,
+                'bits': self.bits,
+                'filter': self.filter,
+                }
+
+    def save(self, filename):
+        """
+            Write the image to filename as one line of JSON with its
+            parameters, followed by the encoded stream.
+        """
+        with open(filename, 'wb') as f:
+            f.write(json.dumps(self._info(), sort_keys=True).encode('ascii') + b'\n')
+            f.write(self.data)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            info = json.loads(f.readline().decode('ascii'))
+            data = f.read()
+        return cls(data, info['width'], info['height'], str(info['colorspace']), info['bits'], str(info['filter']))
+
+
+JPEG_COLORSPACES = {1: 'DeviceGray', 3: 'DeviceRGB', 4: 'DeviceCMYK'}
+
+
+def jpeg_info(data):
+    """
+        Find the frame header in JPEG data
+
+        :returns: (width, height, components)
+    """
+    data = bytearray(data)
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            raise ValueError("Bad JPEG marker at %d" % i)
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        length = (data[i + 2] << 8) | data[i + 3]
+        # Any SOFn except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height, data[i + 9]
+        i += 2 + length
+    raise ValueError("No frame header found in JPEG")
+
+
+def encode_jpeg(data):
+    """
+        Wrap already encoded (baseline or progressive) JPEG data
+    """
+    width, height, components = jpeg_info(data)
+    return PdfImage(data, width, height, JPEG_COLORSPACES[components], 8, 'DCTDecode')
+
+
+def encode_grey(pixels, bits=2, level=9):
+    """
+        Pack a greyscale uint8 array down to bits per pixel (rounding to the
+        nearest level) and Flate compress it.
+    """
+    height, width = pixels.shape
+    levels = (1 << bits) - 1
+    if bits == 8:
+        packed = np.ascontiguousarray(pixels, dtype=np.uint8)
+    else:
+        values = np.rint(pixels * (levels / 255.0)).astype(np.uint8)
+        per_byte = 8 // bits
+        # Each row starts on a byte boundary, so pad the rows out to a whole byte
+        padded_width = -(-width // per_byte) * per_byte
+        if padded_width != width:
+            values = np.pad(values, ((0, 0), (0, padded_width - width)), 'constant')
+        values = values.reshape(height, padded_width // per_byte, per_byte)
+        packed = np.zeros(values.shape[:2], dtype=np.uint8)
+        for i in range(per_byte):
+            packed |= values[:, :, i] << (8 - bits * (i + 1))
+    return PdfImage(zlib.compress(packed.tobytes(), level), width, height, 'DeviceGray', bits, 'FlateDecode')
+
+
+class PdfWriter(object):
+    """
+        Streams image pages into a PDF file.  Each page is written out as soon
+        as it's added, and only the object offsets are kept around, so memory
+        use doesn't grow with the page count.  The pages can be added in any
+        order, and put in the right one when closing.
+
+        ::
+
+            writer = PdfWriter('out.pdf')
+            writer.add_page(image, dpi=300)
+            writer.close()
+
+        The file can also be made readable before it's finished, with
+        :meth:`update`: that appends a page tree of the pages so far, and
+        an incremental update xref section pointing at it (the way a PDF
+        editor saves its changes).  Only what changed since the last update
+        is written again.
+    """
+
+    CATALOG = 1
+    PAGES = 2
+
+    def __init__(self, filename):
+        self.f = open(filename, 'wb')
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3
+        self.unsaved = []  # Objects written since the last xref section
+        self.kids = None  # The pages in the page tree written last
+        self.xref_offset = None
+        self.f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _new_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id, body, stream=None):
+        self.offsets[obj_id] = self.f.tell()
+        self.unsaved.append(obj_id)
+        self.f.write(('%d 0 obj\n' % obj_id).encode('ascii'))
+        self.f.write(body.encode('ascii'))
+        if stream is not None:
+            self.f.write(b'\nstream\n')
+            self.f.write(stream)
+            self.f.write(b'\nendstream')
+        self.f.write(b'\nendobj\n')
+
+    def add_page(self, image, dpi, rotate=0):
+        """
+            Add a page holding just image, sized so the image is at dpi
+
+            :param image: a :class:`PdfImage`
+            :param rotate: page rotation in degrees (multiple of 90)
+            :returns: The id of the page object, see :meth:`close`
+        """
+        image_id = self._new_id()
+        self._write_object(image_id,
+            '<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /%s '
+            '/BitsPerComponent %d /Filter /%s /Length %d >>'
+            % (image.width, image.height, image.colorspace, image.bits, image.filter, len(image.data)),
+            image.data)
+
+        width = image.width * 72.0 / dpi
+        height = image.height * 72.0 / dpi
+        content = ('q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q' % (width, height)).encode('ascii')
+        content_id = self._new_id()
+        self._write_object(content_id, '<< /Length %d >>' % len(content), content)
+
+        page_id = self._new_id()
+        self._write_object(page_id,
+            '<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.4f %.4f] /Rotate %d '
+            '/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+            % (self.PAGES, width, height, rotate, image_id, content_id))
+        self.page_ids.append(page_id)
+        return page_id
+
+    def update(self, page_ids=None):
+        """
+            Make what's been written so far a complete PDF of page_ids (in
+            that order), which more pages can still be added to.
+
+            :param page_ids: The pages (from :meth:`add_page`) in the order they
+                             should be in, if not the order they were added in
+        """
+        if page_ids is None:
+            page_ids = self.page_ids
+        page_ids = list(page_ids)
+        if page_ids != self.kids:
+            kids = ' '.join(['%d 0 R' % page_id for page_id in page_ids])
+            self._write_object(self.PAGES, '<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(page_ids)))
+            self.kids = page_ids
+        if self.CATALOG not in self.offsets:
+            # It only points at the page tree, which is always the same object
+            self._write_object(self.CATALOG, '<< /Type /Catalog /Pages %d 0 R >>' % self.PAGES)
+        if not self.unsaved:
+            # The last xref section still covers everything
+            return
+
+        xref_offset = self.f.tell()
+        self.f.write(b'xref\n')
+        # Every section starts with the head of the free list, object 0, which
+        # some readers take as a sign the section is numbered from 0 at all
+        obj_ids = [0] + sorted(set(self.unsaved))
+        # One subsection per run of consecutive objects
+        start = 0
+        for i in range(1, len(obj_ids) + 1):
+            if i < len(obj_ids) and obj_ids[i] == obj_ids[i - 1] + 1:
+                continue
+            self.f.write(('%d %d\n' % (obj_ids[start], i - start)).encode('ascii'))
+            for obj_id in obj_ids[start:i]:
+                if obj_id == 0:
+                    self.f.write(b'0000000000 65535 f \n')
+                else:
+                    self.f.write(('%010d 00000 n \n' % self.offsets[obj_id]).encode('ascii'))
+            start = i
+        previous = '' if self.xref_offset is None else ' /Prev %d' % self.xref_offset
+        self.f.write(('trailer\n<< /Size %d /Root %d 0 R%s >>\nstartxref\n%d\n%%%%EOF\n'
+                      % (self.next_id, self.CATALOG, previous, xref_offset)).encode('ascii'))
+        self.f.flush()
+        self.unsaved = []
+        self.xref_offset = xref_offset
+
+    def close(self, page_ids=None):
+        """
+            Finish the file
+
+            :param page_ids: The pages (from :meth:`add_page`) in the order they
+                             should be in, if not the order they were added in
+        """
+        self.update(page_ids)
+        self.f.close()
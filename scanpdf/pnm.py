@@ -0,0 +1,215 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Minimal reader and writer for the binary PNM files that scanadf (and
+    ImageMagick, when it keeps the input format) writes.
+
+    :func:`map_pnm` maps the pixels straight out of the file instead of
+    reading them in, so even a full length page at 600 dpi only takes up
+    memory for the parts that actually get looked at.
+"""
+
+import os
+
+import numpy as np
+
+
+class PnmError(ValueError):
+    pass
+
+
+def read_header(f):
+    """
+        Parse a binary PNM header from the open file f.
+
+        :returns: (magic, width, height, maxval, offset of the pixel data);
+                  maxval is 1 for PBM
+    """
+    magic = f.read(2)
+    if magic not in (b'P4', b'P5', b'P6'):
+        raise PnmError("Not a binary PBM/PGM/PPM file")
+    count = 2 if magic == b'P4' else 3
+    fields = []
+    token = b''
+    while len(fields) < count:
+        c = f.read(1)
+        if not c:
+            raise PnmError("Truncated PNM header")
+        if c == b'#':
+            # Comment, skip to end of line
+            while c not in (b'\n', b'\r', b''):
+                c = f.read(1)
+        elif c.isspace():
+            # Exactly one whitespace character after the last field, so the pixels start right after it
+            if token:
+                fields.append(int(token))
+                token = b''
+        else:
+            token += c
+    if magic == b'P4':
+        fields.append(1)
+    width, height, maxval = fields
+    return magic.decode('ascii'), width, height, maxval, f.tell()
+
+
+def _layout(magic, width, height, maxval):
+    """
+        :returns: (dtype, shape) of the raw pixel data
+    """
+    if magic == 'P4':
+        # Rows of packed bits, padded to a whole byte
+        return np.dtype(np.uint8), (height, (width + 7) // 8)
+    dtype = np.dtype(np.uint8) if maxval < 256 else np.dtype('>u2')
+    if magic == 'P6':
+        return dtype, (height, width, 3)
+    return dtype, (height, width)
+
+
+def _decode(raw, magic, width, maxval):
+    """
+        Turn raw pixel data into 8 bit grey/RGB pixels (this makes a copy)
+    """
+    if magic == 'P4':
+        # 1 is black in a PBM
+        bits = np.unpackbits(raw, axis=1)[:, :width]
+        return (1 - bits) * np.uint8(255)
+    return (raw.astype(np.uint32) * 255 // maxval).astype(np.uint8)
+
+
+def read_pnm(filename):
+    """
+        Read a binary PBM (P4), PGM (P5) or PPM (P6) file into memory.
+
+        :returns: uint8 array of shape (height, width) for PBM/PGM, or (height, width, 3) for PPM
+    """
+    with open(filename, 'rb') as f:
+        magic, width, height, maxval, offset = read_header(f)
+        dtype, shape = _layout(magic, width, height, maxval)
+        count = int(np.prod(shape))
+        pixels = np.fromfile(f, dtype=dtype, count=count)
+    if pixels.size != count:
+        raise PnmError("Truncated PNM data in %s" % filename)
+    pixels = pixels.reshape(shape)
+    if magic == 'P4' or maxval != 255:
+        pixels = _decode(pixels, magic, width, maxval)
+    return pixels
+
+
+def map_pnm(filename):
+    """
+        Like :func:`read_pnm`, but for the usual 8 bit PGM/PPM the array is
+        a read-only view of the file mapped into memory, so nothing gets
+        copied until it's used.  PBMs and other bit depths have to be
+        converted, so they are read in like :func:`read_pnm` does.
+
+        Don't overwrite the file in place while the array is still around;
+        :class:`PnmWriter` writes to a new file and renames it, which is safe.
+    """
+    with open(filename, 'rb') as f:
+        magic, width, height, maxval, offset = read_header(f)
+    dtype, shape = _layout(magic, width, height, maxval)
+    if magic == 'P4' or maxval != 255:
+        return read_pnm(filename)
+    if os.path.getsize(filename) < offset + int(np.prod(shape)) * dtype.itemsize:
+        raise PnmError("Truncated PNM data in %s" % filename)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def pnm_header(pixels):
+    magic = 'P6' if pixels.ndim == 3 else 'P5'
+    return ('%s\n%d %d\n255\n' % (magic, pixels.shape[1], pixels.shape[0])).encode('ascii')
+
+
+def to_pnm(pixels):
+    """
+        :returns: The bytes of a binary PGM/PPM file holding the uint8 array pixels
+    """
+    return pnm_header(pixels) + np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+
+
+class PnmWriter(object):
+    """
+        Write a binary PGM/PPM a band of rows at a time, so a stage can emit
+        a page without ever having all of it in memory.  The file is written
+        under a temporary name and only renamed to filename once all the rows
+        are in, so readers (and maps of the old file) never see a partial page.
+
+        ::
+
+            with PnmWriter(filename, width, height) as writer:
+                for band in bands:
+                    writer.write(band)
+    """
+
+    def __init__(self, filename, width, height, channels=1):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows = 0
+        self.tmp_filename = '%s.part' % filename
+        self.f = open(self.tmp_filename, 'wb')
+        magic = 'P6' if channels == 3 else 'P5'
+        self.f.write(('%s\n%d %d\n255\n' % (magic, width, height)).encode('ascii'))
+
+    def write(self, rows):
+        """
+            Append rows, a uint8 array of shape (n, width) or (n, width, 3)
+        """
+        shape = (self.width, self.channels) if self.channels == 3 else (self.width,)
+        if rows.shape[1:] != shape:
+            raise PnmError("Expected rows of shape %s, got %s" % (shape, rows.shape[1:]))
+        if self.rows + rows.shape[0] > self.height:
+            raise PnmError("Too many rows for %s" % self.filename)
+        np.ascontiguousarray(rows, dtype=np.uint8).tofile(self.f)
+        self.rows += rows.shape[0]
+
+    def close(self):
+        self.f.close()
+        if self.rows != self.height:
+            os.remove(self.tmp_filename)
+            raise PnmError("Only wrote %d of %d rows to %s" % (self.rows, self.height, self.filename))
+        os.rename(self.tmp_filename, self.filename)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_pnm(filename, pixels, band_rows=256):
+    """
+        Write the uint8 array pixels to filename with a :class:`PnmWriter`
+    """
+    channels = 3 if pixels.ndim == 3 else 1
+    with PnmWriter(filename, pixels.shape[1], pixels.shape[0], channels) as writer:
+        for top in range(0, pixels.shape[0], band_rows):
+            writer.write(pixels[top:top + band_rows])
+
+
+def read_size(filename):
+    """
+        :returns: (width, height) from the header, without reading any pixels
+    """
+    with open(filename, 'rb') as f:
+        magic, width, height, maxval, offset = read_header(f)
+    return width, height
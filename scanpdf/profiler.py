@@ -0,0 +1,161 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Profiling a run (``--profile``).
+
+    Our own Python code runs under cProfile, on the main thread and on every
+    worker thread, and all of it ends up in one pstats file.  The external
+    tools are accounted for from the stage and command events of the
+    :class:`trace.Tracer`: each command's CPU time and peak RSS (from
+    ``wait4``, see :class:`runner.Result`) is added to the stage and page
+    it ran for.  At the end :meth:`Profiler.report` ranks the stages and
+    pages, so it's easy to tell a slowdown in our code from one in convert.
+"""
+
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import functools
+
+from staging import page_of
+
+# How many stages, pages and functions the report lists
+TOP = 10
+# What cProfile calls the lock acquire that idle threads spend their time in
+# (thread.lock on Python 2, _thread.lock on 3)
+WAIT_FUNCTIONS = ("'acquire' of 'thread.lock' objects>", "'acquire' of '_thread.lock' objects>")
+
+
+class Profiler(object):
+    """
+        :param filename: Where to save the pstats of our own Python code
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+        self.profile = cProfile.Profile()
+        self.worker_profiles = []
+        self.stages = {}  # stage name to {'count', 'wall', 'cpu', 'max_rss_kb'}
+        self.pages = {}  # scanned page (see staging.page_of) to {'wall', 'cpu', 'max_rss_kb', 'commands'}
+        self.start_time = None
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def start(self):
+        self.start_time = time.time()
+        self.start_cpu = self._self_cpu()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.wall = time.time() - self.start_time
+        self.cpu = self._self_cpu() - self.start_cpu
+
+    def _self_cpu(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def wrap(self, func):
+        """
+            :returns: func, profiled when it's called on another thread than the main one
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if threading.current_thread() is self.thread:
+                # Already covered by the main profile (and a second one would switch it off)
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.worker_profiles.append(profile)
+        return wrapper
+
+    def record(self, event):
+        """
+            Account for a stage or command event from the :class:`trace.Tracer`
+        """
+        args = event['args']
+        with self.lock:
+            if event['cat'] == 'stage':
+                stage = self._stage(event['name'])
+                stage['count'] += 1
+                stage['wall'] += event['dur'] / 1e6
+                if event['name'] == 'page' and args.get('page'):
+                    self._page(page_of(args['page']))['wall'] += event['dur'] / 1e6
+                return
+            stage = self._stage(args.get('stage') or event['name'])
+            stage['cpu'] += args['cpu']
+            stage['max_rss_kb'] = max(stage['max_rss_kb'], args['max_rss_kb'])
+            if args.get('page') and page_of(args['page']):
+                page = self._page(page_of(args['page']))
+                page['cpu'] += args['cpu']
+                page['commands'] += 1
+                page['max_rss_kb'] = max(page['max_rss_kb'], args['max_rss_kb'])
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': 0})
+
+    def _page(self, name):
+        return self.pages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': 0, 'commands': 0})
+
+    def stats(self):
+        """
+            :returns: pstats.Stats of the main thread and all the workers together
+        """
+        stats = pstats.Stats(self.profile)
+        for profile in self.worker_profiles:
+            stats.add(profile)
+        return stats
+
+    def save(self):
+        self.stats().dump_stats(self.filename)
+
+    def report(self):
+        """
+            :returns: The summary, as text
+        """
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        ours = resource.getrusage(resource.RUSAGE_SELF)
+        child_cpu = sum(stage['cpu'] for stage in self.stages.values())
+        lines = ['Profile (Python stats saved to %s)' % self.filename,
+                 '  %.2fs elapsed, %.2fs CPU in scanpdf, %.2fs CPU in the tools it ran' % (self.wall, self.cpu, child_cpu),
+                 '  Peak memory: scanpdf %d MB, largest tool %d MB' % (ours.ru_maxrss // 1024, children.ru_maxrss // 1024),
+                 '',
+                 '  Stages by wall time (summed over pages, stages include the ones inside them):',
+                 '    %-12s %6s %10s %10s %10s' % ('stage', 'count', 'wall s', 'tools s', 'tools MB')]
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1]['wall'])[:TOP]:
+            lines.append('    %-12s %6d %10.2f %10.2f %10d' % (name, stage['count'], stage['wall'], stage['cpu'],
+                                                               stage['max_rss_kb'] // 1024))
+        if self.pages:
+            lines += ['',
+                      '  Slowest pages:',
+                      '    %-24s %10s %10s %10s %8s' % ('page', 'wall s', 'tools s', 'tools MB', 'commands')]
+            for name, page in sorted(self.pages.items(), key=lambda item: -item[1]['wall'])[:TOP]:
+                lines.append('    %-24s %10.2f %10.2f %10d %8d' % (name, page['wall'], page['cpu'],
+                                                                   page['max_rss_kb'] // 1024, page['commands']))
+        lines += ['', '  Python functions by time spent in them (not counting waiting on locks):']
+        stats = self.stats()
+        ranked = sorted([item for item in stats.stats.items() if not item[0][2].endswith(WAIT_FUNCTIONS)],
+                        key=lambda item: -item[1][2])[:TOP]
+        for (filename, line, function), (primitive, calls, tottime, cumtime, callers) in ranked:
+            lines.append('    %8.3fs %8d calls  %s (%s:%d)' % (tottime, calls, function, filename, line))
+        return '\n'.join(lines)
@@ -0,0 +1,148 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Thumbnail pyramids for page analysis.
+
+    A page is halved over and over once, right after it's scanned or
+    cropped, and every check then works on whichever level is closest to the
+    resolution it wants, instead of each one shrinking the full page on its
+    own.  Only the levels a check could want (see MAX_DPI) are kept.  The
+    pyramid is saved (compressed) next to the page as ``<page>.pyramid``,
+    and reused for as long as the page file itself doesn't change.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from pnm import map_pnm
+import analysis
+
+SUFFIX = '.pyramid'
+# Stop halving once a level would be smaller than this on either side
+MIN_SIDE = 32
+# The finest resolution any of the checks in analysis work at.  Levels
+# finer than that are only kept if one could still be the closest to it.
+MAX_DPI = max(analysis.COLOR_DPI, analysis.BLANK_DPI, analysis.SKEW_DPI, analysis.SPECK_DPI)
+
+
+def pyramid_filename(filename):
+    return '%s%s' % (filename, SUFFIX)
+
+
+def _source(filename):
+    """
+        What we remember about the page a pyramid was built from, to tell if it's still the same
+    """
+    st = os.stat(filename)
+    return np.array([st.st_size, st.st_mtime], dtype=np.float64)
+
+
+class Pyramid(object):
+    """
+        The levels of a page, keyed by how much they were shrunk (1 is the
+        page itself, then 2, 4, 8, ...)
+    """
+
+    def __init__(self, filename, dpi, levels, pixels=None):
+        self.filename = filename
+        self.dpi = int(dpi)
+        self.levels = levels
+        self._pixels = pixels
+
+    @classmethod
+    def build(cls, filename, dpi, pixels=None):
+        """
+            :param pixels: The page's pixels if they're already in memory, otherwise it's mapped from filename
+        """
+        if pixels is None:
+            pixels = map_pnm(filename)
+        levels = {}
+        level, factor = pixels, 1
+        while min(level.shape[:2]) >= 2 * MIN_SIDE:
+            level = analysis.halve(level)
+            factor *= 2
+            if float(dpi) / factor < MAX_DPI * np.sqrt(2):
+                levels[factor] = level
+        return cls(filename, dpi, levels, pixels)
+
+    @classmethod
+    def load(cls, filename, dpi):
+        """
+            :returns: The saved pyramid for filename, or None if there isn't an up to date one
+        """
+        try:
+            with open(pyramid_filename(filename), 'rb') as f:
+                saved = np.load(f)
+                if int(saved['dpi']) != int(dpi) or not np.array_equal(saved['source'], _source(filename)):
+                    return None
+                levels = dict((int(name.split('_')[1]), saved[name]) for name in saved.files
+                              if name.startswith('level_'))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.debug("No pyramid for %s (%s)" % (filename, e))
+            return None
+        return cls(filename, dpi, levels)
+
+    @classmethod
+    def for_page(cls, filename, dpi, pixels=None):
+        """
+            Load the saved pyramid for filename, or build and save one
+        """
+        pyramid = cls.load(filename, dpi)
+        if pyramid is None:
+            pyramid = cls.build(filename, dpi, pixels)
+            pyramid.save()
+        elif pixels is not None:
+            pyramid._pixels = pixels
+        return pyramid
+
+    def save(self):
+        filename = pyramid_filename(self.filename)
+        arrays = dict(('level_%d' % factor, level) for factor, level in self.levels.items())
+        arrays['dpi'] = np.array(self.dpi)
+        arrays['source'] = _source(self.filename)
+        # Write it under another name first, so a half written pyramid is never picked up
+        tmp_filename = '%s.part' % filename
+        with open(tmp_filename, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.rename(tmp_filename, filename)
+
+    def level(self, factor):
+        if factor == 1:
+            if self._pixels is None:
+                self._pixels = map_pnm(self.filename)
+            return self._pixels
+        return self.levels[factor]
+
+    def at(self, dpi):
+        """
+            The level whose resolution is closest to dpi (the finer one on a tie)
+
+            :returns: (pixels, resolution of that level)
+        """
+        factors = [1] + sorted(self.levels)
+        factor = min(factors, key=lambda f: (abs(np.log(float(self.dpi) / f / dpi)), f))
+        return self.level(factor), float(self.dpi) / factor
+
+    def release(self):
+        self._pixels = None
+
+
+def remove(filename):
+    """
+        Remove the saved pyramid of filename, if there is one
+    """
+    if os.path.exists(pyramid_filename(filename)):
+        os.remove(pyramid_filename(filename))
@@ -0,0 +1,314 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Running external commands without a shell.
+
+    A command is an argv list that gets exec'd directly, and a pipeline is a
+    list of them, each one's stdout connected to the next one's stdin.
+    :func:`start` returns as soon as the processes are running, with a
+    :class:`Command` to :meth:`Command.wait` on later, so any number of
+    commands can be in flight at once.  :func:`run` and :func:`run_pipeline`
+    start one and wait for it.
+"""
+
+import os
+import errno
+import signal
+import tempfile
+import threading
+import subprocess
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+CHUNK_SIZE = 64 * 1024
+# How much output to hang on to for the error message when it's being passed to on_output
+TAIL_SIZE = 64 * 1024
+
+
+class CommandError(Exception):
+    """
+        A command failed.  Has the command line (``cmd``), the ``returncode``
+        and whatever the command printed (``output``).
+    """
+
+    def __init__(self, cmd, returncode, output, message=None):
+        if message is None:
+            message = "Could not run command %s (exit status %s)" % (cmd, returncode)
+        Exception.__init__(self, message)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+
+
+class CommandTimeout(CommandError):
+    """ A command ran for longer than its timeout, and was killed """
+
+    def __init__(self, cmd, timeout, output):
+        CommandError.__init__(self, cmd, -signal.SIGKILL, output,
+                              "Command %s timed out after %ss" % (cmd, timeout))
+        self.timeout = timeout
+
+
+def describe(argvs):
+    """
+        :returns: the shell equivalent of the pipeline argvs, for logging
+    """
+    return ' | '.join(' '.join(quote(str(arg)) for arg in argv) for argv in argvs)
+
+
+class Result(object):
+    """
+        A finished command
+
+        :ivar output: everything it printed (stdout and stderr), or just the
+                      tail of it if it was passed to on_output
+        :ivar cpu: user + system CPU seconds of all the processes
+        :ivar max_rss_kb: the biggest peak RSS of any of the processes
+    """
+
+    def __init__(self, cmd, returncode, output, cpu, max_rss_kb, elapsed, timeout=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+        self.cpu = cpu
+        self.max_rss_kb = max_rss_kb
+        self.elapsed = elapsed
+        self.timeout = timeout
+
+    @property
+    def timed_out(self):
+        return self.timeout is not None
+
+    def check(self):
+        """
+            Raise :class:`CommandTimeout` or :class:`CommandError` if the command failed
+
+            :returns: the output
+        """
+        if self.timed_out:
+            raise CommandTimeout(self.cmd, self.timeout, self.output)
+        if self.returncode != 0:
+            raise CommandError(self.cmd, self.returncode, self.output)
+        return self.output
+
+
+class Command(object):
+    """
+        A running command or pipeline; see :func:`start`
+    """
+
+    def __init__(self, argvs, input=None, env=None, cwd=None, timeout=None, on_output=None):
+        self.cmd = describe(argvs)
+        self.on_output = on_output
+        self.timeout = timeout
+        self.timed_out = False
+        self.chunks = []
+        self.size = 0
+        self.procs = []
+        self.rusages = []
+        self.result = None
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+        environ = None
+        if env:
+            environ = dict(os.environ)
+            environ.update(env)
+        # Anything but the last command in a pipeline writes its errors here
+        self.errors = tempfile.TemporaryFile() if len(argvs) > 1 else None
+
+        stdin = subprocess.PIPE if input is not None else None
+        try:
+            for i, argv in enumerate(argvs):
+                last = i == len(argvs) - 1
+                p = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT if last else self.errors,
+                                     env=environ, cwd=cwd, close_fds=True)
+                if self.procs:
+                    # Only the next command reads from it now
+                    self.procs[-1].stdout.close()
+                self.procs.append(p)
+                stdin = p.stdout
+        except OSError as e:
+            # Same as the shell would do for a missing program
+            self.kill()
+            self._reap_all()
+            raise CommandError(self.cmd, 127, str(e))
+
+        self.threads = []
+        if input is not None:
+            self._thread(self._feed, self.procs[0].stdin, input)
+        self._thread(self._read, self.procs[-1].stdout)
+        self.timer = None
+        if timeout:
+            self.timer = threading.Timer(timeout, self._expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _thread(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def _feed(self, f, data):
+        try:
+            f.write(data)
+            f.close()
+        except (IOError, OSError):
+            # The command exited without reading it all, we'll see its exit status
+            pass
+
+    def _read(self, f):
+        fd = f.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, CHUNK_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            if self.on_output is not None:
+                self.on_output(chunk)
+                while self.size - len(self.chunks[0]) >= TAIL_SIZE:
+                    self.size -= len(self.chunks.pop(0))
+        f.close()
+
+    def _expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def kill(self):
+        with self.lock:
+            for p in self.procs:
+                if p.returncode is None:
+                    try:
+                        p.kill()
+                    except OSError:
+                        pass
+
+    def _reap(self, p, flags=0):
+        """
+            Wait for p ourselves (instead of p.wait()), to get its resource usage
+
+            :returns: True if p has finished
+        """
+        if p.returncode is not None:
+            return True
+        # Not holding the lock while we block, so the timeout can still kill it
+        while True:
+            try:
+                pid, status, rusage = os.wait4(p.pid, flags)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if pid == 0:
+            return False
+        with self.lock:
+            if os.WIFSIGNALED(status):
+                p.returncode = -os.WTERMSIG(status)
+            else:
+                p.returncode = os.WEXITSTATUS(status)
+            self.rusages.append(rusage)
+        return True
+
+    def _reap_all(self):
+        for p in self.procs:
+            self._reap(p)
+
+    def poll(self):
+        """
+            :returns: True if the command has finished (call :meth:`wait` to get the result)
+        """
+        return all([self._reap(p, os.WNOHANG) for p in self.procs])
+
+    def wait(self, check=True):
+        """
+            Wait for the command to finish
+
+            :param check: raise :class:`CommandError` if it failed
+            :returns: a :class:`Result`
+        """
+        if self.result is None:
+            for t in self.threads:
+                t.join()
+            self._reap_all()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer.join()
+            self.result = self._result()
+        if check:
+            self.result.check()
+        return self.result
+
+    def _result(self):
+        output = b''.join(self.chunks)
+        # The pipeline failed if any command in it did, but an earlier command
+        # getting SIGPIPE only means a later one stopped reading
+        returncode = 0
+        for i, p in enumerate(self.procs):
+            if p.returncode == 0:
+                continue
+            if p.returncode == -signal.SIGPIPE and i < len(self.procs) - 1:
+                continue
+            returncode = p.returncode
+            break
+        if self.errors is not None:
+            self.errors.seek(0)
+            output = self.errors.read() + output
+            self.errors.close()
+        return Result(self.cmd, returncode, output,
+                      cpu=sum(r.ru_utime + r.ru_stime for r in self.rusages),
+                      max_rss_kb=max(r.ru_maxrss for r in self.rusages),
+                      elapsed=time.time() - self.start_time,
+                      timeout=self.timeout if self.timed_out else None)
+
+
+def start(argvs, input=None, env=None, cwd=None, timeout=None, on_output=None):
+    """
+        Start the pipeline argvs (a list of argv lists) without waiting for it
+
+        :param input: Optional bytes to feed to the first command's stdin
+        :param env: Optional dict of environment variables to add
+        :param timeout: Kill the pipeline if it runs longer than this many seconds (None or 0 for no limit)
+        :param on_output: Optional function to call with each chunk of output as it comes in
+        :returns: a :class:`Command`
+    """
+    return Command(argvs, input=input, env=env, cwd=cwd, timeout=timeout, on_output=on_output)
+
+
+def run(argv, **kwargs):
+    """
+        Run argv and wait for it; takes the same keyword arguments as :func:`start`
+
+        :returns: its output
+        :raises CommandError: if it fails or times out
+    """
+    return start([argv], **kwargs).wait().output
+
+
+def run_pipeline(argvs, **kwargs):
+    """
+        Run the pipeline argvs and wait for it, like :func:`run`
+    """
+    return start(argvs, **kwargs).wait().output
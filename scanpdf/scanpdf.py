@@ -18,6 +18,13 @@ Usage:
     scanpdf [options] scan 
     scanpdf [options] pdf <pdffile> 
     scanpdf [options] scan pdf <pdffile> 
+    scanpdf [options] serve
+    scanpdf [options] submit scan
+    scanpdf [options] submit pdf <pdffile>
+    scanpdf [options] submit scan pdf <pdffile>
+    scanpdf [options] status [<job>]
+    scanpdf [options] devices <config> [<device>...]
+    scanpdf [options] batch <dir>...
 
 
 Options:
@@ -28,8 +35,25 @@ Options:
     --keep-tmpdir               Whether to keep the tmp dir after scanning or not [default: False]
     --face-up=<true/false>      Face-up scanning [default: True]
     --keep-blanks               Don't check for and remove blank pages
-    --blank-threshold=<ths>     Percentage of white to be marked as blank [default: 0.97] 
+    --blank-threshold=<ths>     Fraction of white in an area for it to count as blank [default: 0.97] 
     --post-process              Run unpaper to deskew/clean up
+    -j --jobs=<n>               Number of pages to process in parallel (defaults to the number of cores)
+    --stream                    With scan pdf, process each page as soon as scanadf has written it
+    --backend=<name>            Image processing backend: numpy (in-process), imagemagick or vips [default: numpy]
+    --analysis=<engine>         Old name for --backend
+    --ghostscript               Merge per-page PDFs with Ghostscript instead of writing the PDF directly
+    --incremental               Keep a readable <pdffile>.partial.pdf up to date as pages are done, then linearize it (with qpdf)
+    --cache-dir=<dir>           Cache per-page results here, to speed up re-running the same scans
+    --cache-size=<mb>           Maximum size of the cache in MB [default: 1024]
+    --trace=<file>              Trace every stage and command to <file> (Chrome trace format, or JSON lines for .jsonl)
+    --profile=<file>            Print where the time and memory went, and save the Python profile to <file> (pstats)
+    --timeout=<secs>            Kill any command (other than the scan) that runs longer than this, 0 for no limit [default: 600]
+    --batch-size=<n>            Pages to check in a single ImageMagick command [default: 50]
+    --socket=<path>             Unix socket for serve, submit and status [default: /tmp/scanpdf.sock]
+    --wait                      With submit, wait for the job to finish
+    --ram-budget=<mb>           Keep up to this many MB of intermediate files in --ram-dir instead of the tmp dir [default: 0]
+    --ram-dir=<dir>             RAM disk for the intermediate files [default: /dev/shm]
+    --outdir=<dir>              With batch, where to write the PDFs [default: .]
     
 """
 
@@ -39,12 +63,47 @@ import shutil
 import re
 
 from version import __version__
+from pnm import to_pnm
+from page import Page
+from pyramid import Pyramid, remove as remove_pyramid
+from pdfwriter import PdfWriter, PdfImage, encode_grey
+from cache import PageCache
+from journal import Journal, sync_file
+from staging import Staging, page_of
+from trace import Tracer, traced
+from profiler import Profiler
+from backend import BACKENDS, ImageMagickBackend
+from server import Server, ServerError, request
+from scheduler import Scheduler, SchedulerError, load_profiles, Batch, find_pending
+import runner
+import analysis
 import docopt
 
-import subprocess
 import time
 import glob
-from itertools import combinations
+import signal
+import socket
+import multiprocessing
+from multiprocessing.dummy import Pool as ThreadPool
+import shlex
+from collections import deque
+
+# How scanadf is run, unless a device profile (see scheduler.py) says otherwise.
+# The options are for the ScanSnap; other things that have been tried are
+# --y-resolution, -y 876.695mm, --page-height 355.617mm and --buffermode On
+SCAN_PROFILE = {
+    'scanadf': 'scanadf',
+    'source': 'ADF Duplex',
+    'mode': 'Color',
+    'options': '--page-height 876.695 -y 876.695 --brightness=25 --emphasis=20 --ald yes',
+}
+
+# With --incremental, the partial PDF gets a new page tree once this many
+# seconds have passed since the last one, or once the pages added since make
+# up this fraction of the ones in it, so a long batch isn't rewriting the
+# whole page tree after every page
+UPDATE_SECONDS = 10
+UPDATE_FRACTION = 0.25
 
 
 class ScanPdf(object):
@@ -58,46 +117,133 @@ class ScanPdf(object):
         """
         self.config = None
         self.bw_pages = {}  # Keep track of which pages were in B&W
+        self.jobs = 1
+        self.pool = None
+        self.own_pool = False
+        self.error = None  # The message of the _error() we exited with
+        self.environ = os.environ
+        self.profile = {}  # scanadf settings for the device, see SCAN_PROFILE
+        self.analysis = 'numpy'  # Name of the --backend (it used to be --analysis)
+        self._backend = None
+        self.imagemagick = ImageMagickBackend(self)  # For the files the backend can't read
+        self.ghostscript = False
+        self.keep_blanks = False
+        self.incremental = False
+        self.cache = None
+        self.journal = None
+        self.staging = None  # Keeps the intermediate files in RAM, see --ram-budget
+        self.tracer = Tracer()
+        self.profiler = None  # See --profile
+        self.timeout = 0  # Seconds before giving up on an external command, 0 for no limit
+        self.batch_size = 50
+        self.prefetched = {}  # (check, filename) to the result of a batched ImageMagick call
+        self.poll_interval = 0.5  # How often to look for new pages when streaming
 
-    def cmd(self, cmd_list):
-        if isinstance(cmd_list, list):
-            cmd_list = ' '.join(cmd_list)
-        logging.debug("Running cmd: %s" % cmd_list)
-        try:
-            out = subprocess.check_output(cmd_list, stderr=subprocess.STDOUT, shell=True)
-            logging.debug(out)
-            return out
-        except subprocess.CalledProcessError as e:
-            print (e.output)
-            self._error("Could not run command %s" % cmd_list)
-            
+    def cmd(self, argv, input=None, env=None, timeout=None):
+        """
+            Run argv (no shell involved) and return its output
 
+            :param input: Optional bytes to feed to the command's stdin
+            :param env: Optional dict of environment variables to add
+            :param timeout: Seconds before giving up on it, defaults to --timeout (0 for no limit)
+            :raises runner.CommandError: if it fails or times out
+        """
+        return self.pipeline([argv], input=input, env=env, timeout=timeout)
+
+    def pipeline(self, argvs, input=None, env=None, timeout=None):
+        """
+            Run argvs with each command's stdout going into the next one's
+            stdin, and return the output of the last one.  See :meth:`cmd`.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        logging.debug("Running cmd: %s" % runner.describe(argvs))
+        token = self.tracer.start_command(argvs, input)
+        result = runner.start(argvs, input=input, env=env, timeout=timeout).wait(check=False)
+        self.tracer.end_command(token, result)
+        logging.debug(result.output)
+        return result.check()
+
+    def _scan_cmd(self):
+        """
+            The scanadf command, with the settings in :attr:`profile` on top of :data:`SCAN_PROFILE`
+        """
+        profile = dict(SCAN_PROFILE)
+        profile.update(self.profile)
+        device = profile.get('device') or self.environ['SCANBD_DEVICE']
+        c = shlex.split(profile['scanadf']) + [
+                '-d', device,
+                '--source', profile['source'],
+                '--mode', profile['mode'],
+                '--resolution', '%sdpi' % self.dpi,
+                #'--y-resolution', '%sdpi' % self.dpi,
+                '-o', '%s/page_%%04d' % self.tmp_dir,
+                ] + shlex.split(profile['options'])
+        return c
+
+    def _scan_env(self):
+        return {'SANE_CONFIG_DIR': '/etc/scanbd'}
+
+    def _log(self, message):
+        self.cmd(['logger', '-t', 'scanbd: ', message])
 
     def run_scan(self):
-        device = os.environ['SCANBD_DEVICE']
-        self.cmd('logger -t "scanbd: " "Begin of scan "')
-        c = ['SANE_CONFIG_DIR=/etc/scanbd', 
-                'scanadf',
-                '-d "%s"' % device,
-                '--source "ADF Duplex"',
-                '--mode Color',
-                '--resolution %sdpi' % self.dpi,
-                #'--y-resolution %sdpi' % self.dpi,
-                '-o %s/page_%%04d' % self.tmp_dir,
-                #'-y 876.695mm',
-                #'--page-height 355.617mm',
-                '--page-height 876.695',
-                '-y 876.695',
-                #'--buffermode On',
-                '--brightness=25',
-                '--emphasis=20',
-                '--ald yes',
-                ]
-        self.cmd(c)
-        self.cmd('logger -t "scanbd: " "End of scan "')
+        self._log("Begin of scan ")
+        with self.tracer.stage('scan'):
+            # A whole batch can take a while, so no timeout on the scan itself
+            self.cmd(self._scan_cmd(), env=self._scan_env(), timeout=0)
+        self._log("End of scan ")
+
+    def run_scan_and_process(self):
+        """
+            Run scanadf in the background, and push each page through
+            :meth:`process_page` as soon as scanadf has finished writing it
+            (see :meth:`imap`).  Page ordering is left to the merge step.
+
+            :returns: generator of (scanned page name, result of :meth:`process_page`)
+        """
+        self._log("Begin of scan ")
+        c = self._scan_cmd()
+        logging.debug("Running cmd in background: %s" % runner.describe([c]))
+        scan = runner.start([c], env=self._scan_env(), on_output=logging.debug)
+        try:
+            for result in self.imap(self.process_page, self._scanned_pages(scan)):
+                yield result
+        except BaseException:
+            scan.kill()
+            raise
+        finally:
+            scan.wait(check=False)
+        scan.wait()
+        self._log("End of scan ")
+
+    def _scanned_pages(self, scan):
+        """
+            Yield each page scanadf writes, once it's done writing it.  scanadf
+            writes the pages one after the other, so a page is complete once
+            the next page file shows up (or scanadf has exited).
+        """
+        seen = set()
+        while True:
+            finished = scan.poll()
+            pages = self.get_pages()
+            if not finished:
+                # The last page may still be in the middle of being scanned
+                pages = pages[:-1]
+            new = [page for page in pages if page not in seen]
+            seen.update(new)
+            # Whatever has come in since we last looked is batched up together
+            self.prefetch_pages(new)
+            for page in new:
+                logging.info("Scanned %s, starting to process it" % page)
+                yield page
+            if finished:
+                break
+            time.sleep(self.poll_interval)
 
     def _error(self, msg):
         print("ERROR: %s" % msg)
+        self.error = msg
         sys.exit(-1)
 
     def _atoi(self,text):                                       
@@ -112,170 +258,475 @@ class ScanPdf(object):
          return [ self._atoi(c) for c in re.split('(\d+)', text) ]         
 
     def get_pages(self):
-        cwd = os.getcwd()
-        os.chdir(self.tmp_dir)
-        pages = glob.glob('./page_*')
+        """
+            Returns the scanned pages (not any of our intermediate files) in the tmp dir, in scan order
+        """
+        mPage = re.compile(r'^page_\d+$')
+        pages = ['./%s' % os.path.basename(f) for f in glob.glob(os.path.join(self.tmp_dir, 'page_*'))]
+        pages = [p for p in pages if mPage.match(os.path.basename(p))]
         pages.sort(key = self._natural_keys)
-        os.chdir(cwd)
         return pages
 
     def reorder_face_up(self, pages):
-        reorder = []
         assert len(pages) % 2 == 0, "Why is page count not even for duplexing??"
         logging.info("Reordering pages")
         pages.reverse()
         return pages
             
-    def parse_dimensions(self, result):
-        first_line = str(result.splitlines()[0].strip())
-        logging.debug(first_line)
-        mCropDim = re.compile("""\s*(?P<filename>[\d\w\[_\/\\\.]+)\s+\w+\s+(?P<X>\d+)x(?P<Y>\d+)\s+""")
-        # blank3.pnm PPM 1x1 1950x2716-1-1 8-bit sRGB 0.010u 0:00.009
-        matchCropDim = mCropDim.search(first_line)
-        if matchCropDim:
-            x = int(matchCropDim.group('X'))
-            y = int(matchCropDim.group('Y'))
-        else:
-            x = -1
-            y = -1
-        return x, y
+    @property
+    def backend(self):
+        """
+            The :class:`backend.ImageBackend` named by --backend
+        """
+        if self._backend is None or self._backend.name != self.analysis:
+            self._backend = BACKENDS[self.analysis](self)
+        return self._backend
+
+    def _backend_for(self, filename):
+        """
+            The backend to use on filename: the --backend, unless it can't
+            read the file, in which case ImageMagick
+        """
+        backend = self.backend
+        if not backend.reads(filename):
+            logging.debug("The %s backend can't read %s, using ImageMagick" % (backend.name, filename))
+            return self.imagemagick
+        return backend
 
     def get_dimensions(self, filename):
-        c = 'identify %s' % filename
-        result = self.cmd(c)
-        return self.parse_dimensions(result)
+        if ('size', filename) in self.prefetched:
+            return self.prefetched.pop(('size', filename))
+        return self._backend_for(filename).dimensions(filename)
 
-    def is_blank(self, filename):
+    def _needs_imagemagick(self, filename):
+        """
+            True if filename has to be done by ImageMagick, so it's worth batching
+        """
+        return isinstance(self._backend_for(filename), ImageMagickBackend)
+
+    def _prefetch(self, check, results):
+        for filename, result in results.items():
+            self.prefetched[(check, filename)] = result
+
+    def prefetch_pages(self, pages):
+        """
+            Do the ImageMagick work that can be batched for pages before
+            they're processed: one identify for their dimensions, and then,
+            instead of a crop, a blank check and a color check for each page,
+            one convert per worker that does all three for its share of the
+            pages (see :meth:`backend.ImageMagickBackend.crop_and_check`).
+            :meth:`process_page` then picks up the results.
+
+            Only the pages ImageMagick has to do are batched (all of them with
+            --backend=imagemagick), and not ones already done by an earlier run.
+        """
+        pages = [page for page in pages if not self._journaled(page) and self._needs_imagemagick(self._tmp_path(page))]
+        if not pages:
+            return
+        self.prefetch_dimensions([self._tmp_path(page) for page in pages])
+        share = -(-len(pages) // self.jobs)
+        self.run_parallel(self._crop_and_check, [pages[i:i + share] for i in range(0, len(pages), share)])
+
+    def _crop_and_check(self, pages):
+        if self.staging is not None:
+            # Don't let the crops be moved to disk while convert is still writing them
+            for page in pages:
+                self.staging.begin(page)
+        try:
+            crops = [(self._tmp_path(page), '%s.crop' % page) for page in pages]
+            crops = [(filename, crop_page, self._tmp_path(crop_page)) for filename, crop_page in crops]
+            try:
+                checks = self.imagemagick.crop_and_check([(filename, crop_filename, self.get_dimensions(filename))
+                                                          for filename, crop_page, crop_filename in crops],
+                                                         check_blank=not self.keep_blanks)
+            except runner.CommandError as e:
+                # process_page does them one at a time instead, and reports what's wrong then
+                logging.warning("Couldn't crop and check %d pages at once: %s" % (len(pages), e))
+                return
+            for filename, crop_page, crop_filename in crops:
+                if not os.path.exists(crop_filename):
+                    continue
+                # The scan always stays where it is, but the crop may be moved to disk before it's used
+                self.prefetched[('crop', filename)] = crop_page
+                if crop_filename in checks:
+                    blank, color = checks[crop_filename]
+                    if blank is not None:
+                        self.prefetched[('blank', crop_filename)] = blank
+                    self.prefetched[('color', crop_filename)] = color
+        finally:
+            if self.staging is not None:
+                for page in pages:
+                    self.staging.end(page)
+
+    def _prefetching(self, pages):
+        """
+            Yield pages, doing :meth:`prefetch_pages` on each --batch-size of them just before they're handed out
+        """
+        for i in range(0, len(pages), self.batch_size):
+            batch = pages[i:i + self.batch_size]
+            self.prefetch_pages(batch)
+            for page in batch:
+                yield page
+
+    def _forget(self, page):
+        """
+            Drop whatever was prefetched for page's files, removing a crop that wasn't used
+        """
+        page = page_of(page)
+        for key in list(self.prefetched):
+            check, filename = key
+            if page_of(filename) != page:
+                continue
+            result = self.prefetched.pop(key, None)
+            if check == 'crop' and result is not None:
+                self._remove_page(self._tmp_path(result))
+
+    def prefetch_dimensions(self, filenames):
         """
-            Returns true if image in filename is blank
+            Get the dimensions of all of filenames up front, with a single
+            identify per --batch-size files, for :meth:`get_dimensions` to use.
+        """
+        filenames = [f for f in filenames if self._needs_imagemagick(f)]
+        self._prefetch('size', self.imagemagick.all_dimensions(filenames))
 
-            - Shave off one inch around edges
-            - Blur and crop down as much as possible
-            - If remaining page has a dimension smaller than 0.3" conclude it's blank
+    def is_blank(self, filename):
+        """
+            Returns true if image in filename is blank, using the --backend
+            (this is where --blank-threshold is used)
         """
         if not os.path.exists(filename):
             return True
+        if ('blank', filename) in self.prefetched:
+            return self.prefetched.pop(('blank', filename))
+        return self._backend_for(filename).is_blank(filename)
 
-        #c = 'convert %s -shave %sx%s -virtual-pixel White -blur 0x15 -fuzz 15%% -trim info:' % (filename, self.dpi, self.dpi)
-        c = 'convert %s -shave %sx%s -density %s -adaptive-resize 65%% -virtual-pixel White -blur 0x15 -fuzz 15%% -trim info:' % (filename, self.dpi, self.dpi, int(self.dpi/2))
-        result = self.cmd(c)
-        x, y = self.parse_dimensions(result)
-        if x>0 and y>0:
-            logging.debug('Finding threshold for blanks')
-            threshold = int(self.dpi)/2*0.3  # Threshold is 0.3 inches
-            logging.debug('x=%s, y=%s, threshold=%s' % (x, y, threshold))
-            if x < threshold or y < threshold:
-                return True
-            else:
-                return False
-        else:
-            logging.debug('Could not find dimensions in output of imagemagick for cropping')
-            return False
-        
-        # Old code, doesn't really work for pages with small amounts of text
-        # c = 'identify -verbose %s' % filename
-        # result = self.cmd(c)
-        # mStdDev = re.compile("""\s*standard deviation:\s*\d+\.\d+\s*\((?P<percent>\d+\.\d+)\).*""")
-        # for line in result.splitlines():
-        #     match = mStdDev.search(str(line))
-        #     if match:
-        #         stdev = float(match.group('percent'))
-        #         if stdev > 0.1:
-        #             return False
-        # return True
-
+    def prefetch_blanks(self, filenames):
+        """
+            Do the ImageMagick blank check of all of filenames up front, in a
+            single convert per --batch-size files, for :meth:`is_blank` to use.
+        """
+        filenames = [f for f in filenames if os.path.exists(f) and self._needs_imagemagick(f)]
+        self._prefetch('blank', self.imagemagick.all_blanks(filenames))
 
     def run_postprocess(self, page_files):
-        cwd = os.getcwd()
-        os.chdir(self.tmp_dir)
-        
-        processed_pages = []
-        self.bw_pages = {}
-        for page in page_files:
-            processed_page = '%s_unpaper' % page
-            c = ['unpaper', page, processed_page]
-            self.cmd(c) 
-            os.remove(page)
-            processed_pages.append(processed_page)
-            self.bw_pages[processed_page] = True
-        os.chdir(cwd)
-        return processed_pages
+        return self.run_parallel(self._postprocess_page, page_files)
+
+    @traced('unpaper')
+    def _postprocess_page(self, page):
+        processed_page = '%s_unpaper' % page
+        # --overwrite, in case an earlier run was interrupted after unpaper
+        c = ['unpaper', '--overwrite', self._tmp_path(page), self._tmp_path(processed_page)]
+        self.cmd(c)
+        self._remove_page(self._tmp_path(page))
+        # unpaper keeps the page's format, so it's still color or B&W as before
+        self.bw_pages[processed_page] = self.bw_pages.get(page, False)
+        return processed_page
+
+    def _needs_postprocess(self, page):
+        """
+            Returns False if the :class:`page.Page` is already straight and
+            clean (see :func:`analysis.pyramid_is_clean`), so running unpaper
+            on it would be a waste of time.
+        """
+        if analysis.pyramid_is_clean(page.pyramid):
+            logging.info("%s is straight and clean, not running unpaper" % page.filename)
+            return False
+        return True
 
     def run_crop(self, page_files):
-        cwd = os.getcwd()
-        os.chdir(self.tmp_dir)
-        crop_pages = []
-        for i, page in enumerate(page_files):
-            logging.debug("Cropping page %d" % i)
-            crop_page = '%s.crop' % page
-            shave_amt = int(int(self.dpi)*0.1)
-            c = ['convert',
-                    '-deskew 80%',
-                    '-shave %dx%d' % (shave_amt, shave_amt),
-                    '-fuzz 20%',
-                    '-trim',
-                    '+repage',
-                ]
-            
-            # Get original dimensions
-            x, y = self.get_dimensions(page)
-            if x>0 and y>0:
-                # IF we know the original dimensions, then just pad back to that with white background
-                c.extend([  '-gravity center',
-                            '-extent %sx%s' % (x, y),
-                            '-background white',
-                ])
-            c.extend([ ' %s ' % page,
-                       crop_page,
-                    ])
-            self.cmd(c)
-            crop_pages.append(crop_page)
-
-            if not self.args['--keep-tmpdir']:
-                os.remove(page)
+        self.prefetch_dimensions([self._tmp_path(page) for page in page_files])
+        return self.run_parallel(self._crop_page, page_files)
 
-        os.chdir(cwd)
-        return crop_pages
+    @traced('crop')
+    def _crop_page(self, page, pyramid=None):
+        """
+            Straighten the page, trim off the scanner background around it,
+            and center it on a white page of the original size, with the
+            --backend (see :meth:`backend.ImageBackend.crop`)
+
+            :param pyramid: The page's :class:`pyramid.Pyramid`, if it's been built already
+        """
+        logging.debug("Cropping page %s" % page)
+        filename = self._tmp_path(page)
+        crop_page = '%s.crop' % page
+        if self.prefetched.pop(('crop', filename), None) and os.path.exists(self._tmp_path(crop_page)):
+            # Already done by prefetch_pages
+            return crop_page
+        self._backend_for(filename).crop(filename, self._tmp_path(crop_page), pyramid)
+        # The original stays until the PDF is written, see cleanup()
+        return crop_page
 
     def run_convert(self, page_files):
+        self.run_parallel(self._output_page, page_files)
+        self.run_merge(page_files)
+
+    @traced('encode')
+    def _output_page(self, page, pixels=None):
+        """
+            Get a finished page ready for :meth:`run_merge`, either as a
+            single page PDF (--ghostscript) or an encoded image stream.
+
+            :param pixels: Optional decoded pixels to use instead of reading the page from disk
+        """
+        if self.ghostscript:
+            data = None if pixels is None else to_pnm(pixels)
+            return self._page_to_pdf(page, data)
+        return self._encode_page(page, pixels)
+
+    def _encode_page(self, page, pixels=None):
+        """
+            Encode a page into a PDF image stream ``<page>.stream``: 2-bit
+            Flate for B&W pages, and JPEG for color ones.
+
+            :param pixels: Optional decoded B&W pixels to use instead of reading the page from disk
+        """
+        filename = self._tmp_path(page)
+        stream_filename = self._tmp_path('%s.stream' % page)
+        is_bw = self.bw_pages.get(page, False)
+        if is_bw and pixels is not None:
+            image = encode_grey(pixels, bits=2)
+        else:
+            image = self._backend_for(filename).encode(filename, is_bw)
+        image.save(stream_filename)
+        return stream_filename
+
+    def write_pdf(self, page_files, pdf_filename):
+        """
+            Assemble the image streams from :meth:`_encode_page` into pdf_filename, in the order of page_files
+        """
+        writer = PdfWriter(pdf_filename)
+        for page in page_files:
+            self._append_page(page, writer)
+        writer.close()
+
+    @traced('append')
+    def _append_page(self, page, writer):
+        """
+            Add the image stream of page to writer.  The stream stays until
+            the PDF is done, since it's what the journal points to.
+
+            :returns: The PDF page id, see :meth:`pdfwriter.PdfWriter.close`
+        """
+        # The scanner gives us the pages upside down
+        return writer.add_page(PdfImage.load(self._tmp_path('%s.stream' % page)), self.dpi, rotate=180)
+
+    def _page_to_pdf(self, page, data=None):
+        """
+            Convert a page to a single page PDF ``<page>.pdf``
+
+            :param data: Optional PNM bytes to use instead of reading the page from disk
+        """
+        filename = self._tmp_path(page)
+        pdf_filename = self._tmp_path('%s.pdf' % page)
+        source = filename if data is None else 'pnm:-'
+        is_bw = self.bw_pages.get(page, False)
+        if is_bw:
+            c = [['convert',
+                    source,
+                    '-density', str(self.dpi),
+                    '-depth', '2',
+                    '-define', 'png:compression-level=9',
+                    '-define', 'png:format=8',
+                    '-define', 'png:color-type=0',
+                    '-define', 'png:bit-depth=2',
+                    'PNG:-',
+                    ],
+                 ['convert', '-', '-rotate', '180', pdf_filename],
+                ]
+        else:
+            c = [['convert',
+                    '-density', str(self.dpi),
+                    '+page', # Make sure it doesn't crop to letter size
+                    '-compress', 'JPEG',
+                    '-sampling-factor', '4:2:0',
+                    '-strip',
+                    '-quality', '85',
+                    '-interlace', 'JPEG',
+                    '-colorspace', 'RGB',
+                    '-rotate', '180',
+                    source,
+                    pdf_filename,
+                ]]
+        self.pipeline(c, input=data)
+        return pdf_filename
+
+    def run_merge(self, page_files):
+        """
+            Merge the pages finished by :meth:`_output_page` (in the order of
+            page_files) into the final PDF, and clean up the temporary files.
+        """
         cwd = os.getcwd()
         os.chdir(self.tmp_dir)
 
         pdf_basename = os.path.basename(self.pdf_filename)
-        ps_filename = pdf_basename
-        ps_filename = ps_filename.replace(".pdf", ".ps")
+        with self.tracer.stage('merge'):
+            if self.ghostscript:
+                self._merge_with_gs(page_files, pdf_basename)
+            else:
+                self.write_pdf(page_files, pdf_basename)
+
+        shutil.move(pdf_basename, self.pdf_filename)
+        if not self.args['--keep-tmpdir']:
+            for filename in page_files:
+                self._remove_page(self._tmp_path(filename))
+                self._remove(self._artifact(filename))
+        os.chdir(cwd)
 
+    def final_order(self, pages):
+        """
+            The scanned pages in the order they go in the PDF
+        """
+        pages = sorted(pages, key = self._natural_keys)
+        if self.args['--face-up']:
+            pages = self.reorder_face_up(pages)
+        logging.debug( pages )
+        return pages
 
-        # Convert each page to a ps
-        for page in page_files:
-            is_bw = self.bw_pages.get(page, False)
-            if is_bw:
-                c = ['convert',
-                        page,
-                        '-density %s' % self.dpi,
-                        '-depth 2', 
-                        '-define png:compression-level=9',
-                        '-define png:format=8',
-                        '-define png:color-type=0',
-                        '-define png:bit-depth=2',
-                        'PNG:- | convert - -rotate 180',
-                        '%s.pdf' % page,
-                        ]
+    def partial_order(self, pages):
+        """
+            :meth:`final_order` of just some of the pages
+        """
+        pages = sorted(pages, key = self._natural_keys)
+        if self.args['--face-up']:
+            pages.reverse()
+        return pages
+
+    def partial_filename(self):
+        """
+            Where the PDF is written with --incremental, until it's finished
+        """
+        return '%s.partial.pdf' % os.path.splitext(self.pdf_filename)[0]
+
+    def assemble(self, results):
+        """
+            Write the PDF from results, the (scanned page, result of
+            :meth:`process_page`) pairs, while they're still coming in.
+
+            Each finished page is appended to the PDF (and its intermediate
+            files removed) as soon as it's done, so they don't pile up in the
+            tmp dir however long the batch is.  Only its stream is kept, for
+            a rerun to resume from if this one is interrupted, until
+            :meth:`cleanup`.  The pages only get put in their final order in
+            the PDF's page tree, once they're all in.  With --ghostscript, the
+            per-page PDFs are kept until they're all merged at the end.
+
+            With --incremental, the PDF is written next to the final one
+            instead (see :meth:`partial_filename`), and brought up to date
+            with the pages done so far every so often (see UPDATE_SECONDS),
+            so it can be opened while it's still being written.  Once it's complete it's
+            linearized into the final PDF (see :meth:`linearize`).
+
+            :returns: dict of scanned page name to the result of :meth:`process_page`
+        """
+        if self.incremental:
+            pdf_filename = self.partial_filename()
+        else:
+            pdf_filename = os.path.join(self.tmp_dir, os.path.basename(self.pdf_filename))
+        writer = None if self.ghostscript else PdfWriter(pdf_filename)
+        if self.incremental:
+            # An empty but valid PDF until the first page is in
+            writer.update([])
+        processed = {}
+        page_ids = {}
+        shown, last_update = 0, time.time()  # Pages in the partial PDF, and when it was updated
+        for page, result in results:
+            processed[page] = result
+            if result is None or writer is None:
+                continue
+            if self.staging is not None:
+                # The workers are still going, and mustn't move the page's files to disk under us
+                self.staging.begin(result)
+            try:
+                page_ids[page] = self._append_page(result, writer)
+                if result != page and not self.args['--keep-tmpdir']:
+                    # The original scan stays until the PDF is done, see cleanup()
+                    self._remove_page(self._tmp_path(result))
+            finally:
+                if self.staging is not None:
+                    self.staging.end(result)
+            if self.incremental and (len(page_ids) - shown >= shown * UPDATE_FRACTION or
+                                     time.time() - last_update >= UPDATE_SECONDS):
+                writer.update([page_ids[done] for done in self.partial_order(page_ids.keys())])
+                shown, last_update = len(page_ids), time.time()
+
+        pages = self.final_order(processed.keys())
+        with self.tracer.stage('merge'):
+            if writer is not None:
+                writer.close([page_ids[page] for page in pages if page in page_ids])
             else:
-                c = ['convert',
-                        '-density %s' % self.dpi,
-                        '+page', # Make sure it doesn't crop to letter size
-                        '-compress JPEG',
-                        '-sampling-factor 4:2:0',
-                        '-strip',
-                        '-quality 85',
-                        '-interlace JPEG',
-                        '-colorspace RGB',
-                        '-rotate 180',
-                        page,
-                        '%s.pdf' % page,
-                    ]
-            self.cmd(c)
+                self._merge_with_gs([processed[page] for page in pages if processed[page]], pdf_filename)
+        if self.incremental:
+            self.linearize(pdf_filename)
+        else:
+            shutil.move(pdf_filename, self.pdf_filename)
+        if self.ghostscript and not self.args['--keep-tmpdir']:
+            for page in pages:
+                if processed[page]:
+                    self._remove_page(self._tmp_path(processed[page]))
+                    self._remove(self._tmp_path('%s.pdf' % processed[page]))
+        return processed
+
+    def linearize(self, pdf_filename):
+        """
+            Rewrite pdf_filename as the final PDF, linearized ("fast web
+            view") with qpdf so a viewer can show the first page without
+            reading the whole file.  Without qpdf it's just renamed.
+        """
+        out_filename = '%s.part' % self.pdf_filename
+        with self.tracer.stage('linearize'):
+            try:
+                self.cmd(['qpdf', '--linearize', pdf_filename, out_filename])
+            except runner.CommandError as e:
+                # qpdf exits with 3 if it only had warnings
+                if e.returncode != 3 or not os.path.exists(out_filename):
+                    logging.warning("Could not linearize %s (%s), leaving it as it is" % (self.pdf_filename, e))
+                    self._remove(out_filename)
+                    shutil.move(pdf_filename, self.pdf_filename)
+                    return
+        os.rename(out_filename, self.pdf_filename)
+        os.remove(pdf_filename)
+
+    def cleanup(self, processed):
+        """
+            Remove the original scans, what was made from them for the PDF
+            (see :meth:`_artifact`), and the journal, once the PDF has been
+            written.  Until then, they're what an interrupted run resumes from.
+
+            :param processed: dict of scanned page name to the result of :meth:`process_page`
+        """
+        if self.args['--keep-tmpdir']:
+            return
+        for page in sorted(processed):
+            self._remove_page(self._tmp_path(page))
+            if processed[page]:
+                self._remove(self._artifact(processed[page]))
+        if self.journal is not None:
+            self.journal.remove()
+        # IF we did the scan, then remove the tmp dir too
+        if self.args['scan']:
+            os.rmdir(self.tmp_dir)
+
+    def _remove(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def _remove_page(self, filename):
+        """
+            Remove a page along with its saved analysis pyramid
+        """
+        self._remove(filename)
+        remove_pyramid(filename)
+
+    def _merge_with_gs(self, page_files, pdf_basename):
+        ps_filename = pdf_basename
+        ps_filename = ps_filename.replace(".pdf", ".ps")
+
+        # The pages go in a file instead of on the command line, which a
+        # long enough batch would overflow
+        args_filename = os.path.join(self.tmp_dir, 'pages.args')
+        with open(args_filename, 'w') as f:
+            for p in page_files:
+                f.write('"%s"\n' % self._tmp_path('%s.pdf' % p))
 
         # Create a single ps file using gs
         c = ['gs', 
@@ -285,9 +736,10 @@ class ScanPdf(object):
                 '-dBATCH',
                 '-dSAFER',
                 '-sOutputFile=%s' % pdf_basename,
-                ' '.join(['%s.pdf' % p for p in page_files]),
+                '@%s' % args_filename,
                 ]
         self.cmd(c)
+        os.remove(args_filename)
         c = ['epstopdf',
                 ps_filename,
                 ]
@@ -322,105 +774,325 @@ class ScanPdf(object):
                 #]
         
         #self.cmd(c)
-        shutil.move(pdf_basename, self.pdf_filename)
-        if not self.args['--keep-tmpdir']:
-            for filename in page_files:
-                os.remove(filename)
-           
-        # IF we did the scan, then remove the tmp dir too
-        if self.args['scan'] and not self.args['--keep-tmpdir']:
-            os.rmdir(self.tmp_dir)
-        os.chdir(cwd)
         
 
     def convert_to_bw(self, pages):
-        new_pages = []
-        for i, page in enumerate(pages):
-            filename = os.path.join(self.tmp_dir, page)
-            logging.info("Checking if %s is bw..." % filename)
-            if self._is_color(filename):
-                new_pages.append(page)
-                logging.info("No, %s is color..." % filename)
-                self.bw_pages[page] = False
-            else: # COnvert to BW
-                bw_page = self._page_to_bw(filename)
-                logging.info("Yes, %s converted to bw..." % filename)
-                new_pages.append(bw_page)
-                self.bw_pages[bw_page] = True
-        return new_pages
+        self.prefetch_colors([self._tmp_path(page) for page in pages])
+        return self.run_parallel(self._convert_page_to_bw, pages)
+
+    @traced('bw')
+    def _convert_page_to_bw(self, page):
+        filename = self._tmp_path(page)
+        logging.info("Checking if %s is bw..." % filename)
+        if self._is_color(filename):
+            logging.info("No, %s is color..." % filename)
+            self.bw_pages[page] = False
+            return page
+        else: # COnvert to BW
+            bw_page = self._page_to_bw(page)
+            logging.info("Yes, %s converted to bw..." % filename)
+            self.bw_pages[bw_page] = True
+            return bw_page
 
-            
     def _page_to_bw(self, page):
         out_page = "%s_bw" % page
-        cwd = os.getcwd()
-        os.chdir(self.tmp_dir)
-
-        cmd = "convert %s +dither -density %s -colors 16 -colors 4 -colorspace gray -normalize %s_bw" % (page, self.dpi, page)
-        out = self.cmd(cmd)
+        filename = self._tmp_path(page)
+        self._backend_for(filename).to_bw(filename, self._tmp_path(out_page))
         # Remove the old file
         if not self.args['--keep-tmpdir']:
-            os.remove(page)
-        os.chdir(cwd)
+            self._remove_page(filename)
         return out_page
 
-    def _is_color(self, filename):
+    def remove_blanks(self, pages):
+        self.prefetch_blanks([self._tmp_path(page) for page in pages])
+        pages = self.run_parallel(self._remove_if_blank, pages)
+        return [page for page in pages if page]
+
+    @traced('blank')
+    def _remove_if_blank(self, page):
+        """
+            Returns page, or None if it was blank (in which case the file is removed)
+        """
+        filename = self._tmp_path(page)
+        logging.info("Checking if %s is blank..." % filename)
+        if not self.is_blank(filename):
+            return page
+        logging.info("  page %s is blank, removing..." % page)
+        self._remove_page(filename)
+        return None
+
+    @traced('page')
+    def process_page(self, page):
+        """
+            Run a single scanned page through the whole per-page chain:
+            a quick blank check of the scan, crop, blank removal (if the
+            quick check couldn't tell), color/B&W conversion,
+            post-processing and encoding (see :meth:`_output_page`).
+
+            :param page: Page name relative to the tmp dir
+            :returns: The final page name to pass to :meth:`run_merge`, or None if the page was blank
         """
-            Run the following command from ImageMagick:
-
-            ::
-                
-                 convert holi.pdf -colors 8 -depth 8 -format %c histogram:info:- 
-
-            This outputs something like the following:
-            ::
-
-                  10831: ( 24, 26, 26,255) #181A1A srgba(24,26,26,1)
-                  4836: ( 55, 87, 79,255) #37574F srgba(55,87,79,1)
-                  6564: ( 77,138,121,255) #4D8A79 srgba(77,138,121,1)
-                  4997: ( 86, 96, 93,255) #56605D srgba(86,96,93,1)
-                  7005: ( 92,153,139,255) #5C998B srgba(92,153,139,1)
-                  2479: (143,118,123,255) #8F767B srgba(143,118,123,1)
-                  8870: (169,176,170,255) #A9B0AA srgba(169,176,170,1)
-                442906: (254,254,254,255) #FEFEFE srgba(254,254,254,1)
-                  1053: (  0,  0,  0,255) #000000 black
-                484081: (255,255,255,255) #FFFFFF white
- 
-        """
-        cmd = "convert %s -density %s -adaptive-resize 35%% -colors 8 -depth 8 -format %%c histogram:info:-" % (filename, int(self.dpi/3))
-        out = self.cmd(cmd)
-        mLine = re.compile(r"""\s*(?P<count>\d+):\s*\(\s*(?P<R>\d+),\s*(?P<G>\d+),\s*(?P<B>\d+).+""")
-        colors = []
-        for line in out.splitlines():
-            matchLine = mLine.search(str(line))
-            if matchLine:
-                logging.debug("Found RGB values")
-                color = [int(x) for x in (matchLine.group('count'),
-                             matchLine.group('R'),
-                             matchLine.group('G'),
-                             matchLine.group('B'),
-                             )
-                        ]
-                colors.append(color)
-        # sort
-        colors.sort(reverse=True, key = lambda x: x[0])
-        logging.debug(colors)
-        is_color = False
-        logging.debug(colors)
-        for color in colors:
-            # Calculate the mean differences between the RGB components
-            # Shades of grey will be very close to zero in this metric...
-            diff = float(sum([abs(color[2]-color[1]),
-                         abs(color[3]-color[1]),
-                         abs(color[3]-color[2]),
-                         ]))/3
-            if diff > 30:
-                is_color = True
-                logging.debug("Found color, diff is %s" % diff)
+        entry = self._journaled(page)
+        if entry and entry['stage'] == 'blank':
+            logging.info("  page %s was blank last time, skipping..." % page)
+            return None
+        if entry and entry['stage'] == 'encoded' and os.path.exists(self._artifact(entry['artifact'])):
+            logging.info("Page %s was already done" % page)
+            return entry['artifact']
+
+        if self.staging is not None:
+            # Don't let the page's files be moved to disk while we're working on them
+            self.staging.begin(page)
+        try:
+            if self.cache is None:
+                result = self._process_page(page)
             else:
-                logging.debug("No color, diff is %s" % diff)
-        return is_color
+                result = self._process_cached_page(page)
+
+            if self.journal:
+                if result is None:
+                    self.journal.record(page, 'blank')
+                else:
+                    sync_file(self._artifact(result))
+                    self.journal.record(page, 'encoded', result)
+        finally:
+            # Anything prefetched for the page that didn't get used (because it was blank or cached)
+            self._forget(page)
+            if self.staging is not None:
+                self.staging.end(page)
+        return result
+
+    def _journaled(self, page):
+        """
+            :returns: The journal entry of page if an earlier run already finished it, otherwise None
+        """
+        entry = self.journal.get(page) if self.journal else None
+        if entry and entry['stage'] in ('blank', 'encoded'):
+            return entry
+        return None
+
+    def _artifact(self, page):
+        """
+            The file :meth:`_output_page` produces for page
+        """
+        if self.ghostscript:
+            return self._tmp_path('%s.pdf' % page)
+        return self._tmp_path('%s.stream' % page)
+
+    def _process_cached_page(self, page):
+        """
+            :meth:`process_page`, but using the cached blank decision and encoded
+            stream for the raw page when we have them.  The blank decision and
+            the stream are cached separately, so changing --keep-blanks or
+            --post-process still reuses whatever it can.
+        """
+        filename = self._tmp_path(page)
+        digest = self.cache.digest(filename)
+        analysis_params = {'dpi': self.dpi, 'analysis': self.analysis, 'blank_threshold': self.blank_threshold}
+        if self.backend.quick_blank_check:
+            # What the scan itself is checked with decides which pages are dropped too
+            analysis_params['raw_blank'] = [analysis.RAW_BLANK_BORDER, analysis.RAW_CONTENT_BORDER,
+                                            analysis.RAW_BLANK_MARGIN]
+        analysis_key = self.cache.key(digest, 'analysis', analysis_params)
+        encode_key = self.cache.key(digest, 'encode',
+                                    {'dpi': self.dpi, 'analysis': self.analysis, 'post_process': self.post_process})
+
+        if not self.keep_blanks:
+            info = self.cache.get_info(analysis_key)
+            if info and info['blank']:
+                logging.info("  page %s is blank (cached), skipping..." % page)
+                return None
+        if self.cache.get_file(encode_key, self._artifact(page)):
+            logging.info("Using cached %s" % page)
+            return page
+
+        result = self._process_page(page)
+        if not self.keep_blanks:
+            self.cache.put_info(analysis_key, {'blank': result is None})
+        if result is not None:
+            self.cache.put_file(encode_key, self._artifact(result))
+        return result
+
+    def _process_page(self, page):
+        check_blank = not self.keep_blanks
+        raw = None
+        if self.analysis == 'numpy':
+            try:
+                # Saved, so it's still there if the page has to be done again
+                raw = Pyramid.for_page(self._tmp_path(page), self.dpi)
+            except ValueError as e:
+                logging.debug("Can't read %s in-process (%s)" % (page, e))
+        if check_blank and self.backend.quick_blank_check:
+            verdict = self._raw_blank_verdict(page, raw)
+            if verdict == analysis.BLANK:
+                return None
+            # Only the borderline ones need checking again once they're cropped
+            check_blank = verdict == analysis.BORDERLINE
+        page = self._crop_page(page, raw)
+        if self.analysis == 'numpy':
+            try:
+                return self._process_decoded_page(page, check_blank)
+            except ValueError as e:
+                logging.debug("Can't read %s in-process (%s), using ImageMagick" % (page, e))
+        if check_blank:
+            page = self._remove_if_blank(page)
+            if not page:
+                return None
+        page = self._convert_page_to_bw(page)
+        if self.post_process:
+            page = self._postprocess_page(page)
+        self._output_page(page)
+        return page
 
+    @traced('prefilter')
+    def _raw_blank_verdict(self, page, pyramid):
+        """
+            :func:`analysis.raw_blank_verdict` of the scanned page, before anything's been done to it
+        """
+        filename = self._tmp_path(page)
+        verdict = self._backend_for(filename).raw_blank_verdict(filename, pyramid)
+        if verdict == analysis.BLANK:
+            # The scan itself stays until the PDF is written, see cleanup()
+            logging.info("  page %s is blank, skipping..." % page)
+        else:
+            logging.debug("  page %s is %s" % (page, verdict))
+        return verdict
+
+    @traced('analyze')
+    def _process_decoded_page(self, name, check_blank=None):
+        """
+            The rest of :meth:`process_page` after cropping, with the page
+            decoded just once into a :class:`page.Page`.  The B&W version is
+            never written to disk, it goes straight to the encoder (unless we
+            need to post-process it).
+
+            :param check_blank: Whether to check if it's blank, defaults to not --keep-blanks
+        """
+        if check_blank is None:
+            check_blank = not self.keep_blanks
+        filename = self._tmp_path(name)
+        page = Page(filename, self.dpi)
+        if check_blank:
+            logging.info("Checking if %s is blank..." % filename)
+            if page.is_blank(self.blank_threshold):
+                logging.info("  page %s is blank, removing..." % name)
+                page.release()
+                self._remove_page(filename)
+                return None
 
+        logging.info("Checking if %s is bw..." % filename)
+        if page.is_color():
+            logging.info("No, %s is color..." % filename)
+        else:
+            page.convert_to_bw()
+            logging.info("Yes, %s converted to bw..." % filename)
+        self.bw_pages[name] = page.is_bw
+
+        if self.post_process and self._needs_postprocess(page):
+            if page.is_bw:
+                page.save(filename)
+            page.release()
+            name = self._postprocess_page(name)
+            self._output_page(name)
+        elif page.is_bw:
+            self._output_page(name, page.pixels)
+        else:
+            # Unchanged, so convert can read the cropped page as is
+            page.release()
+            self._output_page(name)
+        return name
+
+    def _tmp_path(self, page):
+        if self.staging is not None:
+            return self.staging.path(page)
+        return os.path.normpath(os.path.join(self.tmp_dir, page))
+
+    def _run_job(self, job):
+        func, item = job
+        if self.profiler is not None:
+            func = self.profiler.wrap(func)
+        try:
+            return False, func(item)
+        except SystemExit as e:
+            # Don't let _error kill a worker thread; re-raise it in the main thread instead
+            return True, e.code
+
+    def submit(self, func, item):
+        """
+            Queue func(item) on the worker pool (or just run it if there is no
+            pool).  Pass the returned job to :meth:`wait` to get the result.
+        """
+        if self.pool is None:
+            return self._run_job((func, item))
+        return self.pool.apply_async(self._run_job, ((func, item),))
+
+    def wait(self, job):
+        if not isinstance(job, tuple):
+            job = job.get()
+        failed, result = job
+        if failed:
+            sys.exit(result)
+        return result
+
+    def run_parallel(self, func, items):
+        """
+            Apply func to every item, using the worker pool if we have more
+            than one job.  The results are returned in the same order as items.
+        """
+        jobs = [self.submit(func, item) for item in items]
+        return [self.wait(job) for job in jobs]
+
+    def imap(self, func, items):
+        """
+            Like :meth:`run_parallel`, but yields (item, func(item)) in the
+            order of items as the results come in.  Only a couple of items
+            per worker are in flight at any time: the next one isn't taken
+            from items (which can itself be a generator) until the oldest
+            one's result has been consumed, so a slow consumer holds up the
+            producer instead of letting work pile up.
+        """
+        window = 2 * self.jobs if self.pool is not None else 1
+        pending = deque()
+        for item in items:
+            pending.append((item, self.submit(func, item)))
+            if len(pending) >= window:
+                item, job = pending.popleft()
+                yield item, self.wait(job)
+        while pending:
+            item, job = pending.popleft()
+            yield item, self.wait(job)
+
+    def start_pool(self):
+        """
+            Start a worker pool, unless we've been given one to share (by ``scanpdf serve``)
+        """
+        if self.jobs > 1 and self.pool is None:
+            # The heavy lifting happens in child processes (convert, unpaper), so threads are enough
+            self.pool = ThreadPool(self.jobs)
+            self.own_pool = True
+
+    def stop_pool(self):
+        if self.pool is not None and self.own_pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.own_pool = False
+
+    def _is_color(self, filename):
+        """
+            Returns True if the page in filename is in color, using the --backend
+        """
+        if ('color', filename) in self.prefetched:
+            return self.prefetched.pop(('color', filename))
+        return self._backend_for(filename).is_color(filename)
+
+    def prefetch_colors(self, filenames):
+        """
+            Do the ImageMagick color check of all of filenames up front, in a
+            single convert per --batch-size files, for :meth:`_is_color` to use.
+        """
+        filenames = [f for f in filenames if self._needs_imagemagick(f)]
+        self._prefetch('color', self.imagemagick.all_colors(filenames))
 
     def get_options(self, argv):
         """
@@ -467,6 +1139,48 @@ class ScanPdf(object):
         self.blank_threshold = float(argv['--blank-threshold'])
         assert(self.blank_threshold >= 0 and self.blank_threshold <= 1.0)
         self.post_process = argv['--post-process']
+        self.stream = argv['--stream'] and argv['scan'] and argv['pdf']
+
+        self.ghostscript = argv['--ghostscript']
+        self.incremental = argv['--incremental']
+        if self.incremental and self.ghostscript:
+            logging.warning("Ghostscript merges the pages at the end, ignoring --incremental")
+            self.incremental = False
+        self.timeout = float(argv['--timeout'])
+        self.batch_size = int(argv['--batch-size'])
+        assert(self.batch_size >= 1)
+        assert(self.timeout >= 0)
+        if argv['--profile']:
+            self.profiler = Profiler(argv['--profile'])
+        if argv['--trace'] or self.profiler:
+            self.tracer = Tracer(argv['--trace'], self.profiler)
+        if argv['--cache-dir']:
+            if self.ghostscript:
+                logging.warning("The cache only works with the built-in PDF writer, ignoring --cache-dir")
+            else:
+                self.cache = PageCache(argv['--cache-dir'], int(argv['--cache-size']) * 1024 * 1024)
+        self.analysis = argv['--analysis'] or argv['--backend']
+        if self.analysis not in BACKENDS:
+            self._error("Unknown backend %s, it has to be one of %s" % (self.analysis, ', '.join(sorted(BACKENDS))))
+        missing = BACKENDS[self.analysis].missing()
+        if missing:
+            self._error("The %s backend needs %s" % (self.analysis, missing))
+
+        if argv['--jobs']:
+            self.jobs = int(argv['--jobs'])
+        else:
+            self.jobs = multiprocessing.cpu_count()
+        assert(self.jobs >= 1)
+        if self.jobs > 1:
+            # Each page gets its own convert, so don't let ImageMagick oversubscribe the cores as well
+            os.environ.setdefault('MAGICK_THREAD_LIMIT', '1')
+
+        ram_budget = int(argv['--ram-budget']) * 1024 * 1024
+        if ram_budget and self.args['pdf']:
+            if os.path.isdir(argv['--ram-dir']):
+                self.staging = Staging(self.tmp_dir, argv['--ram-dir'], ram_budget)
+            else:
+                logging.warning("No %s, keeping the intermediate files in the tmp dir" % argv['--ram-dir'])
 
     def go(self, argv):
         """ 
@@ -475,54 +1189,207 @@ class ScanPdf(object):
             #. Get the options
             #. Create the temp dir
             #. Run scanadf
+            #. Run each page through crop/bw/blank/post-process/convert in the worker pool
+               (with --stream, each page starts as soon as scanadf has written it)
+            #. Add each page to the PDF as soon as it's done (see :meth:`assemble`)
+            #. Remove the original scans
+
+            Progress is kept in a :class:`journal.Journal` in the temp dir, so
+            if this gets interrupted, running it again picks up where it left off.
         """
         # Read the command line options
         self.get_options(argv)
         logging.info("Temp dir: %s" % self.tmp_dir)
-        if self.args['scan']:
-            self.run_scan()
-        
-        if self.args['pdf']:
-            # Now, convert the files to ps
-            pages = self.get_pages()
-            logging.debug( pages )
-            if self.args['--face-up']:
-                pages = self.reorder_face_up(pages)
-            
-            logging.debug( pages )
-
-            # Crop the pages
-            pages = self.run_crop(pages)
-
-            # Now, check if color or bw
-            pages = self.convert_to_bw(pages)
-            logging.debug(pages)
-
-            # Run blanks
-            if not self.keep_blanks:
-                no_blank_pages = []
-                for i,page in enumerate(pages):
-                    filename = os.path.join(self.tmp_dir, page)
-                    logging.info("Checking if %s is blank..." % filename)
-                    if not self.is_blank(filename):
-                        no_blank_pages.append(page)
-                    else:
-                        logging.info("  page %s is blank, removing..." % i)
-                        os.remove(filename)
-                pages = no_blank_pages
-                    
-            logging.debug( pages )
-
-            if self.post_process:
-                pages = self.run_postprocess(pages)
-                
-            self.run_convert(pages)
+        if self.profiler is not None:
+            self.profiler.start()
+
+        try:
+            processed = {}
+            if self.args['pdf']:
+                self.journal = Journal(self.tmp_dir, self._journal_params())
+                self.start_pool()
+            try:
+                if self.stream:
+                    processed = self.assemble(self.run_scan_and_process())
+                else:
+                    if self.args['scan']:
+                        self.run_scan()
+                    if self.args['pdf']:
+                        pages = self.get_pages()
+                        if self.incremental:
+                            # Start from the first page of the PDF, so it's in the partial PDF soonest
+                            pages = self.partial_order(pages)
+                        processed = self.assemble(self.imap(self.process_page, self._prefetching(pages)))
+            finally:
+                self.stop_pool()
+
+            if self.args['pdf']:
+                self.cleanup(processed)
+        finally:
+            if self.staging is not None:
+                self.staging.close(keep=self.args['--keep-tmpdir'])
+            self.tracer.close()
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler.save()
+                print(self.profiler.report())
+
+    def _journal_params(self):
+        """
+            The options that change what gets produced for each page
+        """
+        return {'dpi': self.dpi,
+                'analysis': self.analysis,
+                'blank_threshold': self.blank_threshold,
+                'keep_blanks': self.keep_blanks,
+                'post_process': self.post_process,
+                'ghostscript': self.ghostscript,
+                }
         
+def serve(args):
+    """
+        Run the ``scanpdf serve`` daemon until it's killed
+    """
+    level = logging.DEBUG if args['--debug'] else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s %(message)s')
+    if args['--jobs']:
+        jobs = int(args['--jobs'])
+    else:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1:
+        os.environ.setdefault('MAGICK_THREAD_LIMIT', '1')
+    server = Server(args['--socket'], ScanPdf, jobs)
+    # Clean up the socket on a plain kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.start()
+    except (ServerError, socket.error) as e:
+        print("ERROR: %s" % e)
+        sys.exit(-1)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def client(args):
+    """
+        ``scanpdf submit`` and ``scanpdf status``: talk to the daemon
+    """
+    try:
+        if args['status']:
+            for status in request(args['--socket'], {'cmd': 'status', 'job': args['<job>']}):
+                print(_job_line(status))
+            return
+        job_args = dict(args)
+        job_args['submit'] = False
+        # The daemon doesn't run in our directory
+        for name in ('<pdffile>', '--tmpdir', '--cache-dir', '--trace', '--profile'):
+            if job_args[name]:
+                job_args[name] = os.path.abspath(job_args[name])
+        env = dict((k, v) for k, v in os.environ.items() if k.startswith('SCANBD_'))
+        status = request(args['--socket'], {'cmd': 'submit', 'args': job_args, 'env': env})
+        print(_job_line(status))
+        if not args['--wait']:
+            return
+        while status['state'] in ('queued', 'running'):
+            time.sleep(1)
+            status, = request(args['--socket'], {'cmd': 'status', 'job': status['job']})
+        print(_job_line(status))
+        if status['state'] == 'failed':
+            sys.exit(-1)
+    except ServerError as e:
+        print("ERROR: %s" % e)
+        sys.exit(-1)
+
+def devices(args):
+    """
+        ``scanpdf devices``: scan from every device in the config file (or
+        just the ones named) at the same time, into a PDF each
+    """
+    level = logging.DEBUG if args['--debug'] else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s %(message)s')
+    try:
+        profiles = load_profiles(args['<config>'])
+    except SchedulerError as e:
+        print("ERROR: %s" % e)
+        sys.exit(-1)
+    if args['<device>']:
+        unknown = set(args['<device>']) - set(p['name'] for p in profiles)
+        if unknown:
+            print("ERROR: No device %s in %s" % (', '.join(sorted(unknown)), args['<config>']))
+            sys.exit(-1)
+        profiles = [p for p in profiles if p['name'] in args['<device>']]
+    if args['--jobs']:
+        jobs = int(args['--jobs'])
+    else:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1:
+        os.environ.setdefault('MAGICK_THREAD_LIMIT', '1')
+    results = Scheduler(profiles, ScanPdf, args, jobs).run()
+    for profile in profiles:
+        error = results.get(profile['name'])
+        print('%s: %s' % (profile['name'], 'failed (%s)' % error if error else 'done'))
+    if any(results.values()):
+        sys.exit(-1)
+
+def batch(args):
+    """
+        ``scanpdf batch``: make a PDF in --outdir from each scan directory
+        that doesn't have one yet, all on one pool
+    """
+    level = logging.DEBUG if args['--debug'] else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s %(message)s')
+    outdir = os.path.expanduser(args['--outdir'])
+    if not os.path.isdir(outdir):
+        print("ERROR: Output directory %s does not exist!" % outdir)
+        sys.exit(-1)
+    try:
+        pending = find_pending(args['<dir>'], outdir)
+    except SchedulerError as e:
+        print("ERROR: %s" % e)
+        sys.exit(-1)
+    if args['--jobs']:
+        jobs = int(args['--jobs'])
+    else:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1:
+        os.environ.setdefault('MAGICK_THREAD_LIMIT', '1')
+    scheduler = Batch(pending, ScanPdf, args, jobs)
+    results = scheduler.run()
+    for directory, pdf, pages in pending:
+        error = results.get(directory)
+        print('%s: %s' % (directory, 'failed (%s)' % error if error else pdf))
+    documents, pages, elapsed = scheduler.throughput()
+    print('%d documents, %d pages in %.1fs (%.1f pages/min)' %
+          (documents, pages, elapsed, 60.0 * pages / elapsed if elapsed else 0.0))
+    if any(results.values()):
+        sys.exit(-1)
+
+def _job_line(status):
+    line = 'job %(job)s: %(state)s' % status
+    if status['pdf']:
+        line += ' %s' % status['pdf']
+    if status['error']:
+        line += ' (%s)' % status['error']
+    return line
+
 def main():
     args = docopt.docopt(__doc__, version='Scan PDF %s' % __version__ )
+    if args['serve']:
+        return serve(args)
+    if args['submit'] or args['status']:
+        return client(args)
+    if args['devices']:
+        return devices(args)
+    if args['batch']:
+        return batch(args)
     script = ScanPdf()
     print(args)
-    script.go(args)
+    try:
+        script.go(args)
+    except runner.CommandError as e:
+        print (e.output)
+        script._error(str(e))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,366 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Scanning from several devices at once.
+
+    The devices are described in an ini style config file, one section per
+    device (every key is optional except device)::
+
+        [fujitsu]
+        device = fujitsu:ScanSnap S1500:1234
+        source = ADF Duplex
+        mode = Color
+        dpi = 300
+        options = --page-height 876.695 -y 876.695 --brightness=25
+        tmpdir = /tmp/scans
+        pdf = ~/scans/fujitsu_%Y%m%d_%H%M%S.pdf
+
+    Every device scans at the same time into its own tmp dir, and their pages
+    are processed as they come in on one shared :class:`FairPool`, which takes
+    turns between the devices so a long batch on one doesn't hold up the others.
+
+    :class:`Batch` does the same for scans that are already on disk (``scanpdf
+    batch``), turning a backlog of scan directories into PDFs on one pool.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import deque
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class Task(object):
+    """
+        A function queued on a :class:`FairPool`; :meth:`get` waits for its result
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except BaseException as e:
+            self.error = e
+        self.done.set()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Lane(object):
+    """
+        One device's queue on a :class:`FairPool`.  It has the bit of the
+        ThreadPool interface that ScanPdf uses, so it can be given to a
+        ScanPdf as its pool.
+    """
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def apply_async(self, func, args=()):
+        return self.pool.put(self.name, Task(func, args))
+
+
+class FairPool(object):
+    """
+        A fixed number of worker threads shared by several lanes.  Every
+        lane has its own queue, and the workers go round the lanes taking
+        one task from each in turn.
+    """
+
+    def __init__(self, workers):
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.turns = deque()  # Lanes with work waiting, in the order they get served
+        self.closed = False
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def lane(self, name):
+        with self.cond:
+            self.queues.setdefault(name, deque())
+        return Lane(self, name)
+
+    def put(self, name, task):
+        with self.cond:
+            if self.closed:
+                raise SchedulerError("Pool is closed")
+            queue = self.queues.setdefault(name, deque())
+            if not queue:
+                self.turns.append(name)
+            queue.append(task)
+            self.cond.notify()
+        return task
+
+    def _next(self):
+        """
+            Take the next task, from the lane whose turn it is
+        """
+        with self.cond:
+            while not self.turns:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            name = self.turns.popleft()
+            queue = self.queues[name]
+            task = queue.popleft()
+            if queue:
+                # Back of the line for this lane's next task
+                self.turns.append(name)
+            return task
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                break
+            task.run()
+
+    def close(self):
+        """
+            Let the workers exit once everything queued is done
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+
+def load_profiles(filename):
+    """
+        Read the device profiles from the config file filename
+
+        :returns: list of dicts, one per device, in the order they're in the file
+    """
+    config = RawConfigParser()
+    if not config.read(filename):
+        raise SchedulerError("Can't read device config %s" % filename)
+    profiles = []
+    for section in config.sections():
+        profile = dict(config.items(section))
+        profile['name'] = section
+        if 'device' not in profile:
+            raise SchedulerError("No device given for [%s] in %s" % (section, filename))
+        profiles.append(profile)
+    return profiles
+
+
+class Scheduler(object):
+    """
+        Scan and process a batch from each of profiles at the same time
+
+        :param factory: Makes the object to scan each device with, usually :class:`scanpdf.ScanPdf`
+        :param args: The docopt options to start each device's options from
+        :param jobs: Number of pages processed at once, across all the devices
+    """
+
+    def __init__(self, profiles, factory, args, jobs):
+        self.profiles = profiles
+        self.factory = factory
+        self.args = args
+        self.pool = FairPool(jobs)
+        self.results = {}
+
+    def device_args(self, profile, stamp):
+        """
+            The options for scanning with profile: the common options, with
+            the device's own dpi, tmp dir and PDF filename.  Pages are always
+            processed as they are scanned (--stream).
+        """
+        args = dict(self.args)
+        name = profile['name']
+        args.update({'scan': True, 'pdf': True, '--stream': True})
+        for key in ('devices', 'batch', 'serve', 'submit', 'status'):
+            args[key] = False
+        if 'dpi' in profile:
+            args['--dpi'] = profile['dpi']
+        tmp_root = os.path.expanduser(profile.get('tmpdir', '/tmp'))
+        args['--tmpdir'] = os.path.join(tmp_root, '%s_%s' % (stamp, name))
+        pdf = profile.get('pdf', '%s_%%Y%%m%%d_%%H%%M%%S.pdf' % name)
+        args['<pdffile>'] = os.path.abspath(os.path.expanduser(time.strftime(pdf, time.localtime())))
+        for option in ('--trace', '--profile'):
+            if args.get(option):
+                root, ext = os.path.splitext(args[option])
+                args[option] = '%s_%s%s' % (root, name, ext)
+        return args
+
+    def run_job(self, name, args, profile=None):
+        """
+            Run one ScanPdf with args, on its own lane of the pool
+        """
+        script = self.factory()
+        if profile is not None:
+            script.profile = profile
+        script.pool = self.pool.lane(name)
+        try:
+            script.go(args)
+            self.results[name] = None
+            logging.info("%s: wrote %s" % (name, args['<pdffile>']))
+        except SystemExit as e:
+            self.results[name] = getattr(script, 'error', None) or 'exit status %s' % e.code
+        except Exception as e:
+            logging.exception("%s failed" % name)
+            self.results[name] = str(e)
+
+    def run_jobs(self, jobs, limit=None):
+        """
+            Run all of jobs, (name, args, profile) tuples, at the same time (or
+            at most limit at a time), and then shut the pool down
+        """
+        slots = threading.Semaphore(limit or len(jobs) or 1)
+
+        def run_one(*job):
+            try:
+                self.run_job(*job)
+            finally:
+                slots.release()
+        threads = []
+        for job in jobs:
+            slots.acquire()
+            t = threading.Thread(target=run_one, args=job)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.pool.close()
+        self.pool.join()
+
+    def run(self):
+        """
+            :returns: dict of device name to None if it went fine, or what went wrong
+        """
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime())
+        self.run_jobs([(profile['name'], self.device_args(profile, stamp), profile) for profile in self.profiles])
+        return self.results
+
+
+# A scanned page, as opposed to the files we make from it
+RAW_PAGE_RE = re.compile(r'^page_\d+$')
+
+
+def count_pages(directory):
+    return len([f for f in os.listdir(directory) if RAW_PAGE_RE.match(f)])
+
+
+def find_pending(dirs, outdir):
+    """
+        Find the scan directories that still need a PDF made.  Each of dirs
+        is either a scan directory itself (it has ``page_NNNN`` files in it),
+        or holds scan directories.  Once a directory's PDF is in outdir it's
+        done, even if its scans were kept (--keep-tmpdir).
+
+        :returns: list of (scan directory, PDF filename, number of pages)
+        :raises SchedulerError: if two of the directories would make the same PDF
+    """
+    candidates = []
+    for directory in dirs:
+        if not os.path.isdir(directory):
+            raise SchedulerError("No directory %s" % directory)
+        if count_pages(directory):
+            candidates.append(directory)
+            continue
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and count_pages(path):
+                candidates.append(path)
+
+    pending, pdfs = [], {}
+    for directory in candidates:
+        directory = os.path.abspath(directory)
+        pdf = os.path.join(os.path.abspath(outdir), '%s.pdf' % os.path.basename(directory))
+        if pdf in pdfs:
+            if pdfs[pdf] == directory:
+                continue
+            raise SchedulerError("%s and %s would both be written to %s" % (pdfs[pdf], directory, pdf))
+        pdfs[pdf] = directory
+        if os.path.exists(pdf):
+            logging.info("%s is already done (%s)" % (directory, pdf))
+            continue
+        pending.append((directory, pdf, count_pages(directory)))
+    return pending
+
+
+class Batch(Scheduler):
+    """
+        Make a PDF from each of a backlog of scan directories, with all
+        their pages going through one shared pool.  A few documents are
+        worked on at once, and the pool takes turns between them, so the
+        workers always have pages to get on with even while one document is
+        being written out.
+
+        :param pending: (scan directory, PDF filename, number of pages) tuples from :func:`find_pending`
+    """
+
+    def __init__(self, pending, factory, args, jobs):
+        Scheduler.__init__(self, [], factory, args, jobs)
+        self.pending = pending
+        self.jobs = jobs
+        self.elapsed = 0.0
+
+    def batch_args(self, directory, pdf):
+        args = dict(self.args)
+        args.update({'pdf': True, '--tmpdir': directory, '<pdffile>': pdf})
+        for key in ('scan', 'batch', 'devices', 'serve', 'submit', 'status', '--stream'):
+            args[key] = False
+        name = os.path.basename(directory)
+        for option in ('--trace', '--profile'):
+            if args.get(option):
+                root, ext = os.path.splitext(args[option])
+                args[option] = '%s_%s%s' % (root, name, ext)
+        return args
+
+    def run(self):
+        """
+            :returns: dict of scan directory to None if it went fine, or what went wrong
+        """
+        start = time.time()
+        # Enough documents on the go for every worker to have pages from a couple of them
+        self.run_jobs([(directory, self.batch_args(directory, pdf), None) for directory, pdf, pages in self.pending],
+                      limit=max(2, self.jobs))
+        self.elapsed = time.time() - start
+        return self.results
+
+    def throughput(self):
+        """
+            :returns: (documents, pages, seconds) for the directories that went fine
+        """
+        done = [pages for directory, pdf, pages in self.pending if self.results.get(directory, True) is None]
+        return len(done), sum(done), self.elapsed
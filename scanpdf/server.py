@@ -0,0 +1,279 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    The ``scanpdf serve`` daemon, and the client side of ``scanpdf submit``
+    and ``scanpdf status``.
+
+    The daemon listens on a Unix socket, and runs the jobs it's sent one
+    after the other, so back-to-back button presses queue up instead of
+    fighting over the CPU.  Every job shares the same warm worker pool.
+    Only the user the daemon runs as can use the socket, since a job gets to
+    write wherever its options say.
+
+    Requests and replies are a single line of JSON each:
+
+    - ``{"cmd": "submit", "args": <docopt args>, "env": {...}}`` replies with the job's status
+    - ``{"cmd": "status", "job": <id or null for all>}`` replies with a list of job statuses
+"""
+
+import os
+import sys
+import errno
+import json
+import time
+import socket
+import struct
+import logging
+import threading
+from multiprocessing.dummy import Pool as ThreadPool
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+# Jobs that have finished are only remembered for so long
+MAX_FINISHED = 100
+# Linux's, for the Pythons that don't have it in socket
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class ServerError(Exception):
+    pass
+
+
+class Job(object):
+
+    def __init__(self, id, args, env):
+        self.id = id
+        self.args = args
+        self.env = env
+        self.state = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def status(self):
+        return {'job': self.id,
+                'state': self.state,
+                'pdf': self.args.get('<pdffile>'),
+                'error': self.error,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                }
+
+
+class Server(object):
+    """
+        :param factory: Makes the object to run each job with, usually :class:`scanpdf.ScanPdf`
+        :param jobs: Size of the worker pool the jobs share
+    """
+
+    def __init__(self, socket_path, factory, jobs=1):
+        self.socket_path = socket_path
+        self.factory = factory
+        self.jobs = jobs
+        self.queue = Queue()
+        self.all_jobs = []
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.pool = None
+        self.sock = None
+        self.running = False
+
+    def start(self):
+        """
+            Start listening and running jobs; call :meth:`serve_forever` next
+        """
+        if os.path.exists(self.socket_path):
+            try:
+                request(self.socket_path, {'cmd': 'status', 'job': None})
+            except ServerError:
+                # Left over from a daemon that didn't exit cleanly
+                os.remove(self.socket_path)
+            else:
+                raise ServerError("scanpdf is already serving on %s" % self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Nobody else gets to connect, not even between the bind and a chmod
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(5)
+        if self.jobs > 1:
+            self.pool = ThreadPool(self.jobs)
+        self.running = True
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+        logging.info("Serving on %s" % self.socket_path)
+
+    def serve_forever(self):
+        try:
+            while self.running:
+                try:
+                    conn, address = self.sock.accept()
+                except socket.error as e:
+                    if not self.running:
+                        break
+                    if e.args and e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                t = threading.Thread(target=self._handle, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+            Stop taking requests.  Whatever job is running gets to finish.
+        """
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        self.queue.put(None)
+
+    def _handle(self, conn):
+        try:
+            f = conn.makefile('rwb')
+            message = json.loads(f.readline().decode('utf-8'))
+            try:
+                uid = peer_uid(conn)
+                if uid is not None and uid != os.getuid():
+                    raise ServerError("Only uid %d can use this scanpdf serve, not %d" % (os.getuid(), uid))
+                reply = {'ok': True, 'result': self.dispatch(message)}
+            except (ServerError, KeyError) as e:
+                reply = {'ok': False, 'error': str(e)}
+            f.write((json.dumps(reply) + '\n').encode('utf-8'))
+            f.flush()
+            f.close()
+        except (IOError, ValueError, socket.error) as e:
+            logging.warning("Bad request: %s" % e)
+        finally:
+            conn.close()
+
+    def dispatch(self, message):
+        if message['cmd'] == 'submit':
+            return self.submit(message['args'], message.get('env', {})).status()
+        if message['cmd'] == 'status':
+            return self.status(message.get('job'))
+        raise ServerError("Unknown request %s" % message['cmd'])
+
+    def submit(self, args, env):
+        with self.lock:
+            job = Job(self.next_id, args, env)
+            self.next_id += 1
+            self.all_jobs.append(job)
+            # Forget the oldest finished jobs
+            finished = [j for j in self.all_jobs if j.finished is not None]
+            for old in finished[:max(0, len(finished) - MAX_FINISHED)]:
+                self.all_jobs.remove(old)
+        if args.get('scan') and not args.get('--tmpdir'):
+            # Jobs can come in quicker than the one second resolution of the default tmp dir name
+            stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime())
+            args['--tmpdir'] = os.path.join('/tmp', '%s_job%d' % (stamp, job.id))
+        logging.info("Queued job %d: %s" % (job.id, describe(args)))
+        self.queue.put(job)
+        return job
+
+    def status(self, job_id=None):
+        with self.lock:
+            jobs = [j.status() for j in self.all_jobs if job_id is None or j.id == int(job_id)]
+        if job_id is not None and not jobs:
+            raise ServerError("No job %s" % job_id)
+        return jobs
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.run_job(job)
+
+    def run_job(self, job):
+        job.state = 'running'
+        job.started = time.time()
+        logging.info("Starting job %d" % job.id)
+        script = self.factory()
+        script.pool = self.pool
+        script.environ = dict(os.environ)
+        script.environ.update(job.env)
+        try:
+            script.go(job.args)
+            job.state = 'done'
+        except SystemExit as e:
+            job.state = 'failed'
+            job.error = getattr(script, 'error', None) or 'exit status %s' % e.code
+        except Exception as e:
+            logging.exception("Job %d failed" % job.id)
+            job.state = 'failed'
+            job.error = str(e)
+        job.finished = time.time()
+        logging.info("Job %d %s in %.1fs" % (job.id, job.state, job.finished - job.started))
+
+
+def peer_uid(conn):
+    """
+        :returns: The uid of the process on the other end of the Unix socket conn, or None if we can't tell here
+    """
+    if not sys.platform.startswith('linux'):
+        # The socket's permissions are all there is
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+
+def describe(args):
+    """
+        :returns: what a job is going to do, for the log
+    """
+    what = [c for c in ('scan', 'pdf') if args.get(c)]
+    if args.get('pdf'):
+        what.append(args['<pdffile>'])
+    return ' '.join(what)
+
+
+def request(socket_path, message):
+    """
+        Send message to the daemon listening on socket_path
+
+        :returns: the result from the reply
+        :raises ServerError: if we can't talk to the daemon, or it turned the request down
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        f = sock.makefile('rwb')
+        f.write((json.dumps(message) + '\n').encode('utf-8'))
+        f.flush()
+        line = f.readline()
+        f.close()
+    except socket.error as e:
+        raise ServerError("Can't talk to scanpdf serve on %s: %s" % (socket_path, e))
+    finally:
+        sock.close()
+    if not line:
+        raise ServerError("No reply from scanpdf serve on %s" % socket_path)
+    reply = json.loads(line.decode('utf-8'))
+    if not reply['ok']:
+        raise ServerError(reply['error'])
+    return reply['result']
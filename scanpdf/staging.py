@@ -0,0 +1,147 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Keeping intermediate files in RAM.
+
+    The original scans (and the journal) always live in the tmp dir, but
+    everything made from them (``.crop``, ``_bw``, ``_unpaper``, ``.stream``,
+    per-page ``.pdf``, pyramids) goes to a directory on a RAM disk such as
+    ``/dev/shm``, for as long as it all fits in the budget.  Once it doesn't,
+    the pages that were used longest ago are moved to the tmp dir, and stay
+    there from then on.  Pages that are being worked on are never moved.
+"""
+
+import os
+import re
+import shutil
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+# What the files of a page start with
+PAGE_RE = re.compile(r'^(page_\d+)')
+
+
+def page_of(name):
+    """
+        :returns: The scanned page a file belongs to (``page_0001`` for ``page_0001.crop_bw``), or None
+    """
+    match = PAGE_RE.match(os.path.basename(name))
+    return match.group(1) if match else None
+
+
+class Staging(object):
+    """
+        :param disk_dir: The tmp dir, where the scans are
+        :param ram_dir: Where to make our own directory for the intermediate files
+        :param budget: Bytes of intermediate files to keep in RAM
+    """
+
+    def __init__(self, disk_dir, ram_dir, budget):
+        self.disk_dir = disk_dir
+        self.ram_dir = tempfile.mkdtemp(prefix='scanpdf_', dir=ram_dir)
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()  # Pages with files in RAM, least recently used first
+        self.active = {}  # Pages being worked on, and by how many
+        self.spilled = set()
+        logging.debug("Staging intermediate files in %s" % self.ram_dir)
+
+    def path(self, name):
+        """
+            Where the file name (relative to the tmp dir) is, or should be written
+        """
+        page = page_of(name)
+        disk_path = os.path.normpath(os.path.join(self.disk_dir, name))
+        with self.lock:
+            if page is None or page == os.path.basename(name) or page in self.spilled:
+                return disk_path
+            if os.path.exists(disk_path):
+                # Left on disk by an earlier run that was interrupted
+                return disk_path
+            self.recent.pop(page, None)
+            self.recent[page] = True
+        return os.path.join(self.ram_dir, os.path.basename(name))
+
+    def begin(self, name):
+        """
+            Keep the files of name's page in RAM until :meth:`end`
+        """
+        page = page_of(name)
+        with self.lock:
+            self.active[page] = self.active.get(page, 0) + 1
+        self.settle()
+
+    def end(self, name):
+        page = page_of(name)
+        with self.lock:
+            self.active[page] -= 1
+            if not self.active[page]:
+                del self.active[page]
+        self.settle()
+
+    def _sizes(self):
+        """
+            :returns: dict of page to bytes of its files in RAM
+        """
+        sizes = {}
+        for filename in os.listdir(self.ram_dir):
+            try:
+                size = os.path.getsize(os.path.join(self.ram_dir, filename))
+            except OSError:
+                # Just removed
+                continue
+            page = page_of(filename)
+            sizes[page] = sizes.get(page, 0) + size
+        return sizes
+
+    def settle(self):
+        """
+            Move pages to disk, least recently used first, until what's left fits in the budget
+        """
+        with self.lock:
+            sizes = self._sizes()
+            used = sum(sizes.values())
+            for page in list(self.recent):
+                if used <= self.budget:
+                    break
+                if page in self.active:
+                    continue
+                self._spill(page)
+                used -= sizes.get(page, 0)
+
+    def _spill(self, page):
+        logging.debug("Moving %s to disk" % page)
+        for filename in os.listdir(self.ram_dir):
+            if page_of(filename) != page:
+                continue
+            src = os.path.join(self.ram_dir, filename)
+            dst = os.path.join(self.disk_dir, filename)
+            # Copied under another name first, so there's never a half copied file under the real one
+            shutil.copy2(src, '%s.part' % dst)
+            os.rename('%s.part' % dst, dst)
+            os.remove(src)
+        del self.recent[page]
+        self.spilled.add(page)
+
+    def close(self, keep=False):
+        """
+            Remove the RAM directory, moving whatever is still in it to the tmp dir first if keep
+        """
+        with self.lock:
+            if keep:
+                for page in list(self.recent):
+                    self._spill(page)
+            shutil.rmtree(self.ram_dir, ignore_errors=True)
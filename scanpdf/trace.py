@@ -0,0 +1,182 @@
+# Copyright 2014 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    Tracing of the pipeline stages and every external command they run.
+
+    The trace is written as it goes, either in the Chrome trace event format
+    (load it in chrome://tracing or Perfetto), or as JSON lines if the file
+    name ends in ``.jsonl``.
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """
+        Records a complete event for each stage and command.  A Tracer
+        without a filename records nothing, so the pipeline can always call
+        into it.
+
+        Commands are tagged with the page and name of the innermost stage
+        running on the same thread.
+
+        :param profiler: Optional :class:`profiler.Profiler` to pass every event on to
+    """
+
+    def __init__(self, filename=None, profiler=None):
+        self.filename = filename
+        self.profiler = profiler
+        self.enabled = filename is not None or profiler is not None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread_ids = {}
+        self.pid = os.getpid()
+        self.f = None
+        self.count = 0
+        if filename is not None:
+            self.jsonl = filename.endswith('.jsonl')
+            self.f = open(filename, 'w')
+            if not self.jsonl:
+                self.f.write('[\n')
+
+    def _tid(self):
+        # Small thread numbers read better in the trace viewer than idents
+        ident = threading.current_thread().ident
+        if ident not in self.thread_ids:
+            self.thread_ids[ident] = len(self.thread_ids)
+        return self.thread_ids[ident]
+
+    def _write(self, event):
+        with self.lock:
+            if self.f is None:
+                return
+            if self.jsonl:
+                self.f.write(json.dumps(event, sort_keys=True) + '\n')
+            else:
+                if self.count:
+                    self.f.write(',\n')
+                self.f.write(json.dumps(event, sort_keys=True))
+            self.count += 1
+
+    def _event(self, name, category, start, end, args):
+        event = {'name': name,
+                 'cat': category,
+                 'ph': 'X',
+                 'ts': int(start * 1e6),
+                 'dur': int((end - start) * 1e6),
+                 'pid': self.pid,
+                 'tid': self._tid(),
+                 'args': args,
+                 }
+        if self.profiler is not None:
+            self.profiler.record(event)
+        self._write(event)
+
+    @property
+    def page(self):
+        """ The page the current thread is working on """
+        return getattr(self.local, 'page', None)
+
+    @contextmanager
+    def stage(self, name, page=None):
+        if not self.enabled:
+            yield
+            return
+        previous, previous_stage = self.page, getattr(self.local, 'stage', None)
+        self.local.page = page if page is not None else previous
+        self.local.stage = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._event(name, 'stage', start, time.time(), {'page': self.local.page})
+            self.local.page, self.local.stage = previous, previous_stage
+
+    def start_command(self, argvs, input=None):
+        """
+            Call before running the pipeline argvs (a list of argv lists)
+
+            :returns: a token for :meth:`end_command`, or None if we're not tracing
+        """
+        if not self.enabled:
+            return None
+        files = existing_files(argvs)
+        bytes_in = sum(size for size in files.values()) + (len(input) if input else 0)
+        return {'argvs': argvs, 'page': self.page, 'stage': getattr(self.local, 'stage', None),
+                'start': time.time(), 'files': files, 'bytes_in': bytes_in}
+
+    def end_command(self, token, result):
+        """
+            Record a finished command
+
+            :param result: the :class:`runner.Result` of the command
+        """
+        if token is None:
+            return
+        end = time.time()
+        # Anything on the command line that's new or changed is output
+        before = token['files']
+        after = existing_files(token['argvs'])
+        bytes_out = sum(size for name, size in after.items() if before.get(name) != size)
+        args = {'cmd': result.cmd,
+                'page': token['page'],
+                'stage': token['stage'],
+                'cpu': result.cpu,
+                'max_rss_kb': result.max_rss_kb,
+                'bytes_in': token['bytes_in'],
+                'bytes_out': bytes_out + len(result.output or b''),
+                'returncode': result.returncode,
+                }
+        name = os.path.basename(token['argvs'][0][0])
+        self._event(name, 'cmd', token['start'], end, args)
+
+    def close(self):
+        with self.lock:
+            if self.f is None:
+                return
+            if not self.jsonl:
+                self.f.write('\n]\n')
+            self.f.close()
+            self.f = None
+
+
+def existing_files(argvs):
+    """
+        :returns: dict of every argument in the pipeline argvs that is a file, to its size
+    """
+    files = {}
+    for argv in argvs:
+        for arg in argv[1:]:
+            if os.path.isfile(arg):
+                files[arg] = os.path.getsize(arg)
+    return files
+
+
+def traced(name):
+    """
+        Decorator for ScanPdf methods that take a page as their first argument,
+        to record them as a stage for that page.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, page, *args, **kwargs):
+            with self.tracer.stage(name, page):
+                return method(self, page, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,247 @@
+#!/usr/bin/env python2.7
+"""Benchmark each ScanPdf stage on synthetic pages.
+
+Generates text, photo, near-blank, skewed and receipt pages (see
+synthetic.py) at each resolution, times every stage over them in a
+separate process, and reports pages/sec, the number of external commands
+it ran, and peak RSS (our own and the worst child process's).  Stages whose
+tools aren't installed are skipped.  Every image backend (--backend) that is
+installed gets its own run, and the fastest one for each stage is listed at
+the end.
+
+The results are compared against the stored baseline, and the run fails
+if any stage got slower by more than the tolerance, failed, or no longer
+runs.  A run with failed stages is never stored as the baseline, and a run
+where no stage ran at all (say, nothing is installed) fails without storing
+or checking anything.
+
+Usage:
+    bench_scanpdf.py [options]
+
+Options:
+    --dpi=<dpis>            Comma separated resolutions to test [default: 150,300]
+    --pages=<n>             Pages of each kind per resolution [default: 1]
+    --backends=<names>      Comma separated backends to benchmark, or all of them [default: all]
+    --baseline=<file>       Baseline results [default: bench_baseline.json]
+    --tolerance=<pct>       Slowdown (in percent) allowed before failing [default: 25]
+    --update                Store these results as the new baseline
+"""
+
+import sys, os
+import json
+import time
+import shutil
+import tempfile
+import resource
+import multiprocessing
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+import docopt
+
+import scanpdf.scanpdf as P
+from scanpdf.page import Page
+from scanpdf.pyramid import Pyramid
+from scanpdf.trace import Tracer
+from scanpdf.backend import BACKENDS
+import synthetic
+
+# (name, tools it needs, function to time) for every stage.  The function gets
+# the ScanPdf object and the list of pages in its tmp dir.
+STAGES = [
+    ('get_dimensions', [], lambda s, pages: [s.get_dimensions(s._tmp_path(p)) for p in pages]),
+    ('run_crop', [], lambda s, pages: s.run_crop(pages)),
+    ('_is_color', [], lambda s, pages: [s._is_color(s._tmp_path(p)) for p in pages]),
+    ('_page_to_bw', [], lambda s, pages: [s._page_to_bw(p) for p in pages]),
+    ('Page.convert_to_bw', [], lambda s, pages: [Page(s._tmp_path(p), s.dpi).convert_to_bw() for p in pages]),
+    ('is_blank', [], lambda s, pages: [s.is_blank(s._tmp_path(p)) for p in pages]),
+    ('Pyramid.build', [], lambda s, pages: [Pyramid.build(s._tmp_path(p), s.dpi) for p in pages]),
+    ('pyramid checks', [], lambda s, pages: [(Page(s._tmp_path(p), s.dpi).is_color(), Page(s._tmp_path(p), s.dpi).is_blank(0.97))
+                                             for p in pages]),
+    # The same checks batched up, as the list APIs do them
+    ('prefetch_dimensions', [], lambda s, pages: s.prefetch_dimensions([s._tmp_path(p) for p in pages])),
+    ('prefetch_colors', [], lambda s, pages: s.prefetch_colors([s._tmp_path(p) for p in pages])),
+    ('prefetch_blanks', [], lambda s, pages: s.prefetch_blanks([s._tmp_path(p) for p in pages])),
+    ('run_postprocess', ['unpaper'], lambda s, pages: s.run_postprocess(pages)),
+    ('run_convert', [], lambda s, pages: s.run_convert(pages)),
+]
+
+def make_scanpdf(tmp_dir, dpi, engine):
+    args = docopt.docopt(P.__doc__, argv=['--tmpdir=%s' % tmp_dir,
+                                          '--dpi=%s' % dpi,
+                                          '--backend=%s' % engine,
+                                          '--jobs=1',
+                                          '--keep-tmpdir',
+                                          'pdf', os.path.join(tmp_dir, 'out.pdf')])
+    s = P.ScanPdf()
+    s.get_options(args)
+    return s
+
+
+def write_pages(tmp_dir, dpi, count):
+    """
+        Generate count pages of each kind into tmp_dir
+
+        :returns: list of (page name, kind)
+    """
+    pages = []
+    for kind, generator in sorted(synthetic.KINDS.items()):
+        pixels = generator(dpi)
+        for i in range(count):
+            page = './page_%04d' % (len(pages) + 1)
+            synthetic.write_ppm(os.path.join(tmp_dir, page), pixels)
+            pages.append((page, kind))
+    return pages
+
+
+def run_stage(stage, dpi, engine, pages_dir, pages, conn):
+    """
+        Runs in its own process, so the peak RSS only covers this stage
+    """
+    name, tools, func = stage
+    tmp_dir = tempfile.mkdtemp(prefix='scanpdf_bench')
+    try:
+        s = make_scanpdf(tmp_dir, dpi, engine)
+        # Every stage gets fresh copies, since some of them delete their input
+        for page, kind in pages:
+            shutil.copy(os.path.join(pages_dir, page), os.path.join(tmp_dir, page))
+            # run_convert wants to know which pages are B&W
+            s.bw_pages[page] = kind != 'photo'
+        pages = [page for page, kind in pages]
+        # Trace the stage, just to count the commands it runs
+        trace_file = os.path.join(tmp_dir, 'trace.jsonl')
+        s.tracer = Tracer(trace_file)
+        start = time.time()
+        func(s, pages)
+        elapsed = time.time() - start
+        s.tracer.close()
+        with open(trace_file) as f:
+            commands = sum(1 for line in f if json.loads(line)['cat'] == 'cmd')
+        conn.send({'pages_per_sec': len(pages) / elapsed,
+                   'seconds': elapsed,
+                   'commands': commands,
+                   'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   'child_max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                   })
+    except BaseException as e:
+        conn.send({'error': repr(e)})
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        conn.close()
+
+
+def measure(stage, dpi, engine, pages_dir, pages):
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=run_stage, args=(stage, dpi, engine, pages_dir, pages, child))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def compare(results, baseline, tolerance, ran):
+    """
+        :param ran: The (backend, dpi) pairs this run covered; the baseline's other stages aren't compared
+        :returns: list of (key, baseline pages/sec, pages/sec) for every stage that got slower than
+                  allowed, with None for the pages/sec of a baseline stage that has no result now
+    """
+    regressions = []
+    for key, expected in sorted(baseline.items()):
+        engine, dpi, name = key.split('/', 2)
+        if (engine, dpi) not in ran:
+            continue
+        expected = expected['pages_per_sec']
+        if key not in results:
+            regressions.append((key, expected, None))
+        elif results[key]['pages_per_sec'] < expected * (1.0 - tolerance / 100.0):
+            regressions.append((key, expected, results[key]['pages_per_sec']))
+    return regressions
+
+
+def fastest(results):
+    """
+        :returns: dict of (dpi, stage) to (backend, pages/sec) of the quickest backend at it
+    """
+    best = {}
+    for key, result in results.items():
+        engine, dpi, name = key.split('/', 2)
+        if result['pages_per_sec'] > best.get((dpi, name), (None, 0.0))[1]:
+            best[(dpi, name)] = (engine, result['pages_per_sec'])
+    return best
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    dpis = [int(d) for d in args['--dpi'].split(',')]
+    count = int(args['--pages'])
+    engines = sorted(BACKENDS) if args['--backends'] == 'all' else args['--backends'].split(',')
+    baseline_file = args['--baseline']
+
+    results = {}
+    failures = {}  # key to the error of every stage that failed
+    ran = set()
+    print("%-34s %10s %10s %9s %12s %12s" % ('stage', 'pages/sec', 'seconds', 'commands', 'rss MB', 'child MB'))
+    for dpi in dpis:
+        pages_dir = tempfile.mkdtemp(prefix='scanpdf_pages')
+        # Generate the pages in a throwaway process too, so it doesn't bloat the stages' RSS
+        generator = multiprocessing.Pool(1)
+        pages = generator.apply(write_pages, (pages_dir, dpi, count))
+        generator.terminate()
+        for engine in engines:
+            if BACKENDS[engine].missing():
+                print("%-34s skipped, needs %s" % (engine, BACKENDS[engine].missing()))
+                continue
+            ran.add((engine, str(dpi)))
+            for stage in STAGES:
+                name, tools = stage[0], stage[1]
+                key = '%s/%s/%s' % (engine, dpi, name)
+                missing = [t for t in tools if not find_executable(t)]
+                if missing:
+                    print("%-34s skipped, needs %s" % (key, ', '.join(missing)))
+                    continue
+                result = measure(stage, dpi, engine, pages_dir, pages)
+                if 'error' in result:
+                    print("%-34s failed: %s" % (key, result['error']))
+                    failures[key] = result['error']
+                    continue
+                results[key] = result
+                print("%-34s %10.2f %10.3f %9d %12.1f %12.1f" % (key, result['pages_per_sec'], result['seconds'],
+                      result['commands'], result['max_rss_kb'] / 1024.0, result['child_max_rss_kb'] / 1024.0))
+        shutil.rmtree(pages_dir, ignore_errors=True)
+
+    print("\nFastest backend for each stage:")
+    for (dpi, name), (engine, pages_per_sec) in sorted(fastest(results).items()):
+        print("  %-30s %-12s %10.2f pages/sec" % ('%s/%s' % (dpi, name), engine, pages_per_sec))
+
+    for key, error in sorted(failures.items()):
+        print("FAILED: %s: %s" % (key, error))
+    if not results:
+        # An empty baseline would check nothing from then on
+        print("No stage ran, so there's nothing to store or compare")
+        return 1
+
+    if args['--update'] or not os.path.exists(baseline_file):
+        if failures:
+            # A baseline without the broken stages would hide them from then on
+            print("Not storing a baseline, %d stages failed" % len(failures))
+            return 1
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Stored baseline in %s" % baseline_file)
+        return 0
+
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, float(args['--tolerance']), ran)
+    for key, expected, actual in regressions:
+        if actual is None:
+            print("REGRESSION: %s no longer runs (it did %.2f pages/sec)" % (key, expected))
+        else:
+            print("REGRESSION: %s is down to %.2f pages/sec from %.2f" % (key, actual, expected))
+    return 1 if regressions or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
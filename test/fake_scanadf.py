@@ -0,0 +1,44 @@
+"""
+    Stands in for scanadf in the tests: takes the same options scanpdf
+    passes to scanadf, and writes synthetic pages instead of scanning.
+    ``--pages`` and ``--delay`` (seconds between pages) are its own.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import text, specks, write_ppm
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--device', required=True)
+    parser.add_argument('--source')
+    parser.add_argument('--mode', default='Color')
+    parser.add_argument('--resolution', default='100dpi')
+    parser.add_argument('-o', '--output-file', required=True)
+    parser.add_argument('--pages', type=int, default=2)
+    parser.add_argument('--delay', type=float, default=0)
+    args, unknown = parser.parse_known_args(argv)
+    dpi = int(args.resolution.rstrip('dpi'))
+    for i in range(1, args.pages + 1):
+        time.sleep(args.delay)
+        pixels = text(dpi, seed=i) if i % 2 else specks(dpi)
+        filename = args.output_file % i
+        if args.mode == 'Gray':
+            with open(filename, 'wb') as f:
+                f.write(('P5\n%d %d\n255\n' % (pixels.shape[1], pixels.shape[0])).encode('ascii'))
+                f.write(np.ascontiguousarray(pixels[:, :, 0]).tobytes())
+        else:
+            write_ppm(filename, pixels)
+        sys.stderr.write('Scanned document %s\n' % filename)
+    sys.stderr.write('Scanned %d pages\n' % args.pages)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
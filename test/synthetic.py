@@ -0,0 +1,105 @@
+"""
+    Synthetic scanner pages for the tests and the benchmark, so neither
+    needs a scanner.  Every generator takes the resolution and returns a
+    uint8 array, (height, width, 3) like scanadf's color PNM output.
+"""
+
+import numpy as np
+
+PAPER = 250
+
+
+def write_ppm(filename, pixels):
+    with open(filename, 'wb') as f:
+        f.write(('P6\n%d %d\n255\n' % (pixels.shape[1], pixels.shape[0])).encode('ascii'))
+        f.write(np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+
+
+def blank_page(dpi=100, width=8.5, height=11):
+    return np.full((int(height * dpi), int(width * dpi), 3), PAPER, dtype=np.uint8)
+
+
+def text_page(h=1100, w=850, seed=0, margin=None, line=None):
+    """ White page with rows of black 'words' """
+    rng = np.random.RandomState(seed)
+    page = np.full((h, w, 3), 255, dtype=np.uint8)
+    margin = margin or max(1, w // 10)
+    line = line or max(3, h // 36)
+    height = max(1, line * 2 // 5)
+    for y in range(margin, h - margin, line):
+        x = margin
+        while x < w - margin - line * 5:
+            word = rng.randint(line * 2 // 3, line * 8 // 3)
+            page[y:y + height, x:x + word] = 20
+            x += word + line // 2
+    return page
+
+
+def noisy(page, amount, seed=1):
+    rng = np.random.RandomState(seed)
+    noise = rng.randint(-amount, amount + 1, size=page.shape)
+    return np.clip(page.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def text(dpi, width=8.5, height=11, seed=0):
+    """ A letter page of text, with a little scanner noise """
+    page = text_page(int(height * dpi), int(width * dpi), seed=seed, margin=dpi, line=dpi // 6)
+    return noisy(page, 6, seed)
+
+
+def photo(dpi, width=8.5, height=11):
+    """ A page that is all color gradients """
+    h, w = int(height * dpi), int(width * dpi)
+    y, x = np.mgrid[0:h, 0:w]
+    pixels = np.dstack([x * 255 // w, y * 255 // h, 255 - x * 255 // w]).astype(np.uint8)
+    return noisy(pixels, 10)
+
+
+def specks(dpi, width=8.5, height=11, count=40, seed=6):
+    """ A near-blank page with a few dust specks """
+    rng = np.random.RandomState(seed)
+    page = blank_page(dpi, width, height)
+    size = max(1, dpi // 150)
+    h, w = page.shape[:2]
+    for y, x in zip(rng.randint(0, h - size, count), rng.randint(0, w - size, count)):
+        page[y:y + size, x:x + size] = 40
+    return page
+
+
+def skew(page, degrees):
+    """
+        Approximate a small rotation with a shear: every column (and then
+        every row) gets shifted in proportion to its position.
+    """
+    slope = np.tan(np.radians(degrees))
+    out = np.full_like(page, PAPER)
+    h, w = page.shape[:2]
+    for x in range(0, w, 8):
+        shift = int(round((x - w / 2) * slope))
+        src = page[max(0, -shift):h - max(0, shift), x:x + 8]
+        out[max(0, shift):max(0, shift) + src.shape[0], x:x + 8] = src
+    page, out = out, np.full_like(out, PAPER)
+    for y in range(0, h, 8):
+        shift = -int(round((y - h / 2) * slope))
+        src = page[y:y + 8, max(0, -shift):w - max(0, shift)]
+        out[y:y + 8, max(0, shift):max(0, shift) + src.shape[1]] = src
+    return out
+
+
+def skewed(dpi, degrees=2.0):
+    """ A text page fed in crooked """
+    return skew(text(dpi, seed=7), degrees)
+
+
+def receipt(dpi, length_mm=876, width_mm=80):
+    """ A long, narrow receipt (the scanner's maximum page length) """
+    return text(dpi, width=width_mm / 25.4, height=length_mm / 25.4, seed=8)
+
+
+KINDS = {
+    'text': text,
+    'photo': photo,
+    'specks': specks,
+    'skewed': skewed,
+    'receipt': receipt,
+}
@@ -0,0 +1,172 @@
+import scanpdf.scanpdf as P
+import scanpdf.analysis as A
+from scanpdf.pnm import read_pnm
+import pytest
+import time
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+import numpy as np
+
+from synthetic import write_ppm, text_page, noisy
+from synthetic import specks as specks_page
+
+has_imagemagick = find_executable('convert') is not None
+
+
+def grey_pages():
+    gradient = np.tile(np.linspace(0, 255, 850).astype(np.uint8)[None, :, None], (1100, 1, 3))
+    return {
+        'text': text_page(),
+        'noisy_text': noisy(text_page(seed=2), 12),
+        'gradient': gradient,
+        'blank': np.full((1100, 850, 3), 250, dtype=np.uint8),
+    }
+
+
+def color_pages():
+    stamp = text_page(seed=3)
+    stamp[800:900, 600:720] = (200, 30, 30)
+    logo = text_page(seed=4)
+    logo[40:90, 40:110] = (30, 60, 200)
+    highlight = text_page(seed=5)
+    highlight[300:330, 80:700] = (255, 255, 120)
+    y, x = np.mgrid[0:1100, 0:850]
+    photo = np.dstack([x * 255 // 850, y * 255 // 1100, 255 - x * 255 // 850]).astype(np.uint8)
+    return {
+        'stamp': stamp,
+        'logo': logo,
+        'highlight': highlight,
+        'photo': noisy(photo, 10),
+    }
+
+
+class TestAnalysis:
+
+    def setup(self):
+        self.p = P.ScanPdf()
+        self.p.dpi = 300
+
+    def test_read_pnm(self, tmpdir):
+        page = text_page(50, 40)
+        filename = str(tmpdir.join('page_0001'))
+        write_ppm(filename, page)
+        assert np.array_equal(read_pnm(filename), page)
+
+    def test_read_pnm_comment(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        with open(filename, 'wb') as f:
+            f.write(b'P5\n# scanadf\n3 2\n255\n' + bytearray(range(6)))
+        assert read_pnm(filename).tolist() == [[0, 1, 2], [3, 4, 5]]
+
+    @pytest.mark.parametrize("name", sorted(grey_pages()))
+    def test_grey_pages(self, name):
+        assert not A.is_color(grey_pages()[name])
+
+    @pytest.mark.parametrize("name", sorted(color_pages()))
+    def test_color_pages(self, name):
+        assert A.is_color(color_pages()[name])
+
+    def test_grey_array(self):
+        assert not A.is_color(np.zeros((10, 10), dtype=np.uint8))
+
+    @pytest.mark.skipif(not has_imagemagick, reason="needs ImageMagick")
+    def test_agrees_with_imagemagick(self, tmpdir):
+        corpus = [(name, page, False) for name, page in grey_pages().items()]
+        corpus += [(name, page, True) for name, page in color_pages().items()]
+        timing = {'numpy': 0.0, 'imagemagick': 0.0}
+        for name, page, expected in corpus:
+            filename = str(tmpdir.join(name))
+            write_ppm(filename, page)
+            results = {}
+            for engine in timing:
+                self.p.analysis = engine
+                start = time.time()
+                results[engine] = self.p._is_color(filename)
+                timing[engine] += time.time() - start
+            assert results['numpy'] == results['imagemagick'] == expected, name
+        print("Color check on %d pages: numpy %.3fs, imagemagick %.3fs" % (len(corpus), timing['numpy'], timing['imagemagick']))
+        assert timing['numpy'] < timing['imagemagick']
+
+    def test_falls_back_to_imagemagick(self, tmpdir):
+        filename = str(tmpdir.join('page.png'))
+        with open(filename, 'wb') as f:
+            f.write(b'\x89PNG\r\n')
+        self.p.cmd = lambda c: b'  10: (200, 30, 30,255) #C81E1E srgba(200,30,30,1)\n'
+        assert self.p._is_color(filename)
+
+    def test_blank_page(self):
+        assert A.is_blank(np.full((3300, 2550, 3), 250, dtype=np.uint8), 300)
+
+    def test_blank_page_with_specks(self):
+        assert A.is_blank(specks_page(300), 300)
+        # With a threshold of 1.0 every speck counts as content
+        assert not A.is_blank(specks_page(300), 300, white_fraction=1.0)
+
+    def test_text_page_not_blank(self):
+        assert not A.is_blank(text_page(), 100)
+
+    def test_small_paragraph_not_blank(self):
+        page = np.full((3300, 2550), 255, dtype=np.uint8)
+        for y in range(1500, 1700, 40):
+            page[y:y + 20, 1000:1500] = 0
+        assert not A.is_blank(page, 300)
+        width, height = A.content_size(page, 300)
+        assert abs(width - 500 / 300.0) < 0.2
+        assert abs(height - 180 / 300.0) < 0.2
+
+    def test_bleed_through_is_blank(self):
+        # Faint text showing through from the other side of the sheet
+        page = text_page(3300, 2550)
+        page[page < 255] = 225
+        assert A.is_blank(page, 300)
+
+    def test_is_blank_uses_threshold(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        write_ppm(filename, specks_page(300))
+        self.p.analysis = 'numpy'
+        self.p.blank_threshold = 0.97
+        assert self.p.is_blank(filename)
+        self.p.blank_threshold = 1.0
+        assert not self.p.is_blank(filename)
+
+    def test_clean_page(self):
+        page = text_page()
+        assert A.count_specks(page) == 0
+        assert not A.has_dark_edges(page, 100)
+        page[500:502, 10:12] = 40
+        page[40, 425] = 40
+        assert A.count_specks(page) == 5
+        assert A.has_dark_edges(page, 100)
+
+    def test_specks_not_clean(self):
+        from scanpdf.pyramid import Pyramid
+        assert A.pyramid_is_clean(Pyramid.build('page_0001', 100, text_page()))
+        assert not A.pyramid_is_clean(Pyramid.build('page_0001', 300, specks_page(300)))
+
+    @pytest.mark.parametrize("kind,verdict", [('blank', A.BLANK), ('specks', A.BLANK), ('bleed', A.BLANK),
+                                              ('text', A.CONTENT), ('paragraph', A.CONTENT),
+                                              ('tiny', A.BORDERLINE), ('near_edge', A.BORDERLINE)])
+    def test_raw_blank_verdict(self, kind, verdict):
+        page = np.full((3300, 2550), 250, dtype=np.uint8)
+        if kind == 'specks':
+            page = specks_page(300)
+        elif kind == 'bleed':
+            page = text_page(3300, 2550)
+            page[page < 255] = 225
+        elif kind == 'text':
+            page = text_page(3300, 2550)
+        elif kind == 'paragraph':
+            for y in range(1500, 1700, 40):
+                page[y:y + 20, 1000:1500] = 0
+        elif kind == 'tiny':
+            page[1600:1680, 1200:1290] = 0
+        elif kind == 'near_edge':
+            # Only just inside the part the check on the cropped page looks at
+            page[3020:3100, 400:2000] = 0
+        assert A.raw_blank_verdict(page, 300) == verdict
+        # Never the opposite of what the full check says
+        if verdict != A.BORDERLINE:
+            assert A.is_blank(page, 300) == (verdict == A.BLANK)
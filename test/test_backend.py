@@ -0,0 +1,127 @@
+import scanpdf.scanpdf as P
+import scanpdf.analysis as A
+from scanpdf.backend import BACKENDS, ImageMagickBackend, NumpyBackend, VipsBackend
+from scanpdf.pnm import read_pnm, write_pnm
+import pytest
+import docopt
+
+import numpy as np
+from mock import patch
+
+from synthetic import text, photo, blank_page, skew, specks
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request, tmpdir):
+    """ Every backend that is installed here, set up the way ScanPdf would """
+    missing = BACKENDS[request.param].missing()
+    if missing:
+        pytest.skip("needs %s" % missing)
+    p = P.ScanPdf()
+    p.dpi = 100
+    p.tmp_dir = str(tmpdir)
+    p.blank_threshold = 0.97
+    p.analysis = request.param
+    return p.backend
+
+
+def page_file(tmpdir, pixels, name='page_0001'):
+    filename = str(tmpdir.join(name))
+    write_pnm(filename, pixels)
+    return filename
+
+
+class TestBackend:
+    """ What every backend has to do the same """
+
+    def test_dimensions(self, backend, tmpdir):
+        assert tuple(backend.dimensions(page_file(tmpdir, text(100)))) == (850, 1100)
+
+    def test_is_color(self, backend, tmpdir):
+        assert backend.is_color(page_file(tmpdir, photo(100), 'photo'))
+        assert not backend.is_color(page_file(tmpdir, text(100), 'text'))
+
+    def test_is_blank(self, backend, tmpdir):
+        assert backend.is_blank(page_file(tmpdir, blank_page(100), 'blank'))
+        assert backend.is_blank(page_file(tmpdir, specks(100), 'specks'))
+        assert not backend.is_blank(page_file(tmpdir, text(100), 'text'))
+
+    def test_raw_blank_verdict(self, backend, tmpdir):
+        # Never sure of the wrong answer
+        assert backend.raw_blank_verdict(page_file(tmpdir, blank_page(100), 'blank')) != A.CONTENT
+        assert backend.raw_blank_verdict(page_file(tmpdir, text(100), 'text')) != A.BLANK
+
+    def test_crop_straightens(self, backend, tmpdir):
+        out = str(tmpdir.join('page_0001.crop'))
+        backend.crop(page_file(tmpdir, skew(text(100, seed=7), 2.0)), out)
+        cropped = read_pnm(out)
+        assert cropped.shape[:2] == (1100, 850)
+        assert abs(A.estimate_skew(cropped)) <= 0.5
+
+    def test_crop_blank(self, backend, tmpdir):
+        out = str(tmpdir.join('page_0001.crop'))
+        backend.crop(page_file(tmpdir, blank_page(100)), out)
+        assert read_pnm(out).shape[:2] == (1100, 850)
+
+    def test_to_bw(self, backend, tmpdir):
+        out = str(tmpdir.join('page_0001_bw'))
+        backend.to_bw(page_file(tmpdir, text(100)), out)
+        bw = read_pnm(out)
+        if bw.ndim == 3:
+            assert (bw[..., 0] == bw[..., 1]).all() and (bw[..., 0] == bw[..., 2]).all()
+            bw = bw[..., 0]
+        assert bw.shape == (1100, 850)
+        assert len(np.unique(bw)) <= 4
+        # The ink went black and the paper white
+        assert bw.min() < 64 and np.median(bw) > 192
+
+    def test_encode_bw(self, backend, tmpdir):
+        image = backend.encode(page_file(tmpdir, text(100)), True)
+        assert (image.width, image.height) == (850, 1100)
+        assert (image.colorspace, image.bits, image.filter) == ('DeviceGray', 2, 'FlateDecode')
+
+    def test_encode_color(self, backend, tmpdir):
+        image = backend.encode(page_file(tmpdir, photo(100)), False)
+        assert (image.width, image.height) == (850, 1100)
+        assert (image.colorspace, image.bits, image.filter) == ('DeviceRGB', 8, 'DCTDecode')
+        assert image.data[:2] == b'\xff\xd8'
+
+
+def test_unreadable_goes_to_imagemagick(tmpdir):
+    p = P.ScanPdf()
+    filename = str(tmpdir.join('page.png'))
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n')
+    assert p._backend_for(filename) is p.imagemagick
+    assert p._backend_for(page_file(tmpdir, text(100))) is p.backend
+
+
+def options(tmpdir, *argv):
+    args = docopt.docopt(P.__doc__, argv=['--tmpdir=%s' % tmpdir] + list(argv) + ['pdf', str(tmpdir.join('out.pdf'))])
+    p = P.ScanPdf()
+    p.get_options(args)
+    return p
+
+
+def test_backend_option(tmpdir):
+    with patch.object(NumpyBackend, 'missing', return_value=None):
+        assert options(tmpdir).backend.name == 'numpy'
+        # --analysis is the old name for it
+        assert options(tmpdir, '--backend=vips', '--analysis=numpy').backend.name == 'numpy'
+    with pytest.raises(SystemExit):
+        options(tmpdir, '--backend=gimp')
+
+
+def test_backend_not_installed(tmpdir):
+    with patch.object(VipsBackend, 'missing', return_value='pyvips'):
+        with pytest.raises(SystemExit):
+            options(tmpdir, '--backend=vips')
+
+
+def test_numpy_needs_something_to_encode_with():
+    with patch('scanpdf.backend.Image', None), \
+         patch.object(ImageMagickBackend, 'missing', return_value='ImageMagick (convert and identify)'):
+        assert NumpyBackend.missing() == 'Pillow or ImageMagick'
+    with patch('scanpdf.backend.Image', None), \
+         patch.object(ImageMagickBackend, 'missing', return_value=None):
+        assert NumpyBackend.missing() is None
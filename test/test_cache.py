@@ -0,0 +1,100 @@
+import scanpdf.scanpdf as P
+from scanpdf.cache import PageCache
+import os
+import time
+
+from mock import patch
+
+
+class TestCache:
+
+    def setup(self):
+        self.p = P.ScanPdf()
+        self.p.dpi = 300
+        self.p.keep_blanks = False
+        self.p.post_process = False
+        self.p.blank_threshold = 0.97
+
+    def test_key_depends_on_params(self, tmpdir):
+        cache = PageCache(str(tmpdir), 1024)
+        assert cache.key('abc', 'encode', {'dpi': 300}) == cache.key('abc', 'encode', {'dpi': 300})
+        assert cache.key('abc', 'encode', {'dpi': 300}) != cache.key('abc', 'encode', {'dpi': 600})
+        assert cache.key('abc', 'encode', {'dpi': 300}) != cache.key('abd', 'encode', {'dpi': 300})
+        assert cache.key('abc', 'encode', {'dpi': 300}) != cache.key('abc', 'analysis', {'dpi': 300})
+        key = cache.key('abc', 'encode', {'dpi': 300})
+        with patch('scanpdf.cache.STAGE_VERSION', 0):
+            # What an older version of the stage made
+            assert cache.key('abc', 'encode', {'dpi': 300}) != key
+
+    def test_digest(self, tmpdir):
+        tmpdir.join('a').write('page')
+        tmpdir.join('b').write('page')
+        tmpdir.join('c').write('other page')
+        cache = PageCache(str(tmpdir.join('cache')), 1024)
+        assert cache.digest(str(tmpdir.join('a'))) == cache.digest(str(tmpdir.join('b')))
+        assert cache.digest(str(tmpdir.join('a'))) != cache.digest(str(tmpdir.join('c')))
+
+    def test_info_and_file(self, tmpdir):
+        cache = PageCache(str(tmpdir.join('cache')), 1024)
+        assert cache.get_info('k1') is None
+        cache.put_info('k1', {'blank': True})
+        assert cache.get_info('k1') == {'blank': True}
+        tmpdir.join('stream').write('data')
+        cache.put_file('k2', str(tmpdir.join('stream')))
+        assert cache.get_file('k2', str(tmpdir.join('copy')))
+        assert tmpdir.join('copy').read() == 'data'
+        assert not cache.get_file('k3', str(tmpdir.join('copy3')))
+
+    def test_lru_eviction(self, tmpdir):
+        cache = PageCache(str(tmpdir.join('cache')), 250)
+        tmpdir.join('stream').write('x' * 100)
+        cache.put_file('k1', str(tmpdir.join('stream')))
+        cache.put_file('k2', str(tmpdir.join('stream')))
+        # Use k1 so k2 is now the least recently used
+        past = time.time() - 100
+        os.utime(os.path.join(cache.cache_dir, 'k2.data'), (past, past))
+        os.utime(os.path.join(cache.cache_dir, 'k1.data'), (past - 10, past - 10))
+        assert cache.get_file('k1', str(tmpdir.join('copy')))
+        cache.put_file('k3', str(tmpdir.join('stream')))
+        assert sorted(os.listdir(cache.cache_dir)) == ['k1.data', 'k3.data']
+
+    def test_rerun_uses_cache(self, tmpdir):
+        tmpdir.join('page_0001').write('raw page 1')
+        tmpdir.join('page_0002').write('raw page 2')
+        self.p.tmp_dir = str(tmpdir)
+        self.p.cache = PageCache(str(tmpdir.join('cache')), 1 << 20)
+
+        def process(page):
+            if page == './page_0002':
+                return None
+            tmpdir.join('page_0001.crop.stream').write('stream 1')
+            return './page_0001.crop'
+
+        with patch.object(self.p, '_process_page', side_effect=process) as first:
+            assert self.p.process_page('./page_0001') == './page_0001.crop'
+            assert self.p.process_page('./page_0002') is None
+        assert first.call_count == 2
+
+        with patch.object(self.p, '_process_page') as second:
+            assert self.p.process_page('./page_0001') == './page_0001'
+            assert self.p.process_page('./page_0002') is None
+        assert not second.called
+        assert tmpdir.join('page_0001.stream').read() == 'stream 1'
+
+        # Keeping blanks means page 2 needs processing, but page 1 is still cached
+        self.p.keep_blanks = True
+        with patch.object(self.p, '_process_page', return_value=None) as third:
+            self.p.process_page('./page_0001')
+            self.p.process_page('./page_0002')
+        third.assert_called_once_with('./page_0002')
+
+    def test_blanks_keyed_on_prefilter(self, tmpdir):
+        tmpdir.join('page_0001').write('raw page 1')
+        self.p.tmp_dir = str(tmpdir)
+        self.p.cache = PageCache(str(tmpdir.join('cache')), 1 << 20)
+        with patch.object(self.p, '_process_page', return_value=None):
+            assert self.p.process_page('./page_0001') is None
+        with patch('scanpdf.analysis.RAW_BLANK_MARGIN', 3.0), \
+             patch.object(self.p, '_process_page', return_value=None) as again:
+            self.p.process_page('./page_0001')
+        assert again.called
@@ -0,0 +1,106 @@
+import scanpdf.scanpdf as P
+import scanpdf.analysis as A
+from scanpdf.page import crop, rotate
+from scanpdf.pnm import read_pnm, write_pnm
+import pytest
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
+
+import numpy as np
+from mock import patch
+
+from synthetic import text, skew, photo, specks, receipt, PAPER
+
+has_imagemagick = find_executable('convert') is not None
+
+
+def full_content_box(pixels, shave, fuzz):
+    """ content_box the slow way, looking at every pixel """
+    page = pixels[shave:-shave, shave:-shave].astype(np.float64)
+    distance = ((page - page[0, 0]) ** 2).reshape(page.shape[:2] + (-1,)).sum(axis=2)
+    content = distance > page.reshape(page.shape[:2] + (-1,)).shape[2] * (fuzz * 255) ** 2
+    rows, cols = np.flatnonzero(content.any(axis=1)), np.flatnonzero(content.any(axis=0))
+    return (shave + cols[0], shave + rows[0], shave + cols[-1] + 1, shave + rows[-1] + 1)
+
+
+class TestCrop:
+
+    @pytest.mark.parametrize("degrees", [-3.0, -1.5, 0.0, 2.0, 4.0])
+    def test_estimate_skew(self, degrees):
+        page = skew(text(75, seed=7), degrees)
+        assert abs(A.estimate_skew(page) - degrees) <= 0.15
+
+    def test_too_little_ink(self):
+        assert A.estimate_skew(np.full((100, 80), PAPER, dtype=np.uint8)) == 0.0
+
+    def test_rotate_straightens(self):
+        page = skew(text(75, seed=7), 2.5)
+        straight = rotate(page, -A.estimate_skew(page))
+        assert abs(A.estimate_skew(straight)) <= 0.15
+        # The canvas grows to fit the corners
+        assert straight.shape[0] > page.shape[0] and straight.shape[1] > page.shape[1]
+        assert straight.dtype == np.uint8 and tuple(straight[0, 0]) == (255, 255, 255)
+
+    @pytest.mark.parametrize("kind", ['text', 'photo', 'specks', 'receipt', 'grey'])
+    def test_content_box_matches_full_search(self, kind):
+        page = {'text': lambda: text(100),
+                'photo': lambda: photo(100),
+                'specks': lambda: specks(100),
+                'receipt': lambda: receipt(100),
+                'grey': lambda: text(100)[..., 1]}[kind]()
+        assert A.content_box(page, 10, 0.2) == full_content_box(page, 10, 0.2)
+
+    def test_content_box_blank(self):
+        assert A.content_box(np.full((300, 200, 3), PAPER, dtype=np.uint8), 10, 0.2) is None
+
+    def test_crop_centers_content(self):
+        # A 200x300 sheet off to one side on the dark scanner background
+        page = np.full((400, 300, 3), 30, dtype=np.uint8)
+        page[20:320, 90:290] = PAPER
+        page[40:60, 100:120] = 0
+        cropped = crop(page, 100)
+        assert cropped.shape == page.shape
+        rows, cols = np.nonzero(cropped[..., 0] == 0)
+        assert (rows.min(), rows.max(), cols.min(), cols.max()) == (70, 89, 60, 79)
+        assert (cropped[:50] == 255).all() and (cropped[:, :50] == 255).all()
+        assert (cropped[:, 250:] == 255).all()
+
+    def test_crop_straight_page_not_resampled(self):
+        page = text(100)
+        with patch('scanpdf.page.rotate') as rotated:
+            crop(page, 100, 0.05)
+        assert not rotated.called
+
+    def test_in_process(self, tmpdir):
+        p = P.ScanPdf()
+        p.dpi = 100
+        p.tmp_dir = str(tmpdir)
+        write_pnm(str(tmpdir.join('page_0001')), skew(text(100, seed=7), 2.0))
+        with patch.object(p, 'cmd') as cmd:
+            assert p._crop_page('./page_0001') == './page_0001.crop'
+        assert not cmd.called
+        cropped = read_pnm(str(tmpdir.join('page_0001.crop')))
+        assert cropped.shape == (1100, 850, 3)
+        assert abs(A.estimate_skew(cropped)) <= 0.15
+
+    @pytest.mark.skipif(not has_imagemagick, reason="needs ImageMagick")
+    @pytest.mark.parametrize("kind", ['text', 'skewed', 'photo', 'receipt'])
+    def test_agrees_with_imagemagick(self, tmpdir, kind):
+        page = {'text': lambda: text(100),
+                'skewed': lambda: skew(text(100, seed=7), 2.0),
+                'photo': lambda: photo(100),
+                'receipt': lambda: receipt(100)}[kind]()
+        write_pnm(str(tmpdir.join('page_0001')), page)
+        crops = {}
+        for engine in ('numpy', 'imagemagick'):
+            p = P.ScanPdf()
+            p.dpi = 100
+            p.tmp_dir = str(tmpdir)
+            p.analysis = engine
+            crops[engine] = read_pnm(p._tmp_path(p._crop_page('./page_0001')))
+        assert crops['numpy'].shape == crops['imagemagick'].shape
+        ours = A.content_box(crops['numpy'], 10, 0.2)
+        theirs = A.content_box(crops['imagemagick'], 10, 0.2)
+        assert max(abs(a - b) for a, b in zip(ours, theirs)) <= 5
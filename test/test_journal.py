@@ -0,0 +1,75 @@
+import scanpdf.scanpdf as P
+from scanpdf.journal import Journal
+import pytest
+import os
+
+from mock import patch
+
+PARAMS = {'dpi': 300, 'keep_blanks': False}
+
+
+class TestJournal:
+
+    def setup(self):
+        self.p = P.ScanPdf()
+
+    def test_record_and_reload(self, tmpdir):
+        journal = Journal(str(tmpdir), PARAMS)
+        journal.record('./page_0001', 'encoded', './page_0001.crop')
+        journal.record('./page_0002', 'blank')
+        journal = Journal(str(tmpdir), PARAMS)
+        assert journal.get('./page_0001')['artifact'] == './page_0001.crop'
+        assert journal.get('./page_0002')['stage'] == 'blank'
+        assert journal.get('./page_0003') is None
+
+    def test_changed_params_start_over(self, tmpdir):
+        Journal(str(tmpdir), PARAMS).record('./page_0001', 'blank')
+        journal = Journal(str(tmpdir), {'dpi': 600, 'keep_blanks': False})
+        assert journal.get('./page_0001') is None
+        assert Journal(str(tmpdir), PARAMS).get('./page_0001') is None
+
+    def test_torn_last_line(self, tmpdir):
+        Journal(str(tmpdir), PARAMS).record('./page_0001', 'blank')
+        with open(str(tmpdir.join(Journal.FILENAME)), 'a') as f:
+            f.write('{"page": "./page_00')
+        journal = Journal(str(tmpdir), PARAMS)
+        assert journal.get('./page_0001')['stage'] == 'blank'
+
+    def test_resume(self, tmpdir):
+        for i in range(1, 4):
+            tmpdir.join('page_000%d' % i).write('raw')
+        self.p.tmp_dir = str(tmpdir)
+        self.p.journal = Journal(str(tmpdir), PARAMS)
+
+        def process(page):
+            if page == './page_0003':
+                self.p._error("Could not run command")
+            if page == './page_0002':
+                return None
+            tmpdir.join('page_0001.crop.stream').write('stream')
+            return './page_0001.crop'
+
+        with patch.object(self.p, '_process_page', side_effect=process):
+            assert self.p.process_page('./page_0001') == './page_0001.crop'
+            assert self.p.process_page('./page_0002') is None
+            with pytest.raises(SystemExit):
+                self.p.process_page('./page_0003')
+        # The originals are all still there
+        assert tmpdir.join('page_0001').check()
+
+        self.p.journal = Journal(str(tmpdir), PARAMS)
+        tmpdir.join('page_0003.crop.stream').write('stream')
+        with patch.object(self.p, '_process_page', return_value='./page_0003.crop') as resumed:
+            assert self.p.process_page('./page_0001') == './page_0001.crop'
+            assert self.p.process_page('./page_0002') is None
+            assert self.p.process_page('./page_0003') == './page_0003.crop'
+        resumed.assert_called_once_with('./page_0003')
+
+    def test_cleanup(self, tmpdir):
+        tmpdir.join('page_0001').write('raw')
+        tmpdir.join('page_0001.crop.stream').write('stream')
+        self.p.tmp_dir = str(tmpdir)
+        self.p.args = {'--keep-tmpdir': False, 'scan': False}
+        self.p.journal = Journal(str(tmpdir), PARAMS)
+        self.p.cleanup({'./page_0001': './page_0001.crop', './page_0002': None})
+        assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,134 @@
+import scanpdf.scanpdf as P
+import scanpdf.page as page_module
+from scanpdf.page import to_bw
+from scanpdf.pnm import read_pnm, map_pnm, write_pnm, read_size
+import os
+import shutil
+
+import numpy as np
+from mock import patch
+
+from synthetic import text_page
+
+
+class TestPage:
+
+    def setup(self):
+        self.p = P.ScanPdf()
+        self.p.dpi = 100
+        self.p.keep_blanks = False
+        self.p.post_process = False
+        self.p.blank_threshold = 0.97
+        self.p.args = {'--keep-tmpdir': False}
+
+    def test_to_bw_levels(self):
+        page = text_page()
+        page[200:300, 200:300] = 128
+        bw = to_bw(page)
+        assert bw.shape == page.shape[:2]
+        assert set(np.unique(bw)) <= set([0, 85, 170, 255])
+        assert bw[0, 0] == 255
+        assert bw[85, 90] == 0
+        assert bw[250, 250] in (85, 170)
+
+    def test_to_bw_normalizes(self):
+        # A washed out scan gets stretched to full black and white
+        page = np.full((100, 100), 200, dtype=np.uint8)
+        page[40:60, 10:90] = 120
+        bw = to_bw(page)
+        assert bw.min() == 0 and bw.max() == 255
+
+    def test_pnm_roundtrip(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        grey = to_bw(text_page())
+        write_pnm(filename, grey)
+        assert np.array_equal(read_pnm(filename), grey)
+        assert read_size(filename) == (850, 1100)
+
+    def test_decoded_once(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, text_page())
+        self.p.tmp_dir = str(tmpdir)
+        with patch.object(page_module, 'map_pnm', side_effect=map_pnm) as reader, \
+             patch.object(self.p, 'cmd') as cmd:
+            assert self.p._process_decoded_page('./page_0001.crop') == './page_0001.crop'
+        assert reader.call_count == 1
+        assert self.p.bw_pages['./page_0001.crop']
+        # The B&W page is encoded straight from memory
+        assert not cmd.called
+        assert sorted(os.listdir(str(tmpdir))) == ['page_0001.crop', 'page_0001.crop.pyramid', 'page_0001.crop.stream']
+
+    def test_decoded_piped_to_convert(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, text_page())
+        self.p.tmp_dir = str(tmpdir)
+        self.p.ghostscript = True
+        with patch.object(self.p, 'pipeline') as pipeline:
+            assert self.p._process_decoded_page('./page_0001.crop') == './page_0001.crop'
+        # The B&W page is piped to convert instead of written out
+        args, kwargs = pipeline.call_args
+        assert 'pnm:-' in args[0][0]
+        assert kwargs['input'].startswith(b'P5\n850 1100\n255\n')
+        assert sorted(os.listdir(str(tmpdir))) == ['page_0001.crop', 'page_0001.crop.pyramid']
+
+    def test_decoded_blank_removed(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, np.full((1100, 850, 3), 250, dtype=np.uint8))
+        self.p.tmp_dir = str(tmpdir)
+        with patch.object(self.p, 'cmd') as cmd:
+            assert self.p._process_decoded_page('./page_0001.crop') is None
+        assert not cmd.called
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_postprocess_keeps_color(self, tmpdir):
+        self.p.tmp_dir = str(tmpdir)
+        self.p.bw_pages['./page_0001.crop'] = False
+        self.p.bw_pages['./page_0002.crop'] = True
+        with patch.object(self.p, 'cmd') as cmd:
+            assert self.p._postprocess_page('./page_0001.crop') == './page_0001.crop_unpaper'
+            assert self.p._postprocess_page('./page_0002.crop') == './page_0002.crop_unpaper'
+        assert cmd.call_args[0][0][:2] == ['unpaper', '--overwrite']
+        assert not self.p.bw_pages['./page_0001.crop_unpaper']
+        assert self.p.bw_pages['./page_0002.crop_unpaper']
+
+    def test_clean_page_not_postprocessed(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, text_page())
+        self.p.tmp_dir = str(tmpdir)
+        self.p.post_process = True
+        with patch.object(self.p, 'cmd') as cmd:
+            assert self.p._process_decoded_page('./page_0001.crop') == './page_0001.crop'
+        assert not cmd.called
+
+    def test_specks_postprocessed(self, tmpdir):
+        page = text_page()
+        for y, x in [(120, 700), (300, 60), (1000, 400), (950, 790), (40, 400)]:
+            page[y:y + 2, x:x + 2] = 40
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, page)
+        self.p.tmp_dir = str(tmpdir)
+        self.p.post_process = True
+
+        def unpaper(c, *args, **kwargs):
+            shutil.copy(c[2], c[3])
+        with patch.object(self.p, 'cmd', side_effect=unpaper) as cmd:
+            assert self.p._process_decoded_page('./page_0001.crop') == './page_0001.crop_unpaper'
+        assert cmd.call_args[0][0][0] == 'unpaper'
+        assert self.p.bw_pages['./page_0001.crop_unpaper']
+
+    def test_blank_scan_not_cropped(self, tmpdir):
+        write_pnm(str(tmpdir.join('page_0001')), np.full((1100, 850, 3), 250, dtype=np.uint8))
+        self.p.tmp_dir = str(tmpdir)
+        with patch.object(self.p, '_crop_page') as cropped:
+            assert self.p._process_page('./page_0001') is None
+        assert not cropped.called
+        # The scan stays until the PDF is written
+        assert tmpdir.join('page_0001').check()
+
+    def test_content_not_checked_again(self, tmpdir):
+        write_pnm(str(tmpdir.join('page_0001')), text_page())
+        self.p.tmp_dir = str(tmpdir)
+        with patch.object(page_module.Page, 'is_blank') as is_blank:
+            assert self.p._process_page('./page_0001') == './page_0001.crop'
+        assert not is_blank.called
+        assert tmpdir.join('page_0001.crop.stream').check()
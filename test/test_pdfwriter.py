@@ -0,0 +1,97 @@
+from scanpdf.pdfwriter import PdfWriter, PdfImage, encode_grey, encode_jpeg, jpeg_info
+import pytest
+import re
+import zlib
+
+import numpy as np
+
+# SOI, APP0 (JFIF) and a baseline SOF0 for a 3 component 640x480 image
+JPEG_HEADER = (b'\xff\xd8'
+               b'\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+               b'\xff\xc0\x00\x11\x08\x01\xe0\x02\x80\x03\x01\x22\x00\x02\x11\x01\x03\x11\x01')
+
+
+def check_xref(data):
+    """ Every xref entry has to point at the start of its object """
+    xref_offset = int(re.search(br'startxref\n(\d+)\n%%EOF', data).group(1))
+    assert data[xref_offset:].startswith(b'xref\n')
+    lines = data[xref_offset:].split(b'\n')
+    count = int(lines[1].split()[1])
+    for obj_id in range(1, count):
+        offset = int(lines[2 + obj_id][:10])
+        assert data[offset:].startswith(('%d 0 obj' % obj_id).encode('ascii'))
+    return count
+
+
+class TestPdfWriter:
+
+    def test_jpeg_info(self):
+        assert jpeg_info(JPEG_HEADER) == (640, 480, 3)
+        image = encode_jpeg(JPEG_HEADER)
+        assert image.colorspace == 'DeviceRGB'
+        assert image.filter == 'DCTDecode'
+
+    def test_jpeg_info_bad(self):
+        with pytest.raises(ValueError):
+            jpeg_info(b'\xff\xd8\x00\x00' + b'\x00' * 20)
+
+    def test_encode_grey_2bit(self):
+        pixels = np.array([[0, 85, 170, 255, 255], [255, 0, 0, 90, 160]], dtype=np.uint8)
+        image = encode_grey(pixels, bits=2)
+        assert (image.width, image.height, image.bits) == (5, 2, 2)
+        rows = bytearray(zlib.decompress(image.data))
+        # Rows are padded to whole bytes
+        assert list(rows) == [0b00011011, 0b11000000, 0b11000001, 0b10000000]
+
+    def test_encode_grey_8bit(self):
+        pixels = np.arange(12, dtype=np.uint8).reshape(3, 4)
+        image = encode_grey(pixels, bits=8)
+        assert zlib.decompress(image.data) == pixels.tobytes()
+
+    def test_image_roundtrip(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.stream'))
+        image = encode_grey(np.zeros((10, 20), dtype=np.uint8))
+        image.save(filename)
+        loaded = PdfImage.load(filename)
+        assert loaded.data == image.data
+        assert (loaded.width, loaded.height, loaded.colorspace, loaded.bits, loaded.filter) == \
+               (20, 10, 'DeviceGray', 2, 'FlateDecode')
+
+    def test_write_pdf(self, tmpdir):
+        filename = str(tmpdir.join('out.pdf'))
+        writer = PdfWriter(filename)
+        writer.add_page(encode_grey(np.zeros((3300, 2550), dtype=np.uint8)), 300, rotate=180)
+        writer.add_page(encode_jpeg(JPEG_HEADER), 80)
+        writer.close()
+        data = open(filename, 'rb').read()
+        assert data.startswith(b'%PDF-1.4')
+        assert check_xref(data) == 9
+        assert b'/Kids [5 0 R 8 0 R] /Count 2' in data
+        assert b'/MediaBox [0 0 612.0000 792.0000] /Rotate 180' in data
+        assert b'/MediaBox [0 0 576.0000 432.0000] /Rotate 0' in data
+
+    def test_pages_reordered(self, tmpdir):
+        filename = str(tmpdir.join('out.pdf'))
+        writer = PdfWriter(filename)
+        first = writer.add_page(encode_jpeg(JPEG_HEADER), 80)
+        second = writer.add_page(encode_jpeg(JPEG_HEADER), 80)
+        writer.close([second, first])
+        data = open(filename, 'rb').read()
+        assert check_xref(data) == 9
+        assert ('/Kids [%d 0 R %d 0 R] /Count 2' % (second, first)).encode('ascii') in data
+
+    def test_update_writes_only_changes(self, tmpdir):
+        filename = str(tmpdir.join('out.pdf'))
+        writer = PdfWriter(filename)
+        writer.add_page(encode_jpeg(JPEG_HEADER), 80)
+        writer.update()
+        size = len(open(filename, 'rb').read())
+        # Nothing new, so nothing written
+        writer.update()
+        assert len(open(filename, 'rb').read()) == size
+        writer.add_page(encode_jpeg(JPEG_HEADER), 80)
+        writer.close()
+        data = open(filename, 'rb').read()
+        assert data.count(b'/Type /Catalog') == 1
+        assert data.count(b'/Type /Pages') == 2
+        assert data.count(b'\nxref\n') == 2
@@ -0,0 +1,64 @@
+from scanpdf.pnm import read_pnm, map_pnm, write_pnm, PnmWriter, PnmError
+from synthetic import text_page
+import pytest
+import os
+import numpy as np
+
+
+class TestPnm:
+
+    def test_map_is_zero_copy(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        page = text_page(200, 150)
+        write_pnm(filename, page)
+        mapped = map_pnm(filename)
+        assert isinstance(mapped, np.memmap)
+        assert not mapped.flags.writeable
+        assert np.array_equal(mapped, page)
+
+    def test_pbm(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        with open(filename, 'wb') as f:
+            # 10 pixels wide, so each row is padded out to two bytes
+            f.write(b'P4\n10 2\n' + bytearray([0x80, 0x00, 0xff, 0xc0]))
+        expected = [[0] + [255] * 9, [0] * 10]
+        assert read_pnm(filename).tolist() == expected
+        assert map_pnm(filename).tolist() == expected
+
+    def test_16_bit(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        with open(filename, 'wb') as f:
+            f.write(b'P5\n2 1\n65535\n\xff\xff\x00\x00')
+        assert map_pnm(filename).tolist() == [[255, 0]]
+
+    def test_truncated(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        with open(filename, 'wb') as f:
+            f.write(b'P6\n10 10\n255\n' + b'\x00' * 100)
+        with pytest.raises(PnmError):
+            map_pnm(filename)
+
+    def test_streaming_writer(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        page = text_page(300, 100)
+        with PnmWriter(filename, 100, 300, channels=3) as writer:
+            for top in range(0, 300, 64):
+                writer.write(page[top:top + 64])
+                # Nothing shows up under the real name until it's done
+                assert not os.path.exists(filename)
+        assert np.array_equal(read_pnm(filename), page)
+
+    def test_writer_checks_rows(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        with pytest.raises(PnmError):
+            with PnmWriter(filename, 10, 10) as writer:
+                writer.write(np.zeros((5, 10), dtype=np.uint8))
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_overwrite_while_mapped(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        write_pnm(filename, np.full((10, 10), 7, dtype=np.uint8))
+        mapped = map_pnm(filename)
+        write_pnm(filename, np.full((10, 10), 9, dtype=np.uint8))
+        assert mapped[0, 0] == 7
+        assert map_pnm(filename)[0, 0] == 9
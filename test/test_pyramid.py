@@ -0,0 +1,96 @@
+import scanpdf.scanpdf as P
+import scanpdf.analysis as A
+from scanpdf.pyramid import Pyramid, pyramid_filename
+from scanpdf.pnm import write_pnm
+from synthetic import text, specks
+import os
+import zipfile
+
+import numpy as np
+from mock import patch
+
+
+class TestPyramid:
+
+    def test_halve(self):
+        pixels = np.array([[0, 255, 7], [255, 255, 7], [9, 9, 9]], dtype=np.uint8)
+        assert A.halve(pixels).tolist() == [[191]]
+        rgb = np.dstack([pixels, pixels, pixels])
+        assert A.halve(rgb).tolist() == [[[191, 191, 191]]]
+
+    def test_levels(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, text(300))
+        pyramid = Pyramid.build(filename, 300)
+        assert sorted(pyramid.levels) == [2, 4, 8, 16, 32, 64]
+        assert pyramid.levels[2].shape == (1650, 1275, 3)
+        pixels, dpi = pyramid.at(100)
+        assert dpi == 75 and pixels.shape == (825, 637, 3)
+        assert pyramid.at(300)[1] == 300
+
+    def test_only_levels_checks_read(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        write_pnm(filename, np.full((1024, 768), 255, dtype=np.uint8))
+        pyramid = Pyramid.build(filename, 600)
+        # 300 dpi is finer than any check wants
+        assert sorted(pyramid.levels) == [4, 8, 16]
+        pyramid.save()
+        with zipfile.ZipFile(pyramid_filename(filename)) as saved:
+            assert set(info.compress_type for info in saved.infolist()) == set([zipfile.ZIP_DEFLATED])
+
+    def test_saved_and_reused(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, specks(300))
+        Pyramid.for_page(filename, 300)
+        assert os.path.exists(pyramid_filename(filename))
+        with patch.object(Pyramid, 'build') as build:
+            pyramid = Pyramid.for_page(filename, 300)
+        assert not build.called
+        assert A.pyramid_is_blank(pyramid)
+
+    def test_stale(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, specks(150))
+        Pyramid.for_page(filename, 150)
+        assert Pyramid.load(filename, 300) is None
+        write_pnm(filename, text(150)[:-10])
+        assert Pyramid.load(filename, 150) is None
+        assert not A.pyramid_is_blank(Pyramid.for_page(filename, 150))
+
+    def test_page_checks_share_it(self, tmpdir):
+        filename = str(tmpdir.join('page_0001.crop'))
+        write_pnm(filename, text(150))
+        p = P.ScanPdf()
+        p.dpi = 150
+        p.tmp_dir = str(tmpdir)
+        p.keep_blanks = False
+        p.post_process = False
+        p.blank_threshold = 0.97
+        with patch.object(Pyramid, 'build', side_effect=Pyramid.build) as build, \
+             patch.object(p, '_output_page'):
+            assert p._process_decoded_page('./page_0001.crop') == './page_0001.crop'
+        assert build.call_count == 1
+
+    def test_raw_page_reused(self, tmpdir):
+        write_pnm(str(tmpdir.join('page_0001')), text(150))
+        p = P.ScanPdf()
+        p.dpi = 150
+        p.tmp_dir = str(tmpdir)
+        p.keep_blanks = False
+        p.blank_threshold = 0.97
+        with patch.object(p, '_raw_blank_verdict', return_value=A.BLANK):
+            assert p._process_page('./page_0001') is None
+            with patch.object(Pyramid, 'build') as build:
+                assert p._process_page('./page_0001') is None
+        assert not build.called
+
+    def test_removed_with_page(self, tmpdir):
+        filename = str(tmpdir.join('page_0001'))
+        write_pnm(filename, specks(150))
+        p = P.ScanPdf()
+        p.dpi = 150
+        p.tmp_dir = str(tmpdir)
+        p.analysis = 'numpy'
+        p.blank_threshold = 0.97
+        assert p._remove_if_blank('./page_0001') is None
+        assert os.listdir(str(tmpdir)) == []
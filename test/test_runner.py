@@ -0,0 +1,61 @@
+import scanpdf.runner as R
+import pytest
+import time
+
+
+class TestRunner:
+
+    def test_argv_with_spaces(self, tmpdir):
+        filename = tmpdir.join('a page with spaces')
+        filename.write('scanned')
+        assert R.run(['cat', str(filename)]) == b'scanned'
+
+    def test_no_shell(self):
+        assert R.run(['echo', '$HOME', '|', 'cat']) == b'$HOME | cat\n'
+
+    def test_pipeline(self):
+        assert R.run_pipeline([['printf', 'a\\nb\\nc\\n'], ['sort', '-r'], ['head', '-n', '2']]) == b'c\nb\n'
+
+    def test_input_and_env(self):
+        assert R.run(['cat'], input=b'x' * 200000) == b'x' * 200000
+        assert R.run(['sh', '-c', 'echo $SANE_CONFIG_DIR'], env={'SANE_CONFIG_DIR': '/etc/scanbd'}) == b'/etc/scanbd\n'
+
+    def test_failure(self):
+        with pytest.raises(R.CommandError) as e:
+            R.run(['sh', '-c', 'echo oops >&2; exit 3'])
+        assert e.value.returncode == 3
+        assert e.value.output == b'oops\n'
+        # A failure anywhere in a pipeline fails it
+        with pytest.raises(R.CommandError):
+            R.run_pipeline([['false'], ['cat']])
+
+    def test_missing_program(self):
+        with pytest.raises(R.CommandError) as e:
+            R.run_pipeline([['echo', 'hi'], ['no-such-program-here']])
+        assert e.value.returncode == 127
+
+    def test_timeout(self):
+        start = time.time()
+        with pytest.raises(R.CommandTimeout):
+            R.run(['sleep', '10'], timeout=0.2)
+        assert time.time() - start < 5
+
+    def test_incremental_output(self):
+        chunks = []
+        command = R.start([['sh', '-c', 'echo one; sleep 0.3; echo two']], on_output=chunks.append)
+        time.sleep(0.15)
+        assert chunks == [b'one\n']
+        assert not command.poll()
+        assert command.wait().output.endswith(b'two\n')
+
+    def test_many_in_flight(self):
+        start = time.time()
+        commands = [R.start([['sleep', '0.3']]) for i in range(4)]
+        results = [c.wait() for c in commands]
+        assert time.time() - start < 1.0
+        assert all(r.returncode == 0 for r in results)
+
+    def test_rusage(self):
+        result = R.start([['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done']]).wait()
+        assert result.cpu > 0
+        assert result.max_rss_kb > 0
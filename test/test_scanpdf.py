@@ -1,6 +1,8 @@
-import scanpdf.ScanPdf as P
+import scanpdf.scanpdf as P
 import pytest
 import os
+import re
+import shutil
 import logging
 
 import smtplib
@@ -10,7 +12,294 @@ from mock import MagicMock
 from mock import PropertyMock
 
 
+def pdf_pages(data):
+    """
+        Follow the xref sections of data from the end (the way a viewer
+        would) to find its page tree, and return the ids of the pages in it
+    """
+    offsets = {}
+    xref = int(re.findall(br'startxref\n(\d+)', data)[-1])
+    while xref is not None:
+        lines = data[xref:].split(b'\n')
+        assert lines[0] == b'xref'
+        i = 1
+        while not lines[i].startswith(b'trailer'):
+            first, count = map(int, lines[i].split())
+            for obj_id in range(first, first + count):
+                offsets.setdefault(obj_id, int(lines[i + 1 + obj_id - first][:10]))
+            i += 1 + count
+        trailer = data[xref:].split(b'trailer')[1].split(b'>>')[0]
+        previous = re.search(br'/Prev (\d+)', trailer)
+        xref = int(previous.group(1)) if previous else None
+    for obj_id, offset in offsets.items():
+        if obj_id:
+            assert data[offset:].startswith(b'%d 0 obj' % obj_id)
+    pages = data[offsets[2]:].split(b'endobj')[0]
+    return [int(kid) for kid in re.findall(br'(\d+) 0 R', pages)]
+
+
 class Testscanpdf:
 
     def setup(self):
         self.p = P.ScanPdf()
+
+    def test_run_parallel_keeps_order(self):
+        self.p.jobs = 4
+        self.p.start_pool()
+        try:
+            pages = ['./page_%04d' % i for i in range(1, 41)]
+            results = self.p.run_parallel(lambda page: '%s.crop' % page, pages)
+        finally:
+            self.p.stop_pool()
+        assert results == ['%s.crop' % page for page in pages]
+
+    def test_run_parallel_error_exits(self):
+        def fail(page):
+            self.p._error("Could not run command on %s" % page)
+        self.p.jobs = 2
+        self.p.start_pool()
+        try:
+            with pytest.raises(SystemExit):
+                self.p.run_parallel(fail, ['./page_0001', './page_0002'])
+        finally:
+            self.p.stop_pool()
+
+    def test_imap_backpressure(self):
+        pulled = []
+        def pages():
+            for i in range(1, 21):
+                pulled.append(i)
+                yield './page_%04d' % i
+        self.p.jobs = 2
+        self.p.start_pool()
+        try:
+            results = self.p.imap(lambda page: '%s.crop' % page, pages())
+            assert next(results) == ('./page_0001', './page_0001.crop')
+            # Only a couple of pages per worker get taken ahead of the one being consumed
+            assert len(pulled) == 4
+            assert [page for page, result in results] == ['./page_%04d' % i for i in range(2, 21)]
+        finally:
+            self.p.stop_pool()
+
+    def test_assemble_appends_as_it_goes(self, tmpdir):
+        from scanpdf.pdfwriter import encode_grey
+        import numpy as np
+        self.p.tmp_dir = str(tmpdir)
+        self.p.dpi = 100
+        self.p.pdf_filename = str(tmpdir.join('out.pdf'))
+        self.p.args = {'--keep-tmpdir': False, '--face-up': True}
+        for i in range(1, 5):
+            tmpdir.join('page_%04d' % i).write('raw')
+            if i == 2:
+                # Blank
+                continue
+            tmpdir.join('page_%04d.crop' % i).write('crop')
+            encode_grey(np.full((20, 10), 255, dtype=np.uint8)).save(str(tmpdir.join('page_%04d.crop.stream' % i)))
+        def results():
+            for i in range(1, 5):
+                if i > 1:
+                    # The previous page is in the PDF already, and its files are gone but for its stream
+                    assert not tmpdir.join('page_%04d.crop' % (i - 1)).check()
+                    assert tmpdir.join('page_%04d.crop.stream' % (i - 1)).check() == (i != 3)
+                yield './page_%04d' % i, None if i == 2 else './page_%04d.crop' % i
+        processed = self.p.assemble(results())
+        assert processed['./page_0002'] is None and processed['./page_0003'] == './page_0003.crop'
+        data = tmpdir.join('out.pdf').read_binary()
+        # Face up, so the last page scanned comes first
+        assert b'/Kids [11 0 R 8 0 R 5 0 R] /Count 3' in data
+        assert sorted(os.listdir(str(tmpdir))) == ['out.pdf', 'page_0001', 'page_0001.crop.stream', 'page_0002',
+                                                   'page_0003', 'page_0003.crop.stream', 'page_0004', 'page_0004.crop.stream']
+        # They stay for a rerun to resume from, until the PDF is done
+        self.p.args['scan'] = False
+        self.p.cleanup(processed)
+        assert sorted(os.listdir(str(tmpdir))) == ['out.pdf']
+
+    def test_assemble_traced(self, tmpdir):
+        from scanpdf.pdfwriter import encode_grey
+        from scanpdf.trace import Tracer
+        import numpy as np
+        import json
+        self.p.tmp_dir = str(tmpdir)
+        self.p.dpi = 100
+        self.p.pdf_filename = str(tmpdir.join('out.pdf'))
+        self.p.args = {'--keep-tmpdir': False, '--face-up': False}
+        self.p.tracer = Tracer(str(tmpdir.join('trace.jsonl')))
+        tmpdir.join('page_0001').write('raw')
+        encode_grey(np.full((20, 10), 255, dtype=np.uint8)).save(str(tmpdir.join('page_0001.crop.stream')))
+        self.p.assemble([('./page_0001', './page_0001.crop')])
+        self.p.tracer.close()
+        events = [json.loads(line) for line in tmpdir.join('trace.jsonl').readlines()]
+        append = [event for event in events if event['name'] == 'append']
+        assert len(append) == 1 and append[0]['args']['page'] == './page_0001.crop'
+
+    def test_assemble_incremental(self, tmpdir):
+        from scanpdf.pdfwriter import encode_grey
+        import numpy as np
+        out = tmpdir.mkdir('share')
+        self.p.tmp_dir = str(tmpdir)
+        self.p.dpi = 100
+        self.p.incremental = True
+        self.p.pdf_filename = str(out.join('out.pdf'))
+        self.p.args = {'--keep-tmpdir': False, '--face-up': True}
+        for i in (1, 3, 4):
+            tmpdir.join('page_%04d' % i).write('raw')
+            tmpdir.join('page_%04d.crop' % i).write('crop')
+            encode_grey(np.full((20, 10), 255, dtype=np.uint8)).save(str(tmpdir.join('page_%04d.crop.stream' % i)))
+        partial = out.join('out.partial.pdf')
+        kids = []
+
+        def results():
+            for i in (4, 3, 2, 1):
+                yield './page_%04d' % i, None if i == 2 else './page_%04d.crop' % i
+                # Readable, with the pages so far in their final order
+                data = partial.read_binary()
+                assert data.endswith(b'%%EOF\n')
+                kids.append(pdf_pages(data))
+
+        def qpdf(c):
+            assert c[:2] == ['qpdf', '--linearize'] and c[2] == str(partial)
+            shutil.copy(c[2], c[3])
+        with patch.object(self.p, 'cmd', side_effect=qpdf):
+            self.p.assemble(results())
+        assert kids == [[5], [5, 8], [5, 8], [5, 8, 11]]
+        assert out.listdir() == [out.join('out.pdf')]
+        assert pdf_pages(out.join('out.pdf').read_binary()) == [5, 8, 11]
+
+    def test_assemble_incremental_updates_less_often(self, tmpdir):
+        from scanpdf.pdfwriter import PdfWriter, encode_grey
+        import numpy as np
+        self.p.tmp_dir = str(tmpdir)
+        self.p.dpi = 100
+        self.p.incremental = True
+        self.p.pdf_filename = str(tmpdir.join('out.pdf'))
+        self.p.args = {'--keep-tmpdir': True, '--face-up': False}
+        for i in range(1, 101):
+            encode_grey(np.full((20, 10), 255, dtype=np.uint8)).save(str(tmpdir.join('page_%04d.stream' % i)))
+        with patch.object(PdfWriter, 'update', autospec=True, side_effect=PdfWriter.update) as update, \
+             patch.object(self.p, 'linearize'):
+            self.p.assemble(('./page_%04d' % i, './page_%04d' % i) for i in range(1, 101))
+        # The empty PDF, then after pages 1, 2, 3, 4, 5, 7, 9, 12, 15, 19, 24, 30, 38, 48, 60, 75, 94, and closing
+        assert update.call_count == 19
+
+    def test_linearize_without_qpdf(self, tmpdir):
+        from scanpdf.runner import CommandError
+        self.p.pdf_filename = str(tmpdir.join('out.pdf'))
+        tmpdir.join('out.partial.pdf').write('%PDF')
+        with patch.object(self.p, 'cmd', side_effect=CommandError('qpdf', 127, 'No such file')):
+            self.p.linearize(str(tmpdir.join('out.partial.pdf')))
+        assert tmpdir.listdir() == [tmpdir.join('out.pdf')]
+
+    def test_process_page_chain(self):
+        self.p.analysis = 'imagemagick'
+        self.p.keep_blanks = False
+        self.p.post_process = False
+        with patch.object(self.p, '_crop_page', side_effect=lambda p, pyramid=None: '%s.crop' % p), \
+             patch.object(self.p, '_convert_page_to_bw', side_effect=lambda p: '%s_bw' % p), \
+             patch.object(self.p, '_remove_if_blank', side_effect=lambda p: None if '0002' in p else p), \
+             patch.object(self.p, '_output_page') as output:
+            assert self.p.process_page('./page_0001') == './page_0001.crop_bw'
+            assert self.p.process_page('./page_0002') is None
+            output.assert_called_once_with('./page_0001.crop_bw')
+
+    def test_get_pages_skips_intermediates(self, tmpdir):
+        for name in ['page_0010', 'page_0002', 'page_0001', 'page_0001.crop', 'page_0002.crop_bw.pdf']:
+            tmpdir.join(name).write('')
+        self.p.tmp_dir = str(tmpdir)
+        assert self.p.get_pages() == ['./page_0001', './page_0002', './page_0010']
+
+    def test_run_scan_and_process(self, tmpdir):
+        # Fake scanadf that writes a page every so often
+        script = "for i in 1 2 3 4; do sleep 0.1; touch %s/page_000$i; done" % tmpdir
+        self.p.tmp_dir = str(tmpdir)
+        self.p.poll_interval = 0.02
+        with patch.object(self.p, '_scan_cmd', return_value=['sh', '-c', script]), \
+             patch.object(self.p, 'cmd'), \
+             patch.object(self.p, 'prefetch_pages') as prefetch, \
+             patch.object(self.p, 'process_page', side_effect=lambda p: '%s.crop' % p) as process:
+            processed = dict(self.p.run_scan_and_process())
+        assert processed == dict(('./page_000%d' % i, './page_000%d.crop' % i) for i in range(1, 5))
+        assert process.call_count == 4
+        # Each page is prefetched once, along with whatever came in with it
+        assert sum([args[0] for args, kwargs in prefetch.call_args_list], []) == sorted(processed)
+
+    def test_batched_dimensions(self, tmpdir):
+        self.p.analysis = 'imagemagick'
+        self.p.batch_size = 2
+        self.p.tmp_dir = str(tmpdir)
+        pages = ['./page_0001', './page_0002', './page_0003']
+        calls = []
+        def identify(c):
+            calls.append(c)
+            return b''.join(b'size %d 200\n' % (100 + i) for i in range(len(c) - 3))
+        with patch.object(self.p, 'cmd', side_effect=identify):
+            self.p.prefetch_dimensions([self.p._tmp_path(p) for p in pages])
+            sizes = [self.p.get_dimensions(self.p._tmp_path(p)) for p in pages]
+        assert len(calls) == 2
+        assert calls[0][:3] == ['identify', '-format', 'size %w %h\n']
+        assert sizes == [(100, 200), (101, 200), (100, 200)]
+
+    def test_batched_colors_and_blanks(self, tmpdir):
+        self.p.analysis = 'imagemagick'
+        self.p.dpi = 300
+        self.p.tmp_dir = str(tmpdir)
+        for name in ['page_0001', 'page_0002']:
+            tmpdir.join(name).write('')
+        filenames = [self.p._tmp_path('./page_0001'), self.p._tmp_path('./page_0002')]
+        histograms = (b'page\n  10: (200, 30, 30,255) #C81E1E srgba(200,30,30,1)\n'
+                      b'page\n  10: (30, 30, 30,255) #1E1E1E srgba(30,30,30,1)\n')
+        with patch.object(self.p, 'cmd', return_value=histograms) as cmd:
+            self.p.prefetch_colors(filenames)
+            assert cmd.call_count == 1
+            c = cmd.call_args[0][0]
+            # Each page is read in its own group, so only one is in memory at a time
+            assert c.count('(') == 2 and c[-2:] == ['xc:', 'null:']
+            assert [self.p._is_color(f) for f in filenames] == [True, False]
+        with patch.object(self.p, 'cmd', return_value=b'size 10 10\nsize 500 800\n') as cmd:
+            self.p.prefetch_blanks(filenames)
+            assert [self.p.is_blank(f) for f in filenames] == [True, False]
+            assert cmd.call_count == 1
+
+    def test_prefetch_pages(self, tmpdir):
+        self.p.analysis = 'imagemagick'
+        self.p.dpi = 300
+        self.p.keep_blanks = False
+        self.p.post_process = False
+        self.p.tmp_dir = str(tmpdir)
+        pages = ['./page_0001', './page_0002', './page_0003']
+        for page in pages:
+            tmpdir.join(page).write('')
+        def cmd(c):
+            if c[0] == 'identify':
+                return b''.join(b'size 2550 3300\n' for page in pages)
+            # The crops get written, and then the second page is blank and the third in color
+            for i, arg in enumerate(c):
+                if arg == '-write' and c[i + 1].endswith('.crop'):
+                    open(c[i + 1], 'w').close()
+            return (b'page\nsize 500 800\n  10: (30, 30, 30,255) #1E1E1E srgba(30,30,30,1)\n'
+                    b'page\nsize 10 10\n  10: (30, 30, 30,255) #1E1E1E srgba(30,30,30,1)\n'
+                    b'page\nsize 500 800\n  10: (200, 30, 30,255) #C81E1E srgba(200,30,30,1)\n')
+        with patch.object(self.p, 'cmd', side_effect=cmd) as c, \
+             patch.object(self.p, '_page_to_bw', side_effect=lambda p: '%s_bw' % p), \
+             patch.object(self.p, '_output_page'):
+            processed = [self.p.process_page(page) for page in self.p._prefetching(pages)]
+            # Just the identify and one convert, instead of a crop and two checks per page
+            assert c.call_count == 2
+        assert processed == ['./page_0001.crop_bw', None, './page_0003.crop']
+        assert self.p.prefetched == {}
+
+    def test_prefetch_forgets_unused(self, tmpdir):
+        self.p.tmp_dir = str(tmpdir)
+        tmpdir.join('page_0001.crop').write('')
+        self.p.prefetched = {('crop', self.p._tmp_path('./page_0001')): './page_0001.crop',
+                             ('color', self.p._tmp_path('./page_0001.crop')): True,
+                             ('size', self.p._tmp_path('./page_0002')): (10, 10)}
+        self.p._forget('./page_0001')
+        assert self.p.prefetched == {('size', self.p._tmp_path('./page_0002')): (10, 10)}
+        assert not tmpdir.join('page_0001.crop').exists()
+
+    def test_batch_mismatch_falls_back(self, tmpdir):
+        self.p.analysis = 'imagemagick'
+        filenames = [str(tmpdir.join('a')), str(tmpdir.join('b'))]
+        with patch.object(self.p, 'cmd', return_value=b'size 10 10\n'):
+            self.p.prefetch_dimensions(filenames)
+        assert self.p.prefetched == {}
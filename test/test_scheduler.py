@@ -0,0 +1,185 @@
+import scanpdf.scanpdf as P
+from scanpdf.backend import NumpyBackend
+from scanpdf.scheduler import FairPool, Scheduler, SchedulerError, load_profiles, Batch, find_pending
+from scanpdf.pnm import read_header, write_pnm
+import docopt
+import pytest
+import os
+import sys
+import time
+import threading
+
+from synthetic import text
+from mock import patch
+
+FAKE_SCANADF = '%s %s' % (sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_scanadf.py'))
+
+
+@pytest.fixture(autouse=True)
+def grey_scans():
+    """ The test scans are all grey, so the default backend doesn't need Pillow or ImageMagick for them """
+    with patch.object(NumpyBackend, 'missing', return_value=None):
+        yield
+
+
+class QuietScanPdf(P.ScanPdf):
+    """ Doesn't need logger to be installed """
+
+    def _log(self, message):
+        pass
+
+
+class RecordingScanPdf(QuietScanPdf):
+    """ Scans with fake_scanadf.py, and records what it processes instead of making PDFs """
+
+    processed = []
+    merged = {}
+    lock = threading.Lock()
+
+    def process_page(self, page):
+        with open(self._tmp_path(page), 'rb') as f:
+            magic = read_header(f)[0]
+        with self.lock:
+            self.processed.append((self.profile['name'], page, magic))
+        time.sleep(0.02)
+        return page
+
+    def assemble(self, results):
+        processed = dict(results)
+        pages = [processed[page] for page in self.final_order(processed.keys())]
+        self.merged[self.profile['name']] = (self.tmp_dir, pages, self.pdf_filename)
+        return processed
+
+
+class TestScheduler:
+
+    def setup(self):
+        RecordingScanPdf.processed = []
+        RecordingScanPdf.merged = {}
+
+    def test_fair_pool_takes_turns(self):
+        pool = FairPool(1)
+        gate = threading.Event()
+        ran = []
+        pool.lane('big').apply_async(gate.wait)
+        time.sleep(0.05)
+        big, small = pool.lane('big'), pool.lane('small')
+        tasks = [big.apply_async(ran.append, ('big%d' % i,)) for i in range(1, 6)]
+        tasks += [small.apply_async(ran.append, ('small%d' % i,)) for i in range(1, 3)]
+        gate.set()
+        for task in tasks:
+            task.get()
+        pool.close()
+        pool.join()
+        assert ran == ['big1', 'small1', 'big2', 'small2', 'big3', 'big4', 'big5']
+
+    def test_fair_pool_errors(self):
+        pool = FairPool(2)
+        task = pool.lane('a').apply_async(int, ('x',))
+        with pytest.raises(ValueError):
+            task.get()
+        pool.close()
+        pool.join()
+        with pytest.raises(SchedulerError):
+            pool.lane('a').apply_async(int, ('1',))
+
+    def test_load_profiles(self, tmpdir):
+        config = tmpdir.join('devices.ini')
+        config.write('[left]\ndevice = fujitsu:1\nmode = Gray\n\n[right]\ndevice = epson:2\n')
+        profiles = load_profiles(str(config))
+        assert [p['name'] for p in profiles] == ['left', 'right']
+        assert profiles[0]['mode'] == 'Gray' and profiles[1]['device'] == 'epson:2'
+        config.write('[left]\nmode = Gray\n')
+        with pytest.raises(SchedulerError):
+            load_profiles(str(config))
+        with pytest.raises(SchedulerError):
+            load_profiles(str(tmpdir.join('missing.ini')))
+
+    def test_scan_cmd_profile(self):
+        p = P.ScanPdf()
+        p.dpi = 300
+        p.tmp_dir = '/tmp/scans'
+        p.environ = {'SCANBD_DEVICE': 'fujitsu:1'}
+        c = p._scan_cmd()
+        assert c[:9] == ['scanadf', '-d', 'fujitsu:1', '--source', 'ADF Duplex', '--mode', 'Color',
+                         '--resolution', '300dpi']
+        assert '--ald' in c
+        p.profile = {'device': 'epson:2', 'mode': 'Gray', 'options': '--brightness=10'}
+        c = p._scan_cmd()
+        assert c[2] == 'epson:2' and c[6] == 'Gray' and c[-1] == '--brightness=10'
+
+    def test_devices_scan_at_once(self, tmpdir):
+        config = tmpdir.join('devices.ini')
+        config.write('\n'.join([
+            '[big]',
+            'device = fake:big',
+            'scanadf = %s' % FAKE_SCANADF,
+            'options = --pages 8 --delay 0.02',
+            'dpi = 30',
+            'tmpdir = %s' % tmpdir,
+            'pdf = %s/big.pdf' % tmpdir,
+            '[small]',
+            'device = fake:small',
+            'scanadf = %s' % FAKE_SCANADF,
+            'mode = Gray',
+            'options = --pages 2 --delay 0.1',
+            'dpi = 30',
+            'tmpdir = %s' % tmpdir,
+            'pdf = %s/small.pdf' % tmpdir,
+        ]))
+        args = docopt.docopt(P.__doc__, argv=['devices', str(config)])
+        scheduler = Scheduler(load_profiles(str(config)), RecordingScanPdf, args, 2)
+        results = scheduler.run()
+        assert results == {'big': None, 'small': None}
+
+        merged = RecordingScanPdf.merged
+        # Face up, so in reverse
+        assert merged['big'][1] == ['./page_%04d' % i for i in range(8, 0, -1)]
+        assert merged['small'][1] == ['./page_0002', './page_0001']
+        assert merged['big'][2] == str(tmpdir.join('big.pdf'))
+        # Each device in its own tmp dir, which is cleaned up afterwards
+        assert merged['big'][0] != merged['small'][0]
+        assert not os.path.exists(merged['big'][0]) and not os.path.exists(merged['small'][0])
+        # With its own scan settings
+        processed = RecordingScanPdf.processed
+        assert set(magic for name, page, magic in processed if name == 'small') == set([b'P5'])
+        assert set(magic for name, page, magic in processed if name == 'big') == set([b'P6'])
+        # The small batch isn't stuck behind the big one
+        order = [name for name, page, magic in processed]
+        assert order.index('small') < len(order) - 2
+
+    def make_scans(self, directory, count):
+        directory.ensure(dir=True)
+        for i in range(1, count + 1):
+            write_pnm(str(directory.join('page_%04d' % i)), text(50, seed=i)[..., 1])
+
+    def test_find_pending(self, tmpdir):
+        scans, out = tmpdir.mkdir('scans'), tmpdir.mkdir('out')
+        self.make_scans(scans.join('a'), 2)
+        self.make_scans(scans.join('b'), 3)
+        self.make_scans(scans.join('done'), 1)
+        out.join('done.pdf').write('%PDF')
+        scans.mkdir('empty').join('journal.json').write('{}')
+        self.make_scans(tmpdir.join('c'), 1)
+        pending = find_pending([str(scans), str(tmpdir.join('c'))], str(out))
+        assert pending == [(str(scans.join('a')), str(out.join('a.pdf')), 2),
+                           (str(scans.join('b')), str(out.join('b.pdf')), 3),
+                           (str(tmpdir.join('c')), str(out.join('c.pdf')), 1)]
+        self.make_scans(tmpdir.join('other', 'a'), 1)
+        with pytest.raises(SchedulerError):
+            find_pending([str(scans), str(tmpdir.join('other'))], str(out))
+
+    def test_batch(self, tmpdir):
+        scans, out = tmpdir.mkdir('scans'), tmpdir.mkdir('out')
+        for name, count in (('a', 4), ('b', 2), ('c', 6)):
+            self.make_scans(scans.join(name), count)
+        args = docopt.docopt(P.__doc__, argv=['--dpi=50', '--outdir=%s' % out, 'batch', str(scans)])
+        batch = Batch(find_pending(args['<dir>'], args['--outdir']), QuietScanPdf, args, 2)
+        results = batch.run()
+        assert results == dict((str(scans.join(name)), None) for name in 'abc')
+        for name, count in (('a', 4), ('b', 2), ('c', 6)):
+            assert out.join('%s.pdf' % name).read('rb').count(b'/Type /Page ') == count
+            # The scans are gone, so it's not pending any more
+            assert scans.join(name).listdir() == []
+        assert batch.throughput()[:2] == (3, 12)
+        assert find_pending([str(scans)], str(out)) == []
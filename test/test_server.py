@@ -0,0 +1,116 @@
+import scanpdf.scanpdf as P
+from scanpdf.server import Server, ServerError, request
+import docopt
+import pytest
+import os
+import sys
+import time
+import threading
+
+from mock import patch
+
+
+class FakeScanPdf(object):
+    """ Stands in for ScanPdf, recording the jobs it's asked to run """
+
+    ran = []
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.pool = None
+        self.environ = None
+
+    def go(self, args):
+        with self.lock:
+            self.ran.append(('start', args['<pdffile>'], self.environ.get('SCANBD_DEVICE')))
+        time.sleep(0.1)
+        if args['<pdffile>'].endswith('bad.pdf'):
+            raise SystemExit(-1)
+        with self.lock:
+            self.ran.append(('end', args['<pdffile>'], self.pool))
+
+
+class TestServer:
+
+    def setup(self):
+        FakeScanPdf.ran = []
+
+    def start(self, tmpdir, jobs=1):
+        self.socket_path = str(tmpdir.join('scanpdf.sock'))
+        server = Server(self.socket_path, FakeScanPdf, jobs)
+        server.start()
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server
+
+    def args(self, *argv):
+        return docopt.docopt(P.__doc__, argv=list(argv))
+
+    def wait_for(self, job):
+        for i in range(100):
+            status, = request(self.socket_path, {'cmd': 'status', 'job': job})
+            if status['state'] not in ('queued', 'running'):
+                return status
+            time.sleep(0.05)
+
+    def test_jobs_queue_up(self, tmpdir):
+        server = self.start(tmpdir, jobs=2)
+        try:
+            first = request(self.socket_path, {'cmd': 'submit', 'args': self.args('pdf', '/tmp/a.pdf'),
+                                               'env': {'SCANBD_DEVICE': 'fujitsu'}})
+            second = request(self.socket_path, {'cmd': 'submit', 'args': self.args('pdf', '/tmp/b.pdf'), 'env': {}})
+            assert first['state'] == 'queued' and second['job'] == first['job'] + 1
+            assert self.wait_for(second['job'])['state'] == 'done'
+        finally:
+            server.stop()
+        # One after the other, on the same warm pool
+        assert [r[:2] for r in FakeScanPdf.ran] == [('start', '/tmp/a.pdf'), ('end', '/tmp/a.pdf'),
+                                                   ('start', '/tmp/b.pdf'), ('end', '/tmp/b.pdf')]
+        assert FakeScanPdf.ran[0][2] == 'fujitsu'
+        assert FakeScanPdf.ran[1][2] is FakeScanPdf.ran[3][2] is server.pool is not None
+        assert not os.path.exists(self.socket_path)
+
+    def test_failed_job(self, tmpdir):
+        server = self.start(tmpdir)
+        try:
+            job = request(self.socket_path, {'cmd': 'submit', 'args': self.args('pdf', 'bad.pdf')})
+            status = self.wait_for(job['job'])
+            assert status['state'] == 'failed' and status['error'] == 'exit status -1'
+            with pytest.raises(ServerError):
+                request(self.socket_path, {'cmd': 'status', 'job': 42})
+        finally:
+            server.stop()
+
+    def test_already_serving(self, tmpdir):
+        server = self.start(tmpdir)
+        try:
+            with pytest.raises(ServerError):
+                Server(self.socket_path, FakeScanPdf).start()
+        finally:
+            server.stop()
+
+    def test_only_our_user(self, tmpdir):
+        server = self.start(tmpdir)
+        try:
+            assert os.stat(self.socket_path).st_mode & 0o777 == 0o600
+            with patch('scanpdf.server.peer_uid', return_value=os.getuid() + 1):
+                with pytest.raises(ServerError):
+                    request(self.socket_path, {'cmd': 'submit', 'args': self.args('pdf', '/tmp/a.pdf')})
+            assert server.status() == []
+            if sys.platform.startswith('linux'):
+                # The real thing
+                assert request(self.socket_path, {'cmd': 'status', 'job': None}) == []
+        finally:
+            server.stop()
+
+    def test_stale_socket(self, tmpdir):
+        self.socket_path = str(tmpdir.join('scanpdf.sock'))
+        tmpdir.join('scanpdf.sock').write('')
+        server = Server(self.socket_path, FakeScanPdf)
+        server.start()
+        server.stop()
+
+    def test_no_server(self, tmpdir):
+        with pytest.raises(ServerError):
+            request(str(tmpdir.join('nothing.sock')), {'cmd': 'status', 'job': None})
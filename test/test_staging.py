@@ -0,0 +1,104 @@
+import scanpdf.scanpdf as P
+from scanpdf.staging import Staging, page_of
+import os
+
+import numpy as np
+from mock import patch
+
+
+class TestStaging:
+
+    def write(self, staging, name, size):
+        path = staging.path(name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_page_of(self):
+        assert page_of('./page_0001.crop_bw') == 'page_0001'
+        assert page_of('/tmp/x/page_0012') == 'page_0012'
+        assert page_of('journal.json') is None
+
+    def test_scans_stay_on_disk(self, tmpdir):
+        disk, ram = tmpdir.mkdir('disk'), tmpdir.mkdir('ram')
+        staging = Staging(str(disk), str(ram), 1000)
+        assert staging.path('./page_0001') == str(disk.join('page_0001'))
+        assert staging.path('journal.json') == str(disk.join('journal.json'))
+        assert os.path.dirname(staging.path('./page_0001.crop')) == staging.ram_dir
+        staging.close()
+        assert ram.listdir() == []
+
+    def test_spills_least_recently_used(self, tmpdir):
+        disk, ram = tmpdir.mkdir('disk'), tmpdir.mkdir('ram')
+        staging = Staging(str(disk), str(ram), 250)
+        for i in (1, 2, 3):
+            staging.begin('./page_%04d' % i)
+            self.write(staging, './page_%04d.crop' % i, 100)
+            self.write(staging, './page_%04d.crop.stream' % i, 10)
+            staging.end('./page_%04d' % i)
+        # Page 1 had to go, along with all its files
+        assert sorted(disk.listdir()) == [disk.join('page_0001.crop'), disk.join('page_0001.crop.stream')]
+        assert staging.path('./page_0001.crop.stream') == str(disk.join('page_0001.crop.stream'))
+        assert os.path.dirname(staging.path('./page_0003.crop.stream')) == staging.ram_dir
+        # Page 2 was used more recently, so page 3 goes next
+        staging.begin('./page_0002')
+        self.write(staging, './page_0002.crop_bw', 100)
+        staging.end('./page_0002')
+        assert staging.path('./page_0002.crop_bw').startswith(staging.ram_dir)
+        assert disk.join('page_0003.crop').check()
+        staging.close(keep=True)
+        assert disk.join('page_0002.crop_bw').check() and not os.path.exists(staging.ram_dir)
+
+    def test_through_scanpdf(self, tmpdir):
+        disk, ram = tmpdir.mkdir('disk'), tmpdir.mkdir('ram')
+        p = P.ScanPdf()
+        p.tmp_dir = str(disk)
+        p.staging = Staging(str(disk), str(ram), 10 ** 6)
+        assert p._tmp_path('./page_0001') == str(disk.join('page_0001'))
+        assert p._artifact('./page_0001.crop') == os.path.join(p.staging.ram_dir, 'page_0001.crop.stream')
+        p.staging.close()
+
+    def test_not_moved_while_appended(self, tmpdir):
+        from scanpdf.pdfwriter import encode_grey, PdfImage
+        disk, ram = tmpdir.mkdir('disk'), tmpdir.mkdir('ram')
+        p = P.ScanPdf()
+        p.tmp_dir = str(disk)
+        p.dpi = 100
+        p.pdf_filename = str(tmpdir.join('out.pdf'))
+        p.args = {'--keep-tmpdir': False, '--face-up': False}
+        # Nothing fits, so anything not being worked on is moved to disk
+        p.staging = Staging(str(disk), str(ram), 0)
+        disk.join('page_0001').write('raw')
+        encode_grey(np.full((20, 10), 255, dtype=np.uint8)).save(p._tmp_path('./page_0001.crop.stream'))
+        load = PdfImage.load
+        def spill_while_loading(filename):
+            # Another page finishing in a worker
+            p.staging.settle()
+            return load(filename)
+        with patch.object(PdfImage, 'load', side_effect=spill_while_loading):
+            p.assemble([('./page_0001', './page_0001.crop')])
+        assert sorted(os.listdir(str(disk))) == ['page_0001', 'page_0001.crop.stream']
+        assert tmpdir.join('out.pdf').check()
+        p.staging.close()
+
+    def test_not_moved_while_prefetched(self, tmpdir):
+        disk, ram = tmpdir.mkdir('disk'), tmpdir.mkdir('ram')
+        p = P.ScanPdf()
+        p.tmp_dir = str(disk)
+        p.staging = Staging(str(disk), str(ram), 0)
+        disk.join('page_0001').write('raw')
+        def crop_and_check(pages, check_blank=True):
+            for filename, out_filename, size in pages:
+                with open(out_filename, 'w') as f:
+                    f.write('crop')
+                    # Another page finishing in a worker, while convert is still writing
+                    p.staging.settle()
+                    assert os.path.exists(out_filename)
+            return {}
+        with patch.object(p.imagemagick, 'crop_and_check', side_effect=crop_and_check), \
+             patch.object(p, 'get_dimensions', return_value=(10, 10)):
+            p._crop_and_check(['./page_0001'])
+        assert p.prefetched == {('crop', str(disk.join('page_0001'))): './page_0001.crop'}
+        # Once it's written, it can go
+        assert sorted(os.listdir(str(disk))) == ['page_0001', 'page_0001.crop']
+        p.staging.close()
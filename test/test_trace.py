@@ -0,0 +1,99 @@
+import scanpdf.scanpdf as P
+from scanpdf.trace import Tracer
+from scanpdf.profiler import Profiler
+import json
+import pstats
+from multiprocessing.dummy import Pool as ThreadPool
+
+
+class TestTrace:
+
+    def setup(self):
+        self.p = P.ScanPdf()
+
+    def test_chrome_trace(self, tmpdir):
+        filename = str(tmpdir.join('trace.json'))
+        self.p.tracer = Tracer(filename)
+        src = tmpdir.join('page_0001')
+        src.write('x' * 1000)
+        with self.p.tracer.stage('crop', './page_0001'):
+            self.p.cmd(['cp', str(src), str(tmpdir.join('page_0001.crop'))])
+        self.p.tracer.close()
+
+        events = json.load(open(filename))
+        cmd, stage = events
+        assert cmd['name'] == 'cp'
+        assert cmd['cat'] == 'cmd'
+        assert cmd['args']['page'] == './page_0001'
+        assert cmd['args']['bytes_in'] == 1000
+        assert cmd['args']['bytes_out'] == 1000
+        assert cmd['args']['returncode'] == 0
+        assert cmd['args']['max_rss_kb'] > 0
+        assert stage['name'] == 'crop' and stage['ph'] == 'X'
+        assert stage['ts'] <= cmd['ts'] and cmd['ts'] + cmd['dur'] <= stage['ts'] + stage['dur']
+
+    def test_jsonl_trace(self, tmpdir):
+        filename = str(tmpdir.join('trace.jsonl'))
+        self.p.tracer = Tracer(filename)
+        with self.p.tracer.stage('page', './page_0002'):
+            with self.p.tracer.stage('blank'):
+                pass
+        self.p.tracer.close()
+        events = [json.loads(line) for line in open(filename)]
+        assert [e['name'] for e in events] == ['blank', 'page']
+        assert all(e['args']['page'] == './page_0002' for e in events)
+
+    def test_traced_stage(self, tmpdir):
+        filename = str(tmpdir.join('trace.json'))
+        self.p.tracer = Tracer(filename)
+        self.p.tmp_dir = str(tmpdir)
+        self.p.is_blank = lambda filename: False
+        self.p._remove_if_blank('./page_0003')
+        self.p.tracer.close()
+        events = json.load(open(filename))
+        assert [(e['name'], e['args']['page']) for e in events] == [('blank', './page_0003')]
+
+    def test_pipeline(self, tmpdir):
+        filename = str(tmpdir.join('trace.jsonl'))
+        self.p.tracer = Tracer(filename)
+        assert self.p.pipeline([['cat'], ['tr', 'a-z', 'A-Z']], input=b'hello') == b'HELLO'
+        self.p.tracer.close()
+        event, = [json.loads(line) for line in open(filename)]
+        assert event['name'] == 'cat'
+        assert event['args']['cmd'] == 'cat | tr a-z A-Z'
+        assert event['args']['bytes_in'] == 5 and event['args']['bytes_out'] == 5
+
+    def test_no_trace(self):
+        with self.p.tracer.stage('crop', './page_0001'):
+            assert self.p.tracer.start_command([['ls']]) is None
+
+    def test_profile(self, tmpdir):
+        profiler = Profiler(str(tmpdir.join('scanpdf.prof')))
+        self.p.profiler = profiler
+        self.p.tracer = Tracer(profiler=profiler)
+        self.p.pool = ThreadPool(2)
+        profiler.start()
+
+        def work(page):
+            with self.p.tracer.stage('page', page):
+                with self.p.tracer.stage('crop', '%s.crop' % page):
+                    self.p.cmd(['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done'])
+                return sum(range(100000))
+        self.p.run_parallel(work, ['./page_0001', './page_0002'])
+        self.p.pool.close()
+        self.p.pool.join()
+        profiler.stop()
+        profiler.save()
+
+        assert sorted(profiler.pages) == ['page_0001', 'page_0002']
+        page = profiler.pages['page_0001']
+        assert page['commands'] == 1 and page['cpu'] > 0 and page['max_rss_kb'] > 0 and page['wall'] > 0
+        assert profiler.stages['crop']['count'] == 2 and profiler.stages['crop']['cpu'] > 0
+        assert profiler.stages['page']['cpu'] == 0
+        # The workers' Python is in the profile too
+        stats = pstats.Stats(str(tmpdir.join('scanpdf.prof')))
+        assert [name for name in stats.stats if name[2] == 'work'][0] in stats.stats
+        report = profiler.report()
+        assert 'page_0002' in report and 'crop' in report and ' work ' in report
+        # The workers waiting for something to do isn't time spent
+        assert "'acquire' of" not in report